@@ -0,0 +1,300 @@
+# bench.py - offline microbenchmarks for the QVTP hot paths
+#
+#   python bench.py                       table of results
+#   python bench.py -o results.json       also save them
+#   python bench.py --compare old.json    change against an earlier run
+#   python bench.py -k checksum           only benchmarks whose name contains this
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import ssl
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import QuicConnection
+from aioquic.quic.events import StreamDataReceived
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+import pdu
+import quic_compat
+from fec import FecCodec
+from reassembly import RangeSet
+
+PAYLOAD_SIZES = (1024, 10 * 1024, 64 * 1024, 1024 * 1024)
+CHUNK_SIZE = 10 * 1024
+
+CLIENT_ADDR = ('1.2.3.4', 1234)
+SERVER_ADDR = ('2.3.4.5', 4433)
+
+
+def measure(fn: Callable[[], None], min_time: float, repeat: int = 3) -> float:
+    """Best seconds per call of fn over `repeat` runs of at least min_time each."""
+    fn()
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / 10:
+            break
+        loops *= 10
+    loops = max(1, int(loops * min_time / max(elapsed, 1e-9)))
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        best = min(best, (time.perf_counter() - started) / loops)
+    return best
+
+
+def result(name: str, seconds: float, nbytes: int, **params) -> Dict:
+    return {'name': name, 'params': params, 'ns_per_op': round(seconds * 1e9, 1),
+            'mb_per_s': round(nbytes / seconds / 1e6, 2) if nbytes else None}
+
+
+def bench_codec(min_time: float) -> List[Dict]:
+    results = []
+    for size in PAYLOAD_SIZES:
+        data = os.urandom(size)
+        datagram = pdu.Datagram(pdu.MSG_TYPE_DATA, "", sequence_num=1, data=data, offset=size,
+                                checksum_alg=pdu.CHECKSUM_CRC32, checksum=1)
+        buffer = bytearray(datagram.encoded_size())
+        encoded = bytes(datagram.to_bytes())
+        results.append(result('encode', measure(lambda: datagram.to_bytes(), min_time), size, payload=size))
+        results.append(result('encode_into', measure(lambda: datagram.to_bytes(buffer), min_time), size, payload=size))
+        results.append(result('decode', measure(lambda: pdu.Datagram.from_bytes(encoded), min_time), size, payload=size))
+
+    frames = bytes(pdu.encode_batch([pdu.Datagram(pdu.MSG_TYPE_DATA, "", data=os.urandom(CHUNK_SIZE))] * 64))
+    fragments = [frames[i:i + 1200] for i in range(0, len(frames), 1200)]
+
+    def decode_fragments():
+        decoder = pdu.FrameDecoder()
+        for fragment in fragments:
+            decoder.feed(fragment)
+
+    results.append(result('frame_decode', measure(decode_fragments, min_time), len(frames),
+                          payload=CHUNK_SIZE, fragment=1200))
+    return results
+
+
+def bench_checksums(min_time: float) -> List[Dict]:
+    results = []
+    for name in pdu.supported_checksums():
+        alg = pdu.CHECKSUM_NAMES[name]
+        for size in (CHUNK_SIZE, 1024 * 1024):
+            data = os.urandom(size)
+            results.append(result('checksum', measure(lambda: pdu.compute_checksum(alg, data), min_time), size,
+                                  alg=name, payload=size))
+    for name in pdu.DIGEST_ALGORITHMS:
+        data = os.urandom(1024 * 1024)
+        results.append(result('digest', measure(lambda: pdu.new_digest(name).update(data), min_time), len(data),
+                              alg=name, payload=len(data)))
+    return results
+
+
+def bench_chunk_loop(min_time: float) -> List[Dict]:
+    """The send loop of video_client/video_server without I/O, and the receive side's bookkeeping."""
+    results = []
+    source = memoryview(os.urandom(4 * 1024 * 1024))
+    send_buffer = bytearray(pdu.HEADER.size + CHUNK_SIZE + 64)
+    for name in dict.fromkeys(('none', 'crc32', pdu.negotiate_checksum(pdu.DEFAULT_CHECKSUMS))):
+        alg = pdu.CHECKSUM_NAMES[name]
+
+        def send_loop():
+            for offset in range(0, len(source), CHUNK_SIZE):
+                chunk = source[offset:offset + CHUNK_SIZE]
+                datagram = pdu.Datagram(pdu.MSG_TYPE_DATA, "", sequence_num=offset // CHUNK_SIZE + 1, data=chunk,
+                                        offset=offset)
+                datagram.calculate_checksum(alg)
+                datagram.to_bytes(send_buffer)
+
+        results.append(result('chunk_send_loop', measure(send_loop, min_time), len(source),
+                              alg=name, chunk=CHUNK_SIZE))
+
+    encoded = [bytes(pdu.Datagram(pdu.MSG_TYPE_DATA, "", data=source[offset:offset + CHUNK_SIZE], offset=offset,
+                                  checksum_alg=pdu.CHECKSUM_CRC32,
+                                  checksum=pdu.compute_checksum(pdu.CHECKSUM_CRC32,
+                                                                source[offset:offset + CHUNK_SIZE])).to_bytes())
+               for offset in range(0, len(source), CHUNK_SIZE)]
+
+    def receive_loop():
+        received = RangeSet()
+        for frame in encoded:
+            datagram = pdu.Datagram.from_bytes(frame)
+            if datagram.is_checksum_valid(pdu.CHECKSUM_CRC32):
+                received.add(datagram.offset, datagram.offset + len(datagram.data))
+
+    results.append(result('chunk_receive_loop', measure(receive_loop, min_time), len(source),
+                          alg='crc32', chunk=CHUNK_SIZE))
+    return results
+
+
+def bench_fec(min_time: float) -> List[Dict]:
+    """FEC parity for one group of live datagrams, and rebuilding m lost ones from it."""
+    results = []
+    for scheme, k, m in (('xor', 8, 1), ('rs', 8, 2), ('rs', 16, 4)):
+        codec = FecCodec(scheme, k, m)
+        blocks = [os.urandom(pdu.LIVE_BLOCK.size + pdu.LIVE_PAYLOAD_SIZE) for _ in range(k)]
+        parities = codec.encode(blocks)
+        survivors = {i: block for i, block in enumerate(blocks) if i >= m}
+        survivors.update((k + j, parity) for j, parity in enumerate(parities))
+        size = sum(len(block) for block in blocks)
+        results.append(result('fec_encode', measure(lambda: codec.encode(blocks), min_time), size,
+                              scheme=scheme, k=k, m=m))
+        results.append(result('fec_recover', measure(lambda: codec.recover(k, survivors), min_time), size,
+                              scheme=scheme, k=k, m=m))
+    return results
+
+
+def _self_signed():
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number()).not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256()))
+    return cert, key
+
+
+def _exchange(sender: QuicConnection, receiver: QuicConnection, addr) -> int:
+    now = time.time()
+    count = 0
+    for data, _ in sender.datagrams_to_send(now=now):
+        receiver.receive_datagram(data, addr, now=now)
+        count += 1
+    return count
+
+
+def transfer_in_memory(size: int, chunk_size: int = CHUNK_SIZE) -> float:
+    """
+    Seconds to move size bytes as checksummed DATA PDUs from a client to a
+    server QuicConnection, handing datagrams straight from one to the other
+    (TLS, packetisation, ACKs and flow control included, no sockets).
+    """
+    cert, key = _self_signed()
+    server_config = QuicConfiguration(is_client=False, alpn_protocols=['echo-protocol'])
+    server_config.certificate, server_config.private_key = cert, key
+    client_config = QuicConfiguration(is_client=True, alpn_protocols=['echo-protocol'], server_name='localhost')
+    client_config.verify_mode = ssl.CERT_NONE
+    client = QuicConnection(configuration=client_config)
+    client.connect(SERVER_ADDR, now=time.time())
+    server = QuicConnection(configuration=server_config,
+                            original_destination_connection_id=client.original_destination_connection_id)
+    while _exchange(client, server, CLIENT_ADDR) + _exchange(server, client, SERVER_ADDR):
+        pass
+
+    source = memoryview(os.urandom(size))
+    stream_id = client.get_next_available_stream_id()
+    decoder = pdu.FrameDecoder()
+    send_buffer = bytearray(pdu.HEADER.size + chunk_size + 64)
+    received = 0
+    offset = 0
+    internals = quic_compat.QuicInternals(client)
+    started = time.perf_counter()
+    while received < size:
+        # Keep about a window's worth of data queued on the client
+        queued = internals.send_buffered(stream_id)
+        while offset < size and queued < 1024 * 1024:
+            datagram = pdu.Datagram(pdu.MSG_TYPE_DATA, "", data=source[offset:offset + chunk_size], offset=offset)
+            datagram.calculate_checksum(pdu.CHECKSUM_CRC32)
+            encoded = datagram.to_bytes(send_buffer)
+            client.send_stream_data(stream_id, pdu.FRAME_PREFIX.pack(len(encoded)) + encoded)
+            queued += pdu.FRAME_PREFIX.size + len(encoded)
+            offset += chunk_size
+        _exchange(client, server, CLIENT_ADDR)
+        _exchange(server, client, SERVER_ADDR)
+        event = server.next_event()
+        while event is not None:
+            if isinstance(event, StreamDataReceived):
+                for frame in decoder.feed(event.data):
+                    datagram = pdu.Datagram.from_bytes(frame)
+                    if not datagram.is_checksum_valid(pdu.CHECKSUM_CRC32):
+                        raise AssertionError('checksum mismatch in transfer')
+                    received += len(datagram.data)
+            event = server.next_event()
+    return time.perf_counter() - started
+
+
+def bench_transfer(min_time: float) -> List[Dict]:
+    size = 32 * 1024 * 1024
+    results = []
+    for chunk_size in (pdu.LEGACY_CHUNK_SIZE, pdu.choose_chunk_size(size, None), pdu.MAX_CHUNK_SIZE // 4):
+        seconds = min(transfer_in_memory(size, chunk_size) for _ in range(2))
+        results.append(result('transfer_in_memory', seconds, size, size=size, chunk=chunk_size))
+    return results
+
+
+# Each group with the names of the benchmarks it runs, for -k
+BENCHMARKS = {
+    'codec': (bench_codec, ('encode', 'encode_into', 'decode', 'frame_decode')),
+    'checksum': (bench_checksums, ('checksum', 'digest')),
+    'chunk_loop': (bench_chunk_loop, ('chunk_send_loop', 'chunk_receive_loop')),
+    'fec': (bench_fec, ('fec_encode', 'fec_recover')),
+    'transfer': (bench_transfer, ('transfer_in_memory',)),
+}
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'python': platform.python_version(), 'machine': platform.machine(),
+            'checksums': pdu.supported_checksums(), 'time': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def key(entry: Dict) -> str:
+    return entry['name'] + ''.join(f' {k}={v}' for k, v in sorted(entry['params'].items()))
+
+
+def print_table(results: List[Dict], baseline: Optional[Dict[str, Dict]] = None) -> None:
+    for entry in results:
+        line = f'{key(entry):<52} {entry["ns_per_op"]:>14,.1f} ns/op'
+        if entry['mb_per_s'] is not None:
+            line += f' {entry["mb_per_s"]:>10,.1f} MB/s'
+        old = baseline.get(key(entry)) if baseline else None
+        if old:
+            # Positive is faster than the baseline
+            line += f' {(old["ns_per_op"] / entry["ns_per_op"] - 1) * 100:>+8.1f}%'
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='QVTP microbenchmarks')
+    parser.add_argument('-k', '--filter', default='', help='Only run benchmarks whose group or name contains this')
+    parser.add_argument('-o', '--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Seconds to run each measurement for')
+    args = parser.parse_args()
+
+    results = []
+    for group, (bench, names) in BENCHMARKS.items():
+        if args.filter and args.filter not in group and not any(args.filter in name for name in names):
+            continue
+        print(f'# {group}', file=sys.stderr)
+        results.extend(entry for entry in bench(args.min_time)
+                       if not args.filter or args.filter in group or args.filter in entry['name'])
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {key(entry): entry for entry in json.load(f)['results']}
+    print_table(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import asyncio
+import bisect
+import os
+from typing import Dict, List, Optional, Tuple
+
+import pdu
+from chunk_cache import FileVersion
+from chunk_source import file_digest
+from disk_io import DiskPool, get_pool
+
+VIDEO_EXTENSIONS = ('.mp4', '.m4v', '.mkv', '.mov', '.webm', '.avi', '.ts')
+DEFAULT_REFRESH = 5.0  # seconds between rescans
+
+# Entries per LIST reply, by default and at most
+LIST_PAGE = 100
+MAX_LIST_PAGE = 1000
+
+
+class CatalogEntry:
+    """A servable file: its name as clients ask for it, where it is, and what it was at the last scan."""
+    __slots__ = ('name', 'path', 'size', 'mtime_ns', 'chunk_size', 'digest')
+
+    def __init__(self, name: str, path: str, size: int, mtime_ns: int) -> None:
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        # Chunk size a download gets unless the client's window asks for smaller
+        self.chunk_size = pdu.choose_chunk_size(size, None)
+        # (algorithm, whole-file digest) once computed in the background
+        self.digest: Optional[Tuple[str, bytes]] = None
+
+    @property
+    def version(self) -> FileVersion:
+        return self.path, self.size, self.mtime_ns
+
+    def describe(self) -> Dict:
+        entry = {'name': self.name, 'size': self.size, 'mtime_ns': self.mtime_ns, 'chunk_size': self.chunk_size}
+        if self.digest and self.digest[0]:
+            entry['digest'] = [self.digest[0], self.digest[1].hex()]
+        return entry
+
+
+class Catalog:
+    """
+    Index of the videos under a root directory, the only files the server
+    serves. Built by a scan at startup and rescanned every refresh seconds
+    on the disk pool; only files that appeared, changed size or mtime, or
+    went away are touched. A REQUEST is then answered from memory, in the
+    same time whatever the file's size, and a client can't name anything
+    outside the root: names are relative paths found by the scan, and
+    symlinks and hidden entries are skipped.
+
+    With digest set, whole-file digests of new and changed files are
+    computed in the background, so a download asking for that digest
+    doesn't have to hash the file again.
+    """
+
+    def __init__(self, root: str = '.', extensions=VIDEO_EXTENSIONS, digest: Optional[str] = None,
+                 refresh: float = DEFAULT_REFRESH, pool: Optional[DiskPool] = None) -> None:
+        self.root = os.path.abspath(root)
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        self.digest_name = digest
+        self.refresh_interval = refresh
+        self.pool = pool or get_pool()
+        self._entries: Dict[str, CatalogEntry] = {}
+        self._names: List[str] = []
+        # Files being uploaded, left out until complete, and by how many streams
+        self._held: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._digest_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, name: str) -> Optional[CatalogEntry]:
+        return self._entries.get(name)
+
+    def name_of(self, path: str) -> Optional[str]:
+        """Catalog name of a path, or None if it is outside the root."""
+        relative = os.path.relpath(os.path.abspath(path), self.root)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        return relative.replace(os.sep, '/')
+
+    def page(self, cursor: Optional[str] = None, limit: int = LIST_PAGE) -> Tuple[List[CatalogEntry], Optional[str]]:
+        """
+        Entries in name order after cursor (from the start if None), and
+        the cursor of the next page, None on the last one. A cursor is a
+        name, so paging stays in order while files come and go.
+        """
+        first = bisect.bisect_right(self._names, cursor) if cursor else 0
+        names = self._names[first:first + limit]
+        more = first + limit < len(self._names)
+        return [self._entries[name] for name in names], names[-1] if more and names else None
+
+    async def start(self) -> None:
+        """Scan the root, then keep rescanning it in the background."""
+        await self.refresh()
+        print(f'[svr] Catalog of {self.root}: {len(self)} files')
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                added, changed, removed = await self.refresh()
+            except OSError as e:
+                print(f'[svr] Catalog refresh failed: {e}')
+                continue
+            if added or changed or removed:
+                print(f'[svr] Catalog refreshed: {added} added, {changed} changed, {removed} removed, {len(self)} files')
+
+    async def refresh(self) -> Tuple[int, int, int]:
+        """Rescan the root; returns the number of files added, changed and removed."""
+        found = await self.pool.submit(self._scan)
+        added = changed = 0
+        for name, (size, mtime_ns) in found.items():
+            if name in self._held:
+                continue
+            entry = self._entries.get(name)
+            if entry is not None and (entry.size, entry.mtime_ns) == (size, mtime_ns):
+                continue
+            if entry is None:
+                added += 1
+            else:
+                changed += 1
+            self._entries[name] = CatalogEntry(name, os.path.join(self.root, name), size, mtime_ns)
+        removed = [name for name in self._entries if name not in found or name in self._held]
+        for name in removed:
+            del self._entries[name]
+        if added or changed or removed:
+            self._names = sorted(self._entries)
+            self._compute_digests()
+        return added, changed, len(removed)
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        # Blocking; runs on the disk pool
+        found = {}
+        directories = [self.root]
+        while directories:
+            try:
+                scan = os.scandir(directories.pop())
+            except OSError:
+                continue
+            with scan:
+                items = list(scan)
+            names = {item.name for item in items}
+            for item in items:
+                if item.name.startswith('.') or item.is_symlink():
+                    continue
+                if item.is_dir():
+                    directories.append(item.path)
+                elif (item.is_file() and item.name.lower().endswith(self.extensions)
+                        and item.name + '.journal' not in names):
+                    # (a journal next to it means a resumable upload of it is unfinished)
+                    stat = item.stat()
+                    found[self.name_of(item.path)] = (stat.st_size, stat.st_mtime_ns)
+        return found
+
+    def hold(self, name: str) -> None:
+        """Leave a file out while it is being written, e.g. by the streams of an upload."""
+        self._held[name] = self._held.get(name, 0) + 1
+        if self._entries.pop(name, None) is not None:
+            self._names = sorted(self._entries)
+
+    async def release(self, name: str, complete: bool = True) -> None:
+        """
+        One writer of a held file is done. Once all are, a complete file is
+        put back as it is now, if it is one we serve; an incomplete one is
+        left to the next rescan.
+        """
+        held = self._held.get(name, 0) - 1
+        if held > 0:
+            self._held[name] = held
+            return
+        self._held.pop(name, None)
+        path = os.path.join(self.root, name)
+        if not complete or not name.lower().endswith(self.extensions):
+            return
+        try:
+            stat = await self.pool.submit(os.stat, path)
+        except OSError:
+            return
+        self._entries[name] = CatalogEntry(name, path, stat.st_size, stat.st_mtime_ns)
+        self._names = sorted(self._entries)
+        self._compute_digests()
+
+    def _compute_digests(self) -> None:
+        if self.digest_name and (self._digest_task is None or self._digest_task.done()):
+            self._digest_task = asyncio.ensure_future(self._digest_pending())
+
+    async def _digest_pending(self) -> None:
+        while True:
+            entry = next((entry for entry in self._entries.values() if entry.digest is None), None)
+            if entry is None:
+                return
+            try:
+                digest = await file_digest(entry.path, self.digest_name, 0, entry.size)
+            except OSError:
+                digest = None
+            # Only if the file wasn't replaced meanwhile; a failed one is
+            # marked done too and picked up again once a rescan sees it change
+            if self._entries.get(entry.name) is entry:
+                entry.digest = (self.digest_name, digest) if digest is not None else ('', b'')
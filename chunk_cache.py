@@ -0,0 +1,184 @@
+import asyncio
+import os
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import metrics
+import pdu
+from disk_io import DiskPool, get_pool
+
+DEFAULT_CACHE_BUDGET = 256 * 1024 * 1024
+
+# (path, size, mtime_ns) identifies one version of a file
+FileVersion = Tuple[str, int, int]
+
+
+class ChunkCache:
+    """
+    Byte-budgeted LRU cache of file chunks and their checksums for downloads.
+
+    Chunks sit on a chunk_size grid from the start of the file and are keyed
+    by file version, chunk size, checksum algorithm and index, so a popular
+    video is read from disk and checksummed once no matter how its
+    downloads are split into parts. Seeing a new size or mtime for a path
+    drops what is cached for the old one. Concurrent misses on a chunk
+    share a single read.
+    """
+
+    def __init__(self, budget: int = DEFAULT_CACHE_BUDGET, pool: Optional[DiskPool] = None) -> None:
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pool = pool or get_pool()
+        self._entries: OrderedDict = OrderedDict()
+        self._filling: Dict[tuple, asyncio.Future] = {}
+        self._versions: Dict[str, FileVersion] = {}
+
+    def stats(self) -> dict:
+        return {'budget': self.budget, 'size': self.size, 'entries': len(self._entries),
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def version(self, path: str) -> FileVersion:
+        """Stat path, invalidating its cached chunks if the file has changed."""
+        stat = os.stat(path)
+        return self.track((path, stat.st_size, stat.st_mtime_ns))
+
+    def track(self, version: FileVersion) -> FileVersion:
+        """Note the current version of a file, known without a stat, e.g. from the catalog."""
+        path = version[0]
+        if self._versions.get(path, version) != version:
+            self.invalidate(path)
+        self._versions[path] = version
+        return version
+
+    def invalidate(self, path: str) -> None:
+        for key in [key for key in self._entries if key[0][0] == path]:
+            self._drop(key)
+        self._versions.pop(path, None)
+
+    async def get(self, version: FileVersion, chunk_size: int, checksum_alg: int, index: int) -> Tuple[bytes, int]:
+        """Chunk number index of a file version and its checksum."""
+        key = (version, chunk_size, checksum_alg, index)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        filling = self._filling.get(key)
+        if filling is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            filling = self._filling[key] = asyncio.ensure_future(self._fill(key))
+        # A download that gives up must not cancel a read others wait on
+        return await asyncio.shield(filling)
+
+    async def _fill(self, key: tuple) -> Tuple[bytes, int]:
+        version = key[0]
+        try:
+            entry = await self.pool.submit(self._load, *key)
+        finally:
+            del self._filling[key]
+        if self._versions.get(version[0]) == version:
+            self._insert(key, entry)
+        return entry
+
+    def _load(self, version: FileVersion, chunk_size: int, checksum_alg: int, index: int) -> Tuple[bytes, int]:
+        path, size, _ = version
+        length = min(chunk_size, size - index * chunk_size)
+        with open(path, 'rb') as f:
+            f.seek(index * chunk_size)
+            data = f.read(length)
+        if len(data) != length:
+            raise EOFError(f'{path} shrank while being read')
+        return data, pdu.compute_checksum(checksum_alg, data)
+
+    def _insert(self, key: tuple, entry: Tuple[bytes, int]) -> None:
+        size = len(entry[0])
+        if size > self.budget:
+            return
+        self._entries[key] = entry
+        self.size += size
+        while self.size > self.budget:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key: tuple) -> None:
+        data, _ = self._entries.pop(key)
+        self.size -= len(data)
+
+
+class CachedChunks:
+    """
+    Chunks of a byte range of a file version, served from a ChunkCache.
+
+    Yields (offset, data, checksum), fetching up to read_ahead chunks
+    ahead. Chunks follow the cache's grid, so the first and last chunk of
+    a range not aligned to it are slices of a cached chunk and come with a
+    freshly computed checksum.
+    """
+
+    def __init__(self, cache: ChunkCache, version: FileVersion, chunk_size: int, checksum_alg: int,
+                 start: int, length: int, read_ahead: int = 4) -> None:
+        self.cache = cache
+        self.version = version
+        self.chunk_size = chunk_size
+        self.checksum_alg = checksum_alg
+        self.start = min(start, version[1])
+        self.end = min(version[1], self.start + length)
+        self.read_ahead = max(1, read_ahead)
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[int, memoryview, int]]:
+        if self.start >= self.end:
+            return
+        first = self.start // self.chunk_size
+        last = (self.end - 1) // self.chunk_size
+        pending = deque()
+        index = first
+        try:
+            while True:
+                while len(pending) < self.read_ahead and index <= last:
+                    pending.append((index, asyncio.ensure_future(
+                        self.cache.get(self.version, self.chunk_size, self.checksum_alg, index))))
+                    index += 1
+                if not pending:
+                    break
+                chunk_index, future = pending.popleft()
+                data, checksum = await future
+                chunk_start = chunk_index * self.chunk_size
+                lo = max(self.start, chunk_start) - chunk_start
+                hi = min(self.end, chunk_start + len(data)) - chunk_start
+                view = memoryview(data)[lo:hi]
+                if hi - lo != len(data):
+                    checksum = pdu.compute_checksum(self.checksum_alg, view)
+                yield chunk_start + lo, view, checksum
+        finally:
+            for _, future in pending:
+                future.cancel()
+            if pending:
+                await asyncio.gather(*(future for _, future in pending), return_exceptions=True)
+
+
+_default_cache: Optional[ChunkCache] = None
+
+
+def get_cache() -> ChunkCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ChunkCache()
+    return _default_cache
+
+
+def set_cache(cache: ChunkCache) -> None:
+    global _default_cache
+    _default_cache = cache
+
+
+for _stat in ('size', 'hits', 'misses', 'evictions'):
+    metrics.registry.gauge(f'qvtp_chunk_cache_{_stat}', f'Download chunk cache {_stat}',
+                           read=lambda stat=_stat: getattr(get_cache(), stat))
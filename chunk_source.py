@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Callable, Optional, Tuple
+
+from disk_io import DiskPool, get_pool
+
+
+def part_range(filesize: int, part: int, parts: int) -> Tuple[int, int]:
+    """(start, length) of part number `part` when a file is split `parts` ways."""
+    start = filesize * part // parts
+    return start, filesize * (part + 1) // parts - start
+
+
+def open_preallocated(path: str, size: int) -> BinaryIO:
+    """
+    Open a file for positional writes, creating it if needed and sizing it
+    to `size` without discarding what is already there, so several streams
+    can each fill their own range of it.
+    """
+    f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+    f.truncate(size)
+    return f
+
+
+class ChunkSource:
+    """
+    Reads a file (or a byte range of it) chunk by chunk.
+
+    Up to read_ahead chunk buffers are in use at any time: the one the
+    caller is sending and the ones being filled on the disk pool, so disk
+    reads overlap network sends while memory stays at
+    read_ahead * chunk_size regardless of file size. A yielded chunk is
+    only valid until the next one is requested.
+    """
+
+    def __init__(self, path: str, chunk_size: int, start: int = 0,
+                 length: Optional[int] = None, read_ahead: int = 2, pool: Optional[DiskPool] = None) -> None:
+        self.path = path
+        self.chunk_size = chunk_size
+        self.filesize = os.path.getsize(path)
+        self.start = min(start, self.filesize)
+        self.end = self.filesize if length is None else min(self.filesize, self.start + length)
+        self.read_ahead = max(2, read_ahead)
+        self.pool = pool or get_pool()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def _read_at(self, f, buffer: bytearray, offset: int, size: int) -> memoryview:
+        view = memoryview(buffer)[:size]
+        filled = 0
+        with self._lock:
+            f.seek(offset)
+            while filled < size:
+                n = f.readinto(view[filled:])
+                if not n:
+                    raise EOFError(f'{self.path} shrank while being read')
+                filled += n
+        return view
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[int, memoryview]]:
+        free = [bytearray(self.chunk_size) for _ in range(self.read_ahead)]
+        pending = deque()
+        next_offset = self.start
+        with open(self.path, 'rb', buffering=0) as f:
+            try:
+                while True:
+                    while free and next_offset < self.end:
+                        size = min(self.chunk_size, self.end - next_offset)
+                        buffer = free.pop()
+                        future = self.pool.submit(self._read_at, f, buffer, next_offset, size)
+                        pending.append((next_offset, buffer, future))
+                        next_offset += size
+                    if not pending:
+                        break
+                    offset, buffer, future = pending.popleft()
+                    chunk = await future
+                    yield offset, chunk
+                    # The caller has moved on, so the buffer can be refilled
+                    free.append(buffer)
+            finally:
+                # Don't close the file under a read still running in the executor
+                for _, _, future in pending:
+                    await asyncio.gather(future, return_exceptions=True)
+
+
+async def file_digest(path: str, name: str, start: int = 0, length: Optional[int] = None,
+                      chunk_size: int = 1024 * 1024) -> bytes:
+    """Digest of a file or byte range, read with the same bounded read-ahead."""
+    digest = hashlib.new(name)
+    async for _, chunk in ChunkSource(path, chunk_size, start, length):
+        digest.update(chunk)
+    return digest.digest()
+
+
+class ChunkSizer:
+    """
+    Chunk size of one sending stream, kept between min_size and limit.
+
+    Fixed unless adaptive; then it hill-climbs on the throughput measured
+    over samples of a few chunks: it doubles while that improves by more
+    than a tenth, turns round when a step makes it worse, and holds once
+    neither direction helps, probing again every `reprobe` samples in
+    case the path has changed.
+    """
+
+    def __init__(self, size: int, limit: int, adaptive: bool = False, min_size: int = 4 * 1024,
+                 sample_chunks: int = 16, min_sample_time: float = 0.05, reprobe: int = 32) -> None:
+        self.size = size
+        self.limit = max(size, limit)
+        self.min_size = min(size, min_size)
+        self.adaptive = adaptive
+        self.sample_chunks = sample_chunks
+        self.min_sample_time = min_sample_time
+        self.reprobe = reprobe
+        self._direction = 2
+        self._rate = 0.0
+        self._held = 0
+        self._sample_bytes = 0
+        self._sample_chunks = 0
+        self._sample_started = time.monotonic()
+
+    def sent(self, size: int) -> int:
+        """Count a chunk of size bytes as sent; returns the size for the next one."""
+        if not self.adaptive:
+            return self.size
+        self._sample_bytes += size
+        self._sample_chunks += 1
+        elapsed = time.monotonic() - self._sample_started
+        if self._sample_chunks >= self.sample_chunks and elapsed >= self.min_sample_time:
+            self._adapt(self._sample_bytes / elapsed)
+            self._sample_bytes = self._sample_chunks = 0
+            self._sample_started = time.monotonic()
+        return self.size
+
+    def _adapt(self, rate: float) -> None:
+        if self._held:
+            # Settled: only probe again after a while
+            self._held -= 1
+            if not self._held:
+                self._rate = rate
+                self._step()
+            return
+        if rate > self._rate * 1.1:
+            self._rate = rate
+            if self._step():
+                return
+        elif rate < self._rate * 0.9:
+            # The last step hurt: undo it, and probe the other way next time
+            self._direction = 1 / self._direction
+            self._step()
+        self._held = self.reprobe
+
+    def _step(self) -> bool:
+        size = int(max(self.min_size, min(self.limit, self.size * self._direction)))
+        if size == self.size:
+            self._direction = 1 / self._direction
+            return False
+        self.size = size
+        return True
+
+
+async def resized_chunks(open_chunks: Callable[[int, int, int], AsyncIterable[tuple]], sizer: ChunkSizer,
+                         start: int, length: int) -> AsyncIterator[tuple]:
+    """
+    The chunks of [start, start + length) from open_chunks(chunk_size,
+    start, length), e.g. a ChunkSource, reopened where it left off
+    whenever sizer changes the chunk size. Each chunk is a tuple whose
+    first two items are its offset and data.
+    """
+    position = start
+    stop = start + length
+    while position < stop:
+        size = sizer.size
+        chunks = open_chunks(size, position, stop - position).__aiter__()
+        try:
+            async for chunk in chunks:
+                yield chunk
+                position = chunk[0] + len(chunk[1])
+                if sizer.size != size:
+                    break
+            else:
+                return
+        finally:
+            await chunks.aclose()
@@ -1,19 +1,31 @@
 class QuicStreamEvent:
-    def __init__(self, stream_id: int, data: bytes, end_stream: bool):
+    def __init__(self, stream_id: int, data: bytes, end_stream: bool, framed: bool = False):
         self.stream_id = stream_id
         self.data = data
         self.end_stream = end_stream
+        # True when data already holds length-prefixed PDUs (pdu.encode_batch)
+        self.framed = framed
 
 class EchoQuicConnection:
-    def __init__(self, send=None, receive=None, close=None, get_next_stream_id=None):
+    def __init__(self, send=None, receive=None, close=None, get_next_stream_id=None,
+                 send_datagram=None, open_datagrams=None, close_datagrams=None):
         self.send = send
         self.receive = receive
         self.close = close
         self.get_next_stream_id = get_next_stream_id
+        # Unreliable QUIC DATAGRAM frames of live streams: send one, or get
+        # the queue the datagrams of a flow arrive on
+        self.send_datagram = send_datagram
+        self.open_datagrams = open_datagrams
+        self.close_datagrams = close_datagrams
         self._connections = []
 
     def new_stream(self):
         # Create a new stream and return its ID
+        if self.get_next_stream_id is not None:
+            stream_id = self.get_next_stream_id()
+            self._connections.append(stream_id)
+            return stream_id
         stream_id = len(self._connections)
         self._connections.append(stream_id)
         return stream_id
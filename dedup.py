@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import random
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+# Content-defined chunk bounds. Past MIN_CHUNK a boundary falls wherever the
+# rolling hash has its top 16 bits clear, i.e. every 64 KiB on average.
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+BOUNDARY_MASK = 0xFFFF << 48
+HASH_WINDOW = 64
+
+CHUNK_HASH = 'sha256'
+
+# Gear hash table: a fixed pseudo-random 64-bit value per byte value. Every
+# client must use the same one, or the same content is cut differently and
+# nothing is found in the server's store.
+_rng = random.Random(0x51565450)
+_GEAR = [_rng.getrandbits(64) for _ in range(256)]
+del _rng
+_MASK64 = (1 << 64) - 1
+
+# (offset, length, SHA-256) of one chunk of a file
+ManifestEntry = Tuple[int, int, bytes]
+
+
+def _find_boundary(data, start: int, end: int) -> int:
+    """
+    End of the chunk that starts at start: the first position after
+    MIN_CHUNK where the gear hash of the last HASH_WINDOW bytes hits the
+    mask, else end. Each step shifts the hash left, so bytes older than 64
+    steps drop out and only local content decides where a chunk ends.
+    """
+    scan = start + MIN_CHUNK - HASH_WINDOW
+    if end - start <= MIN_CHUNK:
+        return end
+    gear = _GEAR
+    h = 0
+    for i, byte in enumerate(data[scan:end], scan):
+        h = ((h << 1) + gear[byte]) & _MASK64
+        if not h & BOUNDARY_MASK and i + 1 - start >= MIN_CHUNK:
+            return i + 1
+    return end
+
+
+def chunk_file(f: BinaryIO, block_size: int = 4 * 1024 * 1024) -> Iterator[Tuple[int, bytes]]:
+    """
+    Split a file into content-defined chunks of MIN_CHUNK to MAX_CHUNK
+    bytes and yield (offset, data) for each. An insertion or deletion
+    only changes the chunks around it, so a trimmed or re-muxed copy of a
+    file shares most of its chunks with the original.
+    """
+    buffer = b''
+    offset = 0
+    eof = False
+    while buffer or not eof:
+        if not eof and len(buffer) < MAX_CHUNK:
+            block = f.read(block_size)
+            eof = not block
+            buffer += block
+            continue
+        position = 0
+        # Only cut where a whole MAX_CHUNK is available, or at the end of the file
+        while len(buffer) - position >= MAX_CHUNK or (eof and position < len(buffer)):
+            end = _find_boundary(buffer, position, min(position + MAX_CHUNK, len(buffer)))
+            yield offset + position, buffer[position:end]
+            position = end
+        offset += position
+        buffer = buffer[position:]
+
+
+def file_manifest(path: str) -> List[ManifestEntry]:
+    """Content-defined chunks of a file with their digests; blocking, run it on the disk pool."""
+    with open(path, 'rb') as f:
+        return [(offset, len(data), hashlib.new(CHUNK_HASH, data).digest()) for offset, data in chunk_file(f)]
+
+
+def manifest_ranges(manifest: Iterable[ManifestEntry]) -> List[Tuple[int, int]]:
+    """(offset, length) byte ranges covering the given entries, adjacent ones merged."""
+    ranges = []
+    for offset, length, _ in manifest:
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+        else:
+            ranges.append((offset, length))
+    return ranges
+
+
+class ChunkStore:
+    """
+    Content-addressed store of upload chunks: a directory holding each
+    distinct chunk once, in a file named after its SHA-256, so a file that
+    shares chunks with one uploaded before only needs its new chunks sent.
+
+    Chunks are written to a temporary name and renamed into place, so
+    server worker processes can share one store and a reader never sees a
+    partial chunk. Blocking; call it from the disk pool.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest: bytes) -> str:
+        name = digest.hex()
+        return os.path.join(self.directory, name[:2], name)
+
+    def has(self, digest: bytes) -> bool:
+        return os.path.exists(self._path(digest))
+
+    def get(self, digest: bytes) -> Optional[bytes]:
+        try:
+            with open(self._path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, digest: bytes, data) -> bool:
+        """Store a chunk unless it is already held; False if data doesn't match digest."""
+        if hashlib.new(CHUNK_HASH, data).digest() != digest:
+            return False
+        path = self._path(digest)
+        if os.path.exists(path):
+            return True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    def split(self, manifest: Iterable[ManifestEntry]) -> Tuple[List[ManifestEntry], List[ManifestEntry]]:
+        """(held, missing): the entries of a manifest the store has, and those it doesn't."""
+        held, missing = [], []
+        for entry in manifest:
+            (held if self.has(entry[2]) else missing).append(entry)
+        return held, missing
+
+    def put_from(self, f: BinaryIO, manifest: Iterable[ManifestEntry]) -> List[ManifestEntry]:
+        """Store the chunks of an assembled file; returns the entries whose bytes don't match."""
+        bad = []
+        for offset, length, digest in manifest:
+            f.seek(offset)
+            if not self.put(digest, f.read(length)):
+                bad.append((offset, length, digest))
+        return bad
+
+
+def save_manifest(path: str, manifest: Iterable[ManifestEntry]) -> None:
+    """Keep the chunk list of an uploaded file next to it, so it can be rebuilt from the store."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'hash': CHUNK_HASH, 'chunks': [[length, digest.hex()] for _, length, digest in manifest]}, f)
+    os.replace(tmp_path, path)
+
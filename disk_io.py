@@ -0,0 +1,147 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import BinaryIO, Callable, Optional
+
+import metrics
+
+FSYNC_NONE = 'none'          # leave it to the OS
+FSYNC_END = 'end'            # once, when the file is closed
+FSYNC_PERIODIC = 'periodic'  # every fsync_interval bytes and at the end
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_END, FSYNC_PERIODIC)
+
+DEFAULT_IO_THREADS = 4
+
+
+class DiskPool:
+    """
+    Bounded thread pool that all file reads and writes go through, so a
+    slow disk stalls only the transfers waiting on it and never the event
+    loop. Tracks how many operations are queued or running.
+    """
+
+    def __init__(self, threads: int = DEFAULT_IO_THREADS) -> None:
+        self.threads = threads
+        self.depth = 0
+        self.max_depth = 0
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='qvtp-io')
+
+    def submit(self, fn: Callable, *args) -> asyncio.Future:
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        future = asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: asyncio.Future) -> None:
+        self.depth -= 1
+
+    def stats(self) -> dict:
+        return {'threads': self.threads, 'depth': self.depth, 'max_depth': self.max_depth}
+
+
+_default_pool: Optional[DiskPool] = None
+
+
+def get_pool() -> DiskPool:
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = DiskPool()
+    return _default_pool
+
+
+def set_pool(pool: DiskPool) -> None:
+    global _default_pool
+    _default_pool = pool
+
+
+metrics.registry.gauge('qvtp_disk_queue_depth', 'Disk pool operations queued or running',
+                       read=lambda: get_pool().depth)
+metrics.registry.gauge('qvtp_disk_queue_max_depth', 'Most disk pool operations queued or running at once',
+                       read=lambda: get_pool().max_depth)
+
+
+class WriteBehind:
+    """
+    Positional writes to one file, done on the disk pool.
+
+    Chunks that continue the previous one are appended to a batch that is
+    written with a single call once it reaches batch_size, so a stream of
+    10 KB chunks becomes a few large writes. At most max_pending batches
+    are in flight; write() waits beyond that, which in turn slows the
+    receive loop and, through flow control, the peer.
+    """
+
+    def __init__(self, f: BinaryIO, pool: Optional[DiskPool] = None, batch_size: int = 1024 * 1024,
+                 max_pending: int = 4, fsync: str = FSYNC_NONE, fsync_interval: int = 64 * 1024 * 1024) -> None:
+        self.f = f
+        self.pool = pool or get_pool()
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._batch = bytearray()
+        self._batch_offset = 0
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._unsynced = 0
+
+    @property
+    def depth(self) -> int:
+        """Batches queued or being written, plus the one being filled."""
+        return len(self._pending) + (1 if self._batch else 0)
+
+    async def write(self, offset: int, data) -> None:
+        if self._batch and offset != self._batch_offset + len(self._batch):
+            await self._submit()
+        if not self._batch:
+            self._batch_offset = offset
+        self._batch += data
+        if len(self._batch) >= self.batch_size:
+            await self._submit()
+
+    async def flush(self) -> None:
+        """Write out everything buffered and wait until it is done."""
+        if self._batch:
+            await self._submit()
+        while self._pending:
+            await self._pending.popleft()
+
+    async def close(self) -> None:
+        await self.flush()
+        if self.fsync != FSYNC_NONE:
+            await self.pool.submit(self._sync)
+
+    async def run(self, fn: Callable, *args):
+        """Run another operation on this file in the pool, serialized with the writes."""
+        def locked():
+            with self._lock:
+                return fn(*args)
+        return await self.pool.submit(locked)
+
+    async def _submit(self) -> None:
+        batch, offset = self._batch, self._batch_offset
+        self._batch = bytearray()
+        self._pending.append(self.pool.submit(self._write_at, offset, batch))
+        while len(self._pending) >= self.max_pending:
+            await self._pending.popleft()
+
+    def _write_at(self, offset: int, data: bytearray) -> None:
+        with self._lock:
+            self.f.seek(offset)
+            self.f.write(data)
+            # Batches are large, so hand each to the OS right away; a flushed
+            # WriteBehind then never has bytes left in a userspace buffer.
+            self.f.flush()
+            self._unsynced += len(data)
+            if self.fsync == FSYNC_PERIODIC and self._unsynced >= self.fsync_interval:
+                os.fsync(self.f.fileno())
+                self._unsynced = 0
+
+    def _sync(self) -> None:
+        with self._lock:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self._unsynced = 0
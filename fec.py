@@ -0,0 +1,123 @@
+import functools
+from typing import Dict, List, Sequence
+
+FEC_SCHEMES = ('none', 'xor', 'rs')
+
+# GF(2^8) arithmetic, with the polynomial x^8 + x^4 + x^3 + x^2 + 1
+_EXP = [0] * 512
+_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    _EXP[_i] = _x
+    _LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    _EXP[_i] = _EXP[_i - 255]
+del _x, _i
+
+
+def _mul(a: int, b: int) -> int:
+    return _EXP[_LOG[a] + _LOG[b]] if a and b else 0
+
+
+def _inv(a: int) -> int:
+    return _EXP[255 - _LOG[a]]
+
+
+@functools.lru_cache(maxsize=None)
+def _mul_table(c: int) -> bytes:
+    # Multiplying a whole block by c is then one bytes.translate()
+    return bytes(_mul(c, v) for v in range(256))
+
+
+def _scale(c: int, block: bytes) -> bytes:
+    return block if c == 1 else block.translate(_mul_table(c))
+
+
+def _xor(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def _invert(matrix: List[List[int]]) -> List[List[int]]:
+    """Inverse of a square matrix over GF(2^8), by Gauss-Jordan elimination."""
+    n = len(matrix)
+    rows = [row[:] + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = _inv(rows[col][col])
+        rows[col] = [_mul(scale, v) for v in rows[col]]
+        for r in range(n):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [v ^ _mul(factor, p) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+class FecCodec:
+    """
+    Systematic erasure code over a group of up to k equal-length blocks,
+    adding m parity blocks from which any m lost blocks can be rebuilt.
+
+    'xor' has a single parity block, the XOR of the group. 'rs' is
+    Reed-Solomon style: parity j is a sum of the blocks weighted by row j
+    of a Cauchy matrix over GF(2^8), every square part of which is
+    invertible, so any k of the k + m blocks recover the group. 'none'
+    adds nothing.
+    """
+
+    def __init__(self, scheme: str = 'xor', k: int = 8, m: int = 1) -> None:
+        if scheme not in FEC_SCHEMES:
+            raise ValueError(f'unknown FEC scheme {scheme!r}')
+        self.scheme = scheme
+        self.k = max(1, k)
+        self.m = {'none': 0, 'xor': 1}.get(scheme, max(0, m))
+        if self.k + self.m > 256:
+            raise ValueError('k + m must be at most 256')
+
+    def coefficient(self, j: int, i: int) -> int:
+        """Weight of data block i in parity block j."""
+        if self.scheme == 'xor':
+            return 1
+        # Cauchy matrix 1 / (x_j - y_i) with y_i = i and x_j = 255 - j, disjoint sets as k + m <= 256
+        return _inv((255 - j) ^ i)
+
+    def encode(self, blocks: Sequence[bytes]) -> List[bytes]:
+        """Parity blocks of a group of data blocks, all of the same length."""
+        parities = []
+        for j in range(self.m):
+            parity = bytes(len(blocks[0]))
+            for i, block in enumerate(blocks):
+                parity = _xor(parity, _scale(self.coefficient(j, i), block))
+            parities.append(parity)
+        return parities
+
+    def recover(self, n: int, blocks: Dict[int, bytes]) -> Dict[int, bytes]:
+        """
+        The missing data blocks of a group of n, given the blocks that
+        arrived by index (data 0..n-1, parity j at n + j), or {} if too few
+        did.
+        """
+        missing = [i for i in range(n) if i not in blocks]
+        parities = [j for j in range(self.m) if n + j in blocks][:len(missing)]
+        if not missing or len(parities) < len(missing):
+            return {}
+        # What is left of each parity once the data we have is taken out of
+        # it is a combination of the missing blocks alone
+        residuals = []
+        for j in parities:
+            residual = blocks[n + j]
+            for i in range(n):
+                if i in blocks:
+                    residual = _xor(residual, _scale(self.coefficient(j, i), blocks[i]))
+            residuals.append(residual)
+        inverse = _invert([[self.coefficient(j, i) for i in missing] for j in parities])
+        recovered = {}
+        for c, i in enumerate(missing):
+            block = bytes(len(residuals[0]))
+            for r, residual in enumerate(residuals):
+                block = _xor(block, _scale(inverse[c][r], residual))
+            recovered[i] = block
+        return recovered
@@ -0,0 +1,77 @@
+from typing import Dict
+
+from quic_compat import QuicInternals
+
+
+class ReceiveCredit:
+    """
+    Grants QUIC receive credit as the application consumes data.
+
+    aioquic raises MAX_DATA and MAX_STREAM_DATA on its own whenever half of
+    the current window has *arrived*, whether or not anyone has read it, so
+    a slow consumer buffers without limit. This replaces its two limit
+    writers on one connection: a stream may have at most stream_budget
+    bytes received but not consumed, and the connection connection_budget
+    bytes, so a peer sending faster than we process is held back by flow
+    control instead of by our memory.
+
+    The writers are private to aioquic, so quic_compat only replaces
+    them if it finds them as expected; if not, active is False and
+    aioquic grants credit its own way.
+    """
+
+    def __init__(self, internals: QuicInternals, stream_budget: int, connection_budget: int) -> None:
+        self.stream_budget = stream_budget
+        self.connection_budget = connection_budget
+        self._internals = internals
+        self._consumed: Dict[int, int] = {}
+        self._connection_consumed = 0
+        self.active = internals.hold_receive_limits()
+
+    def buffered(self, stream_id: int) -> int:
+        """Bytes received on a stream that the application hasn't consumed."""
+        received = self._internals.received_offset(stream_id)
+        if received is None:
+            return 0
+        return received - self._consumed.get(stream_id, 0)
+
+    def consumed(self, stream_id: int, size: int) -> bool:
+        """
+        Record that size bytes of a stream were consumed. Returns True when
+        new credit was granted and a transmit is needed to announce it.
+        """
+        consumed = self._consumed.get(stream_id, 0) + size
+        self._consumed[stream_id] = consumed
+        self._connection_consumed += size
+        if not self.active:
+            return False
+        granted = False
+
+        # Only announce once a good part of the budget has been freed, not
+        # for every chunk.
+        internals = self._internals
+        current = internals.stream_receive_limit(stream_id)
+        limit = consumed + self.stream_budget
+        if current is not None and limit - current >= self.stream_budget // 4:
+            internals.set_stream_receive_limit(stream_id, limit)
+            granted = True
+
+        limit = self._connection_consumed + self.connection_budget
+        if limit - internals.connection_receive_limit() >= self.connection_budget // 4:
+            internals.set_connection_receive_limit(limit)
+            granted = True
+        return granted
+
+    def forget(self, stream_id: int) -> None:
+        self._consumed.pop(stream_id, None)
+
+    def release(self, stream_id: int) -> bool:
+        """
+        Forget a stream that won't be read any more, first counting what it
+        received but was never consumed as consumed, so that doesn't stay
+        charged to the connection budget. Returns True like consumed().
+        """
+        unread = self.buffered(stream_id)
+        granted = self.consumed(stream_id, unread) if unread > 0 else False
+        self.forget(stream_id)
+        return granted
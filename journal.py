@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from reassembly import RangeSet
+
+log = logging.getLogger(__name__)
+
+# Save the journal after this many newly received bytes
+SAVE_INTERVAL = 4 * 1024 * 1024
+
+_open_journals: Dict[str, 'TransferJournal'] = {}
+
+
+class TransferJournal:
+    """
+    On-disk record of which byte ranges of a partial file have arrived, so
+    an interrupted transfer can be resumed instead of restarted.
+
+    A journal is a small JSON file next to the partial file. Its key
+    identifies the transfer (filename, size and a digest or version tag);
+    a journal whose key doesn't match is ignored. It also records the size,
+    inode and mtime the partial file had when it was saved: a journal whose
+    file was since deleted, replaced or resized would claim ranges that
+    aren't there, so it is discarded instead. The mtime may be later, as
+    chunks written after the last save still count as missing. The streams of a
+    multi-stream transfer share one instance through open()/release(),
+    and each attaches its writer so checkpoint() can flush them all before
+    saving: the journal must never claim bytes still waiting to be written.
+    A stream that ends, however it ends, hands its writer back through
+    finish() and then releases the journal.
+    """
+
+    def __init__(self, path: str, key: Dict, received: Optional[RangeSet] = None,
+                 file_path: Optional[str] = None) -> None:
+        self.path = path
+        self.key = key
+        self.file_path = file_path
+        self.received = received if received is not None else RangeSet()
+        # What the journal on disk says has arrived: received counts chunks
+        # as they are queued for writing, so only these are safe to offer
+        # for resuming while the journal is in use
+        self.saved = RangeSet(self.received)
+        self._unsaved = 0
+        self._users = 0
+        self._writers = []
+
+    @staticmethod
+    def peek(path: str, file_path: Optional[str] = None) -> Optional[Dict]:
+        """
+        The saved journal at path as {'key': ..., 'ranges': ...}, if any. With
+        file_path, a journal that doesn't match the partial file as it is now
+        is discarded and None returned.
+        """
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if file_path is not None and not same_file(saved.get('file'), file_state(file_path)):
+            log.warning('Partial file %s changed since its journal was saved, starting over', file_path)
+            discard(path)
+            return None
+        return saved
+
+    @classmethod
+    def open(cls, path: str, key: Dict, file_path: Optional[str] = None) -> 'TransferJournal':
+        # Shared only while another stream of the transfer is still using
+        # it; otherwise what is on disk is what counts
+        journal = _open_journals.get(path)
+        if journal is None or journal.key != key or journal._users <= 0:
+            saved = cls.peek(path, file_path)
+            ranges = saved['ranges'] if saved and saved.get('key') == key else ()
+            journal = _open_journals[path] = cls(path, key, RangeSet(ranges), file_path)
+        journal._users += 1
+        return journal
+
+    def attach(self, writer) -> None:
+        """Register a disk_io.WriteBehind whose chunks are counted in `received`."""
+        self._writers.append(writer)
+
+    def detach(self, writer) -> None:
+        if writer in self._writers:
+            self._writers.remove(writer)
+
+    async def finish(self, writer, size: int) -> None:
+        """
+        Close an attached writer and stop counting on it, then save what
+        has arrived, or discard the journal if that is all size bytes.
+        """
+        try:
+            await writer.close()
+        finally:
+            self.detach(writer)
+        if self.received.covers(0, size):
+            self.discard()
+        else:
+            await self.checkpoint()
+
+    def release(self) -> None:
+        self._users -= 1
+        if self._users <= 0 and _open_journals.get(self.path) is self:
+            del _open_journals[self.path]
+
+    def note(self, size: int) -> bool:
+        """Count newly received bytes; True when a save is due."""
+        self._unsaved += size
+        return self._unsaved >= SAVE_INTERVAL
+
+    def save(self) -> None:
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            saved = {'key': self.key, 'ranges': list(self.received)}
+            if self.file_path is not None:
+                saved['file'] = file_state(self.file_path)
+            json.dump(saved, f)
+        os.replace(tmp_path, self.path)
+        self.saved = RangeSet(self.received)
+        self._unsaved = 0
+
+    async def checkpoint(self) -> None:
+        """Flush every attached writer, then save."""
+        for writer in list(self._writers):
+            await writer.flush()
+        self.save()
+
+    def discard(self) -> None:
+        discard(self.path)
+
+
+def file_state(path: str) -> Optional[List[int]]:
+    """[size, inode, mtime_ns] of a file, or None if it is gone."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_ino, stat.st_mtime_ns]
+
+
+def same_file(saved: Optional[List[int]], now: Optional[List[int]]) -> bool:
+    """Whether a partial file is still the one a journal was saved for."""
+    if not saved or not now or len(saved) != 3:
+        return False
+    return saved[:2] == now[:2] and now[2] >= saved[2]
+
+
+def discard(path: str) -> None:
+    """Remove a journal, e.g. once its file is complete or is being rewritten."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
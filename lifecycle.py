@@ -0,0 +1,104 @@
+import asyncio
+import time
+from typing import Dict, Optional, Set
+
+import metrics
+
+DEFAULT_MAX_CONNECTIONS = 1000
+DEFAULT_MAX_STREAMS = 16  # open request streams per connection
+DEFAULT_IDLE_TIMEOUT = 60.0  # seconds a stream may go without receiving or sending anything
+DEFAULT_SLOW_PEER_TIMEOUT = 30.0  # seconds a sender may wait for its peer to take data
+DEFAULT_MEMORY_BUDGET = 1024 * 1024 * 1024  # bytes buffered in QUIC for all connections
+
+# How often streams are checked for timeouts
+SWEEP_INTERVAL = 1.0
+
+# How long a rejected connection is kept for its ERROR to get through before it is closed
+REJECT_LINGER = 1.0
+
+# Application error code of streams we reset or stop
+STREAM_ABORTED = 0x1
+
+CONNECTIONS_REJECTED = metrics.registry.counter('qvtp_connections_rejected_total', 'Connections turned away at the connection limit')
+STREAMS_REJECTED = metrics.registry.counter('qvtp_streams_rejected_total', 'Request streams turned away by a stream or memory limit')
+STREAMS_TIMED_OUT = metrics.registry.counter('qvtp_streams_timed_out_total', 'Streams closed as idle or for a slow peer')
+
+
+class StreamLifecycle:
+    """
+    Keeps what a server holds for its connections and streams bounded.
+
+    A connection past max_connections, and a request stream past
+    max_streams on its connection or arriving while the connections
+    together have memory_budget bytes buffered in QUIC (sent but not
+    acknowledged, or received but not yet handled), is answered with an
+    ERROR PDU and closed instead of being served. A stream that neither
+    receives nor sends for idle_timeout seconds, or whose handler waits
+    slow_peer_timeout seconds for the peer to take its data, is closed;
+    only that stream, never the whole connection. A stream waiting for its
+    turn in the send scheduler is neither, however long that takes.
+    """
+
+    def __init__(self, max_connections: int = DEFAULT_MAX_CONNECTIONS, max_streams: int = DEFAULT_MAX_STREAMS,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT, slow_peer_timeout: float = DEFAULT_SLOW_PEER_TIMEOUT,
+                 memory_budget: int = DEFAULT_MEMORY_BUDGET) -> None:
+        self.max_connections = max_connections
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self.slow_peer_timeout = slow_peer_timeout
+        self.memory_budget = memory_budget
+        self.connections: Set = set()
+        self._task: Optional[asyncio.Task] = None
+        metrics.registry.gauge('qvtp_connections', 'Connections being served', read=lambda: len(self.connections))
+        metrics.registry.gauge('qvtp_buffered_bytes', 'Bytes buffered in QUIC for all connections', read=self.memory_in_use)
+
+    def stats(self) -> Dict:
+        return {'connections': len(self.connections), 'streams': sum(len(c.handlers()) for c in self.connections),
+                'buffered': self.memory_in_use()}
+
+    def memory_in_use(self) -> int:
+        return sum(connection.buffered_bytes() for connection in self.connections)
+
+    def admit_connection(self, connection) -> Optional[str]:
+        """Start tracking a new connection, or say why it is turned away."""
+        if len(self.connections) >= self.max_connections:
+            CONNECTIONS_REJECTED.inc()
+            return 'Too many connections'
+        self.connections.add(connection)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._sweep())
+        return None
+
+    def connection_closed(self, connection) -> None:
+        self.connections.discard(connection)
+
+    def admit_stream(self, connection) -> Optional[str]:
+        """None if a connection may open another request stream, else why not."""
+        if len(connection.handlers()) >= self.max_streams:
+            reason = 'Too many streams'
+        elif self.memory_in_use() >= self.memory_budget:
+            reason = 'Server busy'
+        else:
+            return None
+        STREAMS_REJECTED.inc()
+        return reason
+
+    async def _sweep(self) -> None:
+        while self.connections:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            now = time.monotonic()
+            for connection in list(self.connections):
+                for handler in connection.handlers():
+                    if handler.blocked_since is not None:
+                        # Waiting for the peer is not idle, only possibly slow
+                        if now - handler.blocked_since <= self.slow_peer_timeout:
+                            continue
+                        reason = 'Slow peer'
+                    elif handler.scheduled:
+                        continue
+                    elif now - handler.last_activity > self.idle_timeout:
+                        reason = 'Idle timeout'
+                    else:
+                        continue
+                    STREAMS_TIMED_OUT.inc()
+                    handler.abort(reason)
@@ -0,0 +1,195 @@
+import asyncio
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pdu
+from chunk_source import ChunkSource
+from fec import FEC_SCHEMES, FecCodec
+
+DEFAULT_FEC = 'xor'
+DEFAULT_GROUP = 8
+DEFAULT_PARITY = 2
+DEFAULT_BITRATE = 4_000_000  # bits per second
+DEFAULT_LATENCY = 0.2  # seconds from a packet's timestamp to its playout
+
+
+def flow_id(stream_id: int) -> int:
+    """Flow of the live stream controlled by a QUIC stream, as carried in its datagrams."""
+    return stream_id & 0xFFFF
+
+
+def negotiate_live(offered: Dict) -> Dict:
+    """Live stream parameters the server accepts for a REQUEST's 'live' option."""
+    fec = offered.get('fec') if offered.get('fec') in FEC_SCHEMES else DEFAULT_FEC
+    k = min(64, max(1, int(offered.get('k', DEFAULT_GROUP))))
+    m = FecCodec(fec, k, min(16, max(0, int(offered.get('m', DEFAULT_PARITY))))).m
+    bitrate = min(1_000_000_000, max(64_000, int(offered.get('bitrate', DEFAULT_BITRATE))))
+    latency = min(5.0, max(0.02, float(offered.get('latency', DEFAULT_LATENCY))))
+    return {'fec': fec, 'k': k, 'm': m, 'bitrate': bitrate, 'latency': latency}
+
+
+class LiveSender:
+    """
+    Sends a file as a live feed: DATA datagrams of up to LIVE_PAYLOAD_SIZE
+    bytes paced out at the bitrate, each group of k followed by the
+    codec's parity datagrams. Nothing is retransmitted; the receiver plays
+    what arrives, or can be rebuilt, in time.
+    """
+
+    def __init__(self, send_datagram: Callable[[bytes], None], flow: int, codec: FecCodec, bitrate: int,
+                 payload_size: int = pdu.LIVE_PAYLOAD_SIZE) -> None:
+        self.send_datagram = send_datagram
+        self.flow = flow
+        self.codec = codec
+        self.bitrate = bitrate
+        self.payload_size = payload_size
+        self.packets = 0
+        self.parity_packets = 0
+        self.bytes = 0
+
+    async def send_file(self, path: str) -> int:
+        """Stream the file in real time at the bitrate; returns the number of DATA packets sent."""
+        started = time.monotonic()
+        group: List[Tuple[int, bytes]] = []
+        async for _, chunk in ChunkSource(path, 64 * self.payload_size):
+            for i in range(0, len(chunk), self.payload_size):
+                payload = bytes(chunk[i:i + self.payload_size])
+                # A packet's timestamp is its position in the feed, in ms
+                position = self.bytes * 8 / self.bitrate
+                delay = started + position - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                timestamp = int(position * 1000)
+                self.send_datagram(pdu.LiveDatagram(pdu.LIVE_DATA, self.codec.k, self.codec.m, len(group), self.flow,
+                                                    self.packets, timestamp, payload).to_bytes())
+                group.append((timestamp, payload))
+                self.packets += 1
+                self.bytes += len(payload)
+                if len(group) == self.codec.k:
+                    self._send_parity(group)
+                    group = []
+        if group:
+            self._send_parity(group)
+        return self.packets
+
+    def _send_parity(self, group: List[Tuple[int, bytes]]) -> None:
+        if not self.codec.m:
+            return
+        blocks = [pdu.LIVE_BLOCK.pack(timestamp, len(payload)) + payload for timestamp, payload in group]
+        size = max(len(block) for block in blocks)
+        first = self.packets - len(group)
+        for j, parity in enumerate(self.codec.encode([block.ljust(size, b'\0') for block in blocks])):
+            self.send_datagram(pdu.LiveDatagram(pdu.LIVE_PARITY, len(group), self.codec.m, len(group) + j, self.flow,
+                                                first, group[0][0], parity).to_bytes())
+            self.parity_packets += 1
+
+
+class JitterBuffer:
+    """
+    Receiver side of a live stream: puts packets back in sequence order and
+    releases each at its timestamp plus latency on the local clock (set
+    by the first packet), so network jitter up to latency is absorbed and
+    end-to-end delay stays fixed. A lost packet is rebuilt from its FEC
+    group if enough of the group arrives before it is due; otherwise it is
+    skipped when the next packet is due. Packets arriving after that are
+    late and dropped.
+    """
+
+    def __init__(self, codec: FecCodec, latency: float) -> None:
+        self.codec = codec
+        self.latency = latency
+        self.next_seq = 0
+        self._offset: Optional[float] = None
+        # sequence -> (timestamp, payload)
+        self._packets: Dict[int, Tuple[int, bytes]] = {}
+        # first sequence of a group -> {index: FEC block}, and its size once a parity packet says
+        self._groups: Dict[int, Dict[int, bytes]] = {}
+        self._group_sizes: Dict[int, int] = {}
+        self.received = 0
+        self.recovered = 0
+        self.lost = 0
+        self.late = 0
+        self.max_jitter = 0.0
+
+    def stats(self) -> Dict:
+        return {'received': self.received, 'recovered': self.recovered, 'lost': self.lost, 'late': self.late,
+                'max_jitter_ms': round(self.max_jitter * 1000, 1)}
+
+    def _due(self, timestamp: int) -> float:
+        return self._offset + timestamp / 1000 + self.latency
+
+    def add(self, packet: pdu.LiveDatagram, now: float) -> None:
+        if self._offset is None:
+            self._offset = now - packet.timestamp / 1000
+        if packet.kind == pdu.LIVE_DATA:
+            if packet.sequence < self.next_seq:
+                self.late += 1
+                return
+            if packet.sequence in self._packets:
+                return
+            payload = bytes(packet.data)
+            self._packets[packet.sequence] = (packet.timestamp, payload)
+            self.received += 1
+            self.max_jitter = max(self.max_jitter, now - self._offset - packet.timestamp / 1000)
+            first = packet.sequence - packet.index
+            if self.codec.m:
+                self._groups.setdefault(first, {})[packet.index] = pdu.LIVE_BLOCK.pack(packet.timestamp, len(payload)) + payload
+        else:
+            first = packet.sequence
+            self._groups.setdefault(first, {})[packet.index] = bytes(packet.data)
+            self._group_sizes[first] = packet.k
+        self._recover(first)
+
+    def _recover(self, first: int) -> None:
+        n = self._group_sizes.get(first)
+        blocks = self._groups.get(first)
+        if n is None or not blocks or first + n <= self.next_seq:
+            return
+        if all(i in blocks for i in range(n)):
+            return
+        size = max(len(block) for block in blocks.values())
+        rebuilt = self.codec.recover(n, {i: block.ljust(size, b'\0') for i, block in blocks.items()})
+        for i, block in rebuilt.items():
+            blocks[i] = block
+            timestamp, length = pdu.LIVE_BLOCK.unpack_from(block)
+            if first + i >= self.next_seq and first + i not in self._packets:
+                self._packets[first + i] = (timestamp, block[pdu.LIVE_BLOCK.size:pdu.LIVE_BLOCK.size + length])
+                self.recovered += 1
+
+    def pop_due(self, now: float) -> List[Tuple[int, Optional[bytes]]]:
+        """(sequence, payload) of the packets due by now, in order; payload is None for a lost one."""
+        released = []
+        while True:
+            entry = self._packets.get(self.next_seq)
+            if entry is not None:
+                if self._due(entry[0]) > now:
+                    break
+                del self._packets[self.next_seq]
+                released.append((self.next_seq, entry[1]))
+            else:
+                # A gap is given up on once a later packet is due
+                later = min((seq for seq in self._packets if seq > self.next_seq), default=None)
+                if later is None or self._due(self._packets[later][0]) > now:
+                    break
+                released.append((self.next_seq, None))
+                self.lost += 1
+            self.next_seq += 1
+        self._forget_groups()
+        return released
+
+    def finish(self, total: int) -> List[Tuple[int, Optional[bytes]]]:
+        """Release everything up to packet total, once the stream has ended."""
+        released = []
+        while self.next_seq < total:
+            entry = self._packets.pop(self.next_seq, None)
+            released.append((self.next_seq, entry[1] if entry else None))
+            if entry is None:
+                self.lost += 1
+            self.next_seq += 1
+        self._forget_groups()
+        return released
+
+    def _forget_groups(self) -> None:
+        for first in [first for first in self._groups if first + self._group_sizes.get(first, 256) <= self.next_seq]:
+            del self._groups[first]
+            self._group_sizes.pop(first, None)
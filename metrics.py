@@ -0,0 +1,156 @@
+import asyncio
+import bisect
+import signal
+import sys
+import threading
+from typing import Callable, Dict, List, Optional, Sequence
+
+# Upper bounds of the default histogram buckets; the last bucket is unbounded
+THROUGHPUT_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)  # MB/s
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class Counter:
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name: str, help: str = '') -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def lines(self) -> List[str]:
+        return [f'{self.name} {self.value}']
+
+
+class Gauge:
+    """A value that goes up and down, or one read from a callback when dumped."""
+
+    __slots__ = ('name', 'help', 'value', 'read')
+
+    def __init__(self, name: str, help: str = '', read: Optional[Callable[[], float]] = None) -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.read = read
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: int = 1) -> None:
+        self.value -= amount
+
+    def lines(self) -> List[str]:
+        return [f'{self.name} {self.read() if self.read else self.value}']
+
+
+class Histogram:
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, name: str, help: str = '', buckets: Sequence[float] = DEPTH_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_sum {round(self.sum, 6)}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+
+class Registry:
+    """
+    In-process metrics, cheap enough to update on every chunk: a counter
+    increment is one attribute add. Nothing is formatted until dump().
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, object] = {}
+
+    def _get(self, cls, name: str, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name: str, help: str = '') -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str = '', read: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._get(Gauge, name, help, read)
+
+    def histogram(self, name: str, help: str = '', buckets: Sequence[float] = DEPTH_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets)
+
+    def dump(self) -> str:
+        """All metrics in the Prometheus text format."""
+        lines = []
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            if metric.help:
+                lines.append(f'# HELP {name} {metric.help}')
+            lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+BYTES_IN = registry.counter('qvtp_bytes_in_total', 'Stream payload bytes received')
+BYTES_OUT = registry.counter('qvtp_bytes_out_total', 'Stream payload bytes sent')
+CHUNKS_IN = registry.counter('qvtp_chunks_in_total', 'DATA chunks received and written')
+CHUNKS_OUT = registry.counter('qvtp_chunks_out_total', 'DATA chunks sent')
+CHECKSUM_FAILURES = registry.counter('qvtp_checksum_failures_total', 'DATA chunks dropped for a bad checksum')
+CHUNKS_DROPPED = registry.counter('qvtp_chunks_dropped_total', 'DATA chunks dropped for falling outside the expected range')
+OUT_OF_ORDER = registry.counter('qvtp_transfers_out_of_order_total', 'Transfers whose chunks did not all arrive in order')
+SEND_BLOCKED = registry.counter('qvtp_send_blocked_total', 'Times a sender waited for its stream buffer to drain')
+ACTIVE_STREAMS = registry.gauge('qvtp_active_streams', 'Transfers in progress, one stream each')
+DEDUP_BYTES = registry.counter('qvtp_dedup_bytes_total', 'Upload bytes not sent because the chunk store held them')
+TRANSFERS = registry.counter('qvtp_transfers_total', 'Finished transfers')
+TRANSFER_THROUGHPUT = registry.histogram('qvtp_transfer_throughput_mbps', 'Per-transfer throughput in MB/s',
+                                         THROUGHPUT_BUCKETS)
+RECEIVE_QUEUE_DEPTH = registry.histogram('qvtp_receive_queue_depth', 'PDUs waiting when a handler takes one')
+
+
+def record_transfer(size: int, seconds: float) -> None:
+    TRANSFERS.inc()
+    if seconds > 0:
+        TRANSFER_THROUGHPUT.observe(size / seconds / 1e6)
+
+
+def dump_on_signal(signum: int = getattr(signal, 'SIGUSR1', 0), stream=None) -> None:
+    """Write the registry to stream (stderr) whenever the process gets signum."""
+    if signum and threading.current_thread() is threading.main_thread():
+        signal.signal(signum, lambda *_: (stream or sys.stderr).write(registry.dump()))
+
+
+async def serve_endpoint(host: str, port: int) -> asyncio.AbstractServer:
+    """
+    Serve the registry as plain text over HTTP on host:port, for scraping or
+    curl. Bind it to a local address; there is no authentication.
+    """
+    async def respond(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await reader.readline()
+            body = registry.dump().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         + f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii') + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(respond, host, port)
@@ -1,14 +1,165 @@
 import struct
 import hashlib
+import json
+import zlib
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+try:
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+try:
+    import xxhash as _xxhash
+except ImportError:
+    _xxhash = None
 
 MSG_TYPE_REQUEST = 1
 MSG_TYPE_RESPONSE = 2
 MSG_TYPE_DATA = 3
 MSG_TYPE_ACK = 4
 MSG_TYPE_ERROR = 5
+MSG_TYPE_END = 6  # last PDU of a transfer, carries the whole-file digest
+MSG_TYPE_MANIFEST = 7  # content-defined chunk list of a dedup upload, and the server's reply to it
+MSG_TYPE_LIST = 8  # page of the server's catalog, asked for from a cursor and sent back
+
+# Per-chunk checksum algorithms; the value travels as a 64-bit field.
+CHECKSUM_NONE = 0
+CHECKSUM_CRC32 = 1
+CHECKSUM_CRC32C = 2
+CHECKSUM_XXH64 = 3
+
+CHECKSUM_NAMES = {
+    'none': CHECKSUM_NONE,
+    'crc32': CHECKSUM_CRC32,
+    'crc32c': CHECKSUM_CRC32C,
+    'xxh64': CHECKSUM_XXH64,
+}
+
+_CHECKSUM_FUNCS = {
+    CHECKSUM_NONE: lambda data: 0,
+    CHECKSUM_CRC32: zlib.crc32,
+}
+if _crc32c is not None:
+    _CHECKSUM_FUNCS[CHECKSUM_CRC32C] = _crc32c.crc32c
+if _xxhash is not None:
+    _CHECKSUM_FUNCS[CHECKSUM_XXH64] = _xxhash.xxh64_intdigest
+
+# Client preference order; entries this build can't compute are skipped.
+DEFAULT_CHECKSUMS = ['xxh64', 'crc32c', 'crc32']
+
+# Whole-file digests that may be negotiated for end-of-stream verification.
+DIGEST_ALGORITHMS = ('sha256', 'blake2b', 'md5')
+
+# DATA chunk sizes that may be negotiated. A peer that doesn't negotiate
+# one sends LEGACY_CHUNK_SIZE chunks.
+MIN_CHUNK_SIZE = 4 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+LEGACY_CHUNK_SIZE = 10 * 1024
+
+# Every PDU on a QUIC stream is preceded by its length so the receiver can
+# find message boundaries again; QUIC does not preserve write boundaries.
+FRAME_PREFIX = struct.Struct('!I')
+
+# Longest PDU a peer may frame: a DATA chunk of MAX_CHUNK_SIZE or a full
+# LIST page, with room to spare. A longer length means a broken stream.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Fixed part of every PDU: mtype, msg_len, filename_len, filesize,
+# transaction_id, sequence_num, offset, data_len, options_len,
+# range_count, checksum_alg, checksum. The msg, filename, options (JSON),
+# ranges and data bytes follow in that order.
+HEADER = struct.Struct('!IIIQIIQIIIBQ')
+
+# Just the mtype at the start of HEADER, to tell a PDU's type without decoding it
+MTYPE = struct.Struct('!I')
+
+# One requested byte range: offset, length
+RANGE = struct.Struct('!QQ')
+
+# Header of a live stream datagram (see LiveDatagram): kind, k, m, index,
+# flow, sequence, timestamp
+LIVE_HEADER = struct.Struct('!BBBBHII')
+LIVE_DATA = 0
+LIVE_PARITY = 1
+
+# What FEC protects of a live DATA packet besides its payload: timestamp,
+# payload length, so a rebuilt packet gets both back
+LIVE_BLOCK = struct.Struct('!IH')
+
+# Payload bytes per live datagram, so that with the header and the FEC
+# block prefix it fits a QUIC packet of the default 1200 bytes
+LIVE_PAYLOAD_SIZE = 1024
+
+# One chunk of a dedup upload manifest: length, SHA-256 of the chunk
+MANIFEST_ENTRY = struct.Struct('!I32s')
+
+
+def supported_checksums() -> List[str]:
+    return [name for name, alg in CHECKSUM_NAMES.items() if alg in _CHECKSUM_FUNCS]
+
+
+def negotiate_checksum(offered) -> str:
+    """Pick the first offered checksum this side supports, else crc32."""
+    for name in offered or []:
+        if CHECKSUM_NAMES.get(name) in _CHECKSUM_FUNCS:
+            return name
+    return 'crc32'
+
+
+def compute_checksum(checksum_alg: int, data) -> int:
+    return _CHECKSUM_FUNCS[checksum_alg](data)
+
+
+def negotiate_digest(offered: Optional[str]) -> Optional[str]:
+    return offered if offered in DIGEST_ALGORITHMS else None
+
+
+def chunk_size_limit(window: Optional[int]) -> int:
+    """
+    Largest chunk for a receive window of window bytes (unknown if None):
+    a PDU is only consumed, freeing credit, once all of it has arrived, so
+    several must fit in the window for the sender to keep going.
+    """
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, window // 8)) if window else MAX_CHUNK_SIZE
+
+
+def choose_chunk_size(filesize: int, window: Optional[int], preferred: Optional[int] = None) -> int:
+    """
+    Chunk size for a transfer of filesize bytes into a receive window of
+    window bytes. Every chunk costs a header, a checksum, a send and a
+    stream write however small it is, so without a preference it is about
+    1/256 of the file, as a power of two, up to chunk_size_limit(window).
+    """
+    limit = chunk_size_limit(window)
+    if preferred:
+        return max(MIN_CHUNK_SIZE, min(limit, preferred))
+    size = MIN_CHUNK_SIZE
+    while size * 2 <= min(limit, filesize // 256):
+        size *= 2
+    return size
+
+
+def negotiate_chunk_size(preferred: Optional[int], filesize: int, window: Optional[int]) -> Tuple[int, int]:
+    """
+    (chunk_size, limit) for a transfer into a receive window of window
+    bytes: the sender starts at chunk_size and, if it adapts, stays
+    within limit.
+    """
+    return choose_chunk_size(filesize, window, preferred), chunk_size_limit(window)
+
+
+def new_digest(name: str):
+    """Incremental whole-file digest object (hashlib interface)."""
+    return hashlib.new(name)
+
 
 class Datagram:
-    def __init__(self, mtype, msg, filename="", filesize=0, transaction_id=0, sequence_num=0, data=b'', checksum=''):
+    __slots__ = ('mtype', 'msg', 'filename', 'filesize', 'transaction_id',
+                 'sequence_num', 'data', 'options', 'checksum_alg', 'checksum', 'offset', 'ranges')
+
+    def __init__(self, mtype, msg, filename="", filesize=0, transaction_id=0, sequence_num=0, data=b'',
+                 options=None, checksum_alg=CHECKSUM_NONE, checksum=0, offset=0, ranges=None):
         self.mtype = mtype
         self.msg = msg
         self.filename = filename
@@ -16,50 +167,207 @@ class Datagram:
         self.transaction_id = transaction_id
         self.sequence_num = sequence_num
         self.data = data
+        # Negotiated parameters for REQUEST/RESPONSE, empty otherwise
+        self.options = options if options is not None else {}
+        self.checksum_alg = checksum_alg
         self.checksum = checksum
+        # Byte position of a DATA payload in the file
+        self.offset = offset
+        # (offset, length) byte ranges a download REQUEST asks for, in the
+        # order wanted, and that its RESPONSE will serve, or that the reply
+        # to a MANIFEST still needs; empty for the whole file
+        self.ranges = [tuple(r) for r in ranges] if ranges else []
+
+    def _encoded_options(self) -> bytes:
+        return json.dumps(self.options).encode('utf-8') if self.options else b''
+
+    def encoded_size(self) -> int:
+        return (HEADER.size + len(self.msg.encode('utf-8')) + len(self.filename.encode('utf-8'))
+                + len(self._encoded_options()) + RANGE.size * len(self.ranges) + len(self.data))
 
-    def to_bytes(self):
-        header = struct.pack('!I', self.mtype) + struct.pack('!I', len(self.msg)) + self.msg.encode('utf-8')
-        if self.mtype in [MSG_TYPE_REQUEST, MSG_TYPE_RESPONSE, MSG_TYPE_DATA]:
-            header += struct.pack('!I', len(self.filename)) + self.filename.encode('utf-8')
-            header += struct.pack('!Q', self.filesize)
-            header += struct.pack('!I', self.transaction_id)
-            header += struct.pack('!I', self.sequence_num)
-            header += struct.pack('!I', len(self.data)) + self.data
-            header += self.checksum.encode('utf-8')
-        return header
+    def pack_into(self, buffer, offset=0) -> int:
+        """Encode into a writable buffer at offset and return the end offset."""
+        msg = self.msg.encode('utf-8')
+        filename = self.filename.encode('utf-8')
+        options = self._encoded_options()
+        data_len = len(self.data)
+        HEADER.pack_into(buffer, offset, self.mtype, len(msg), len(filename), self.filesize,
+                         self.transaction_id, self.sequence_num, self.offset, data_len, len(options),
+                         len(self.ranges), self.checksum_alg, self.checksum)
+        index = offset + HEADER.size
+        for part in (msg, filename, options):
+            buffer[index:index + len(part)] = part
+            index += len(part)
+        for range_offset, range_length in self.ranges:
+            RANGE.pack_into(buffer, index, range_offset, range_length)
+            index += RANGE.size
+        buffer[index:index + data_len] = self.data
+        return index + data_len
+
+    def to_bytes(self, buffer=None):
+        """
+        Encode the PDU. When a bytearray large enough is supplied it is
+        reused and a memoryview of the encoded bytes is returned.
+        """
+        size = self.encoded_size()
+        if buffer is None or len(buffer) < size:
+            buffer = bytearray(size)
+            self.pack_into(buffer)
+            return buffer
+        self.pack_into(buffer)
+        return memoryview(buffer)[:size]
 
     @classmethod
     def from_bytes(cls, data):
-        mtype = struct.unpack('!I', data[:4])[0]
-        msg_len = struct.unpack('!I', data[4:8])[0]
-        msg = data[8:8+msg_len].decode('utf-8')
-        index = 8 + msg_len
-        filename_len = struct.unpack('!I', data[index:index+4])[0]
-        index += 4
-        filename = data[index:index+filename_len].decode('utf-8')
+        """Decode a PDU; the payload is a memoryview into data, not a copy."""
+        view = memoryview(data)
+        (mtype, msg_len, filename_len, filesize, transaction_id, sequence_num, offset,
+         data_len, options_len, range_count, checksum_alg, checksum) = HEADER.unpack_from(view)
+        index = HEADER.size
+        msg = str(view[index:index + msg_len], 'utf-8')
+        index += msg_len
+        filename = str(view[index:index + filename_len], 'utf-8')
         index += filename_len
-        filesize = struct.unpack('!Q', data[index:index+8])[0]
-        index += 8
-        transaction_id = struct.unpack('!I', data[index:index+4])[0]
-        index += 4
-        sequence_num = struct.unpack('!I', data[index:index+4])[0]
-        index += 4
-        data_len = struct.unpack('!I', data[index:index+4])[0]
-        index += 4
-        payload = data[index:index+data_len]
-        index += data_len
-        checksum = data[index:].decode('utf-8')
-        return cls(mtype, msg, filename, filesize, transaction_id, sequence_num, payload, checksum)
-
-    def calculate_checksum(self):
-        hash_md5 = hashlib.md5()
-        hash_md5.update(self.data)
-        self.checksum = hash_md5.hexdigest()
-
-    def is_checksum_valid(self):
-        if not self.checksum:
+        options = json.loads(str(view[index:index + options_len], 'utf-8')) if options_len else {}
+        index += options_len
+        ranges = [RANGE.unpack_from(view, index + i * RANGE.size) for i in range(range_count)]
+        index += range_count * RANGE.size
+        payload = view[index:index + data_len]
+        return cls(mtype, msg, filename, filesize, transaction_id, sequence_num, payload,
+                   options, checksum_alg, checksum, offset, ranges)
+
+    def calculate_checksum(self, checksum_alg=None):
+        if checksum_alg is not None:
+            self.checksum_alg = checksum_alg
+        self.checksum = compute_checksum(self.checksum_alg, self.data)
+
+    def is_checksum_valid(self, expected_alg: int):
+        """
+        True if the checksum is right and of the algorithm the transfer
+        negotiated; a PDU of any other algorithm, weaker or none, fails.
+        """
+        if self.checksum_alg != expected_alg:
+            return False
+        func = _CHECKSUM_FUNCS.get(self.checksum_alg)
+        if func is None:
             return False
-        hash_md5 = hashlib.md5()
-        hash_md5.update(self.data)
-        return self.checksum == hash_md5.hexdigest()
+        return self.checksum == func(self.data)
+
+
+def encode_batch(datagrams, buffer=None) -> memoryview:
+    """
+    Encode and frame several PDUs back to back into one send buffer.
+
+    The result can be sent as a single already-framed stream write. A
+    bytearray passed as buffer is reused when it is large enough.
+    """
+    size = sum(FRAME_PREFIX.size + d.encoded_size() for d in datagrams)
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+    offset = 0
+    for datagram in datagrams:
+        end = datagram.pack_into(buffer, offset + FRAME_PREFIX.size)
+        FRAME_PREFIX.pack_into(buffer, offset, end - offset - FRAME_PREFIX.size)
+        offset = end
+    return memoryview(buffer)[:size]
+
+
+class LiveDatagram:
+    """
+    One packet of a live stream, sent as a QUIC DATAGRAM frame. Datagrams
+    must fit in a single QUIC packet, so these have a compact header of
+    their own: kind (DATA or PARITY), FEC group size and parity count,
+    index in the group, flow (which live stream), sequence number and
+    timestamp in ms. A PARITY packet's sequence number is that of the first
+    packet of its group, and its k is the group's actual size.
+    """
+
+    __slots__ = ('kind', 'k', 'm', 'index', 'flow', 'sequence', 'timestamp', 'data')
+
+    def __init__(self, kind, k, m, index, flow, sequence, timestamp, data=b''):
+        self.kind = kind
+        self.k = k
+        self.m = m
+        self.index = index
+        self.flow = flow
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.data = data
+
+    def to_bytes(self) -> bytes:
+        return LIVE_HEADER.pack(self.kind, self.k, self.m, self.index, self.flow, self.sequence,
+                                self.timestamp) + self.data
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(*LIVE_HEADER.unpack_from(data), memoryview(data)[LIVE_HEADER.size:])
+
+    @staticmethod
+    def flow_of(data) -> int:
+        return LIVE_HEADER.unpack_from(data)[4]
+
+
+def encode_manifest(entries) -> bytes:
+    """Pack (length, digest) manifest entries as the payload of a MANIFEST PDU."""
+    return b''.join(MANIFEST_ENTRY.pack(length, digest) for length, digest in entries)
+
+
+def decode_manifest(data) -> List[Tuple[int, bytes]]:
+    return [(length, bytes(digest)) for length, digest in MANIFEST_ENTRY.iter_unpack(data)]
+
+
+class FrameDecoder:
+    """
+    Reassembles length-prefixed PDUs from arbitrary stream fragments.
+
+    Fragments are kept as received; a frame that lies inside a single
+    fragment is returned as a memoryview into it, and only frames that
+    straddle fragment boundaries are joined into a new buffer. A length
+    over MAX_FRAME_SIZE raises ValueError rather than being waited for.
+    """
+
+    def __init__(self) -> None:
+        self._fragments: Deque[memoryview] = deque()
+        self._buffered = 0
+        self._frame_len = -1
+
+    def __len__(self) -> int:
+        return self._buffered
+
+    def feed(self, data) -> List[memoryview]:
+        if data:
+            self._fragments.append(memoryview(data))
+            self._buffered += len(data)
+        frames = []
+        while True:
+            if self._frame_len < 0:
+                if self._buffered < FRAME_PREFIX.size:
+                    break
+                self._frame_len = FRAME_PREFIX.unpack(self._take(FRAME_PREFIX.size))[0]
+                if self._frame_len > MAX_FRAME_SIZE:
+                    raise ValueError(f'Frame of {self._frame_len} bytes is over {MAX_FRAME_SIZE}')
+            if self._buffered < self._frame_len:
+                break
+            frames.append(self._take(self._frame_len))
+            self._frame_len = -1
+        return frames
+
+    def _take(self, size: int) -> memoryview:
+        first = self._fragments[0]
+        self._buffered -= size
+        if len(first) >= size:
+            if len(first) == size:
+                self._fragments.popleft()
+            else:
+                self._fragments[0] = first[size:]
+            return first[:size]
+        out = bytearray(size)
+        filled = 0
+        while filled < size:
+            fragment = self._fragments.popleft()
+            n = min(len(fragment), size - filled)
+            out[filled:filled + n] = fragment[:n]
+            filled += n
+            if n < len(fragment):
+                self._fragments.appendleft(fragment[n:])
+        return memoryview(out)
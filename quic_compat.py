@@ -0,0 +1,223 @@
+import functools
+import inspect
+import logging
+from typing import Optional
+
+import aioquic
+from aioquic.quic import connection as _connection
+from aioquic.quic.connection import QuicConnection
+from aioquic.quic.packet import QuicFrameType
+from aioquic.quic.stream import QuicStream
+
+log = logging.getLogger(__name__)
+
+# The aioquic release whose private internals the code below was written
+# against; requirements.txt pins it
+AIOQUIC_VERSION = '1.6.1'
+
+# aioquic's writers of MAX_DATA and MAX_STREAM_DATA frames that
+# QuicInternals.hold_receive_limits() replaces, with their parameters after self
+LIMIT_WRITERS = {
+    '_write_connection_limits': ('builder', 'space'),
+    '_write_stream_limits': ('builder', 'space', 'stream'),
+}
+
+# What else of QuicConnection the replacements use
+LIMIT_ATTRIBUTES = ('_streams', '_local_max_data', '_local_max_streams_bidi', '_local_max_streams_uni',
+                    '_on_connection_limit_delivery', '_on_max_stream_data_delivery', '_quic_logger')
+LIMIT_CONSTANTS = ('CONNECTION_LIMIT_FRAME_CAPACITY', 'MAX_STREAM_DATA_FRAME_CAPACITY')
+
+# What QuicInternals reads of a connection, of its loss recovery, and of
+# its streams, their senders and their receivers
+CONNECTION_ATTRIBUTES = ('_streams', '_loss', '_remote_max_data', '_remote_max_data_used',
+                         '_original_destination_connection_id')
+RECOVERY_ATTRIBUTES = ('_rtt_initialized', '_rtt_smoothed')
+STREAM_ATTRIBUTES = ('max_stream_data_remote', 'max_stream_data_local', 'max_stream_data_local_sent')
+SENDER_ATTRIBUTES = ('_buffer_start', '_buffer_stop', 'next_offset')
+RECEIVER_ATTRIBUTES = ('highest_offset', 'is_finished')
+
+
+def version_supported() -> bool:
+    return aioquic.__version__ == AIOQUIC_VERSION
+
+
+@functools.lru_cache(maxsize=None)
+def _limit_writers_match(cls: type) -> bool:
+    for name, parameters in LIMIT_WRITERS.items():
+        method = getattr(cls, name, None)
+        if method is None or tuple(inspect.signature(method).parameters)[1:] != parameters:
+            return False
+    return all(hasattr(_connection, name) for name in LIMIT_CONSTANTS)
+
+
+def can_replace_limit_writers(quic: QuicConnection) -> bool:
+    """
+    True if this connection's aioquic has the limit writers, and what they
+    use, that QuicInternals replaces. Otherwise aioquic's own credit has to
+    do, and it is said so once.
+    """
+    supported = _limit_writers_match(type(quic)) and all(hasattr(quic, name) for name in LIMIT_ATTRIBUTES)
+    if not supported:
+        _warn(f'aioquic {aioquic.__version__} lacks the flow-control internals of {AIOQUIC_VERSION}; '
+              'receive credit is granted as data arrives, not as it is consumed')
+    elif not version_supported():
+        _warn(f'aioquic {aioquic.__version__} is untested (requirements.txt pins {AIOQUIC_VERSION}); '
+              'its flow-control internals look the same, so they are used')
+    return supported
+
+
+@functools.lru_cache(maxsize=None)
+def _streams_match() -> bool:
+    # A stream's attributes only exist once it does, so look at a new one
+    stream = QuicStream()
+    return (all(hasattr(stream, name) for name in STREAM_ATTRIBUTES)
+            and all(hasattr(stream.sender, name) for name in SENDER_ATTRIBUTES)
+            and all(hasattr(stream.receiver, name) for name in RECEIVER_ATTRIBUTES))
+
+
+class QuicInternals:
+    """
+    Everything of one connection that aioquic has no public API for, as
+    used by flow_control.ReceiveCredit, transport.AutoTuner and the
+    stream handlers. Without it, on an aioquic other than the pinned one,
+    each read gives a neutral answer instead, said so once: no RTT, so
+    the connection isn't auto-tuned; nothing buffered, so senders aren't
+    held back; every stall is put down to congestion; and receive limits
+    are left to aioquic.
+    """
+
+    def __init__(self, quic: QuicConnection) -> None:
+        self.quic = quic
+        self.supported = (_streams_match() and all(hasattr(quic, name) for name in CONNECTION_ATTRIBUTES)
+                          and all(hasattr(quic._loss, name) for name in RECOVERY_ATTRIBUTES))
+        if not self.supported:
+            _warn(f'aioquic {aioquic.__version__} lacks the connection internals of {AIOQUIC_VERSION}; '
+                  'send buffers are unbounded, receive credit is granted as data arrives, '
+                  'and the transport is not auto-tuned')
+        elif not version_supported():
+            _warn(f'aioquic {aioquic.__version__} is untested (requirements.txt pins {AIOQUIC_VERSION}); '
+                  'its connection internals look the same, so they are used')
+
+    def smoothed_rtt(self) -> Optional[float]:
+        """The connection's smoothed RTT in seconds, None until there is one."""
+        if not self.supported or not self.quic._loss._rtt_initialized:
+            return None
+        return self.quic._loss._rtt_smoothed
+
+    def send_buffered(self, stream_id: int) -> int:
+        """Bytes written to the stream that the peer has not acknowledged yet."""
+        stream = self.quic._streams.get(stream_id) if self.supported else None
+        if stream is None:
+            return 0
+        return stream.sender._buffer_stop - stream.sender._buffer_start
+
+    def send_blocked_on(self, stream_id: int) -> str:
+        """
+        What data written to the stream waits for: the peer's credit for the
+        stream or the connection, or else congestion control.
+        """
+        if not self.supported:
+            return 'congestion'
+        stream = self.quic._streams.get(stream_id)
+        if stream is not None and stream.sender.next_offset >= stream.max_stream_data_remote:
+            return 'stream_window'
+        if self.quic._remote_max_data_used >= self.quic._remote_max_data:
+            return 'connection_window'
+        return 'congestion'
+
+    def has_stream(self, stream_id: int) -> bool:
+        """Whether aioquic still keeps the stream; one it forgot is done both ways."""
+        return stream_id in self.quic._streams if self.supported else True
+
+    def receiving(self, stream_id: int) -> bool:
+        """Whether the peer may still send on the stream."""
+        if not self.supported:
+            return True
+        stream = self.quic._streams.get(stream_id)
+        return stream is not None and not stream.receiver.is_finished
+
+    def received_offset(self, stream_id: int) -> Optional[int]:
+        """How far into the stream data has arrived, None if aioquic has no such stream."""
+        stream = self.quic._streams.get(stream_id) if self.supported else None
+        return stream.receiver.highest_offset if stream is not None else None
+
+    def hold_receive_limits(self) -> bool:
+        """
+        Stop aioquic raising the connection's MAX_DATA and MAX_STREAM_DATA on
+        its own, leaving that to set_*_receive_limit(). False, with aioquic
+        left as it is, if its limit writers can't be replaced.
+        """
+        if not self.supported or not can_replace_limit_writers(self.quic):
+            return False
+        self.quic._write_connection_limits = self._write_connection_limits
+        self.quic._write_stream_limits = self._write_stream_limits
+        return True
+
+    # Only for connections whose receive limits are held
+
+    def stream_receive_limit(self, stream_id: int) -> Optional[int]:
+        stream = self.quic._streams.get(stream_id)
+        return stream.max_stream_data_local if stream is not None else None
+
+    def set_stream_receive_limit(self, stream_id: int, limit: int) -> None:
+        self.quic._streams[stream_id].max_stream_data_local = limit
+
+    def connection_receive_limit(self) -> int:
+        return self.quic._local_max_data.value
+
+    def set_connection_receive_limit(self, limit: int) -> None:
+        self.quic._local_max_data.value = limit
+
+    def connection_id(self) -> str:
+        """The original destination connection ID, which qlog names the connection by."""
+        if not self.supported:
+            return f'{id(self.quic):x}'
+        return self.quic._original_destination_connection_id.hex()
+
+    def _write_connection_limits(self, builder, space) -> None:
+        # Same as aioquic's, except MAX_DATA is never raised automatically.
+        quic = self.quic
+        for limit in (quic._local_max_data, quic._local_max_streams_bidi, quic._local_max_streams_uni):
+            if limit is not quic._local_max_data and limit.used * 2 > limit.value:
+                limit.value *= 2
+            if limit.value != limit.sent:
+                buf = builder.start_frame(
+                    limit.frame_type,
+                    capacity=_connection.CONNECTION_LIMIT_FRAME_CAPACITY,
+                    handler=quic._on_connection_limit_delivery,
+                    handler_args=(limit,),
+                )
+                buf.push_uint_var(limit.value)
+                limit.sent = limit.value
+                if quic._quic_logger is not None:
+                    builder.quic_logger_frames.append(
+                        quic._quic_logger.encode_connection_limit_frame(
+                            frame_type=limit.frame_type, maximum=limit.value
+                        )
+                    )
+
+    def _write_stream_limits(self, builder, space, stream) -> None:
+        # Same as aioquic's, except MAX_STREAM_DATA is never raised automatically.
+        if stream.max_stream_data_local_sent != stream.max_stream_data_local:
+            quic = self.quic
+            buf = builder.start_frame(
+                QuicFrameType.MAX_STREAM_DATA,
+                capacity=_connection.MAX_STREAM_DATA_FRAME_CAPACITY,
+                handler=quic._on_max_stream_data_delivery,
+                handler_args=(stream,),
+            )
+            buf.push_uint_var(stream.stream_id)
+            buf.push_uint_var(stream.max_stream_data_local)
+            stream.max_stream_data_local_sent = stream.max_stream_data_local
+            if quic._quic_logger is not None:
+                builder.quic_logger_frames.append(
+                    quic._quic_logger.encode_max_stream_data_frame(
+                        maximum=stream.max_stream_data_local, stream_id=stream.stream_id
+                    )
+                )
+
+
+@functools.lru_cache(maxsize=None)
+def _warn(message: str) -> None:
+    # Once per message, not once per connection
+    log.warning(message)
@@ -1,34 +1,65 @@
 import asyncio
-from aioquic.asyncio import connect, serve
+import functools
+from aioquic.asyncio import connect
+from aioquic.asyncio.server import QuicServer
 from aioquic.asyncio.protocol import QuicConnectionProtocol
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import StreamDataReceived
-from typing import Optional, Dict, Callable, Coroutine, Deque, List
-from aioquic.tls import SessionTicket
+from aioquic.quic.events import ConnectionTerminated, DatagramFrameReceived, HandshakeCompleted, StreamDataReceived
+from typing import Optional, Dict, Callable, Coroutine, Deque, List, Set
 import logging
+import time
 from collections import deque
 
 import json
 
 from common import EchoQuicConnection, QuicStreamEvent
+from flow_control import ReceiveCredit
+from lifecycle import REJECT_LINGER, STREAM_ABORTED
+from transport import AutoTuner, TransportProfile
+from tracing import Tracer, TransferTrace
+import metrics
+from scheduler import DEFAULT_PRIORITY
+from tickets import ClientTicketCache, SessionTicketStore
+import pdu
+import quic_compat
 import video_server, video_client
 
 ALPN_PROTOCOL = "echo-protocol"
 
-def build_server_quic_config(cert_file, key_file) -> QuicConfiguration:
+# Unacknowledged bytes a stream may buffer before send() waits, and the
+# level it must drain back to before sending resumes.
+SEND_HIGH_WATERMARK = 2 * 1024 * 1024
+SEND_LOW_WATERMARK = 512 * 1024
+
+# Bytes a peer may have in flight to us beyond what the handlers have
+# consumed, per stream and per connection (see flow_control.ReceiveCredit).
+RECV_STREAM_BUDGET = 4 * 1024 * 1024
+RECV_CONNECTION_BUDGET = 16 * 1024 * 1024
+
+# Largest DATAGRAM frame we accept; advertising one enables them (live streams)
+MAX_DATAGRAM_FRAME_SIZE = 65536
+
+def build_server_quic_config(cert_file, key_file, profile: Optional[TransportProfile] = None) -> QuicConfiguration:
     configuration = QuicConfiguration(
         alpn_protocols=[ALPN_PROTOCOL], 
-        is_client=False
+        is_client=False,
+        max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE
     )
     configuration.load_cert_chain(cert_file, key_file)
+    # Windows, congestion control, packet size and timeouts for the kind of path
+    if profile is not None:
+        profile.configure(configuration)
   
     return configuration
 
-def build_client_quic_config(cert_file = None):
+def build_client_quic_config(cert_file = None, profile: Optional[TransportProfile] = None):
     configuration = QuicConfiguration(alpn_protocols=[ALPN_PROTOCOL], 
-                                      is_client=True)
+                                      is_client=True,
+                                      max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE)
     if cert_file:
         configuration.load_verify_locations(cert_file)
+    if profile is not None:
+        profile.configure(configuration)
   
     return configuration
 
@@ -38,15 +69,70 @@ def create_msg_payload(msg):
 SERVER_MODE = 0
 CLIENT_MODE = 1
 
+class HandshakeStats:
+    """Handshake latency of this process's connections, full and resumed."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.resumed = 0
+        self.early_data = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float, resumed: bool, early_data: bool) -> None:
+        self.count += 1
+        self.resumed += resumed
+        self.early_data += early_data
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self) -> Dict:
+        return {'handshakes': self.count, 'resumed': self.resumed, 'early_data': self.early_data,
+                'avg_ms': round(self.total / self.count * 1000, 2) if self.count else 0.0,
+                'max_ms': round(self.max * 1000, 2)}
+
+handshake_stats = HandshakeStats()
+
 class AsyncQuicServer(QuicConnectionProtocol):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, scope: Optional[Dict] = None, **kwargs):
         super().__init__(*args, **kwargs)
+        # Settings handed to every request handler (see run_server)
+        self.scope: Dict = scope or {}
         self._handlers: Dict[int, EchoServerRequestHandler] = {}
         self._client_handler: Optional[EchoClientRequestHandler] = None
+        # Handlers waiting in send() for their stream buffer to drain
+        self._blocked_senders = set()
+        # Windows of the transport profile if one is set (scope['transport']),
+        # grown to the measured bandwidth-delay product if it is an auto one
+        profile: Optional[TransportProfile] = self.scope.get('transport')
+        # What flow control, the tuner and handlers use of aioquic's own state
+        self.internals = quic_compat.QuicInternals(self._quic)
+        if profile is not None:
+            self.receive_credit = ReceiveCredit(self.internals, profile.stream_window, profile.connection_window)
+            self.send_buffer = profile.send_buffer
+        else:
+            self.receive_credit = ReceiveCredit(self.internals, RECV_STREAM_BUDGET, RECV_CONNECTION_BUDGET)
+            self.send_buffer = SEND_HIGH_WATERMARK
+        self._tuner = AutoTuner(self, profile) if profile is not None and profile.auto else None
+        # Stream bytes handed to the application and written, for the tuner
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Live stream flow -> queue of its datagrams; others are dropped
+        self._datagram_queues: Dict[int, asyncio.Queue] = {}
+        # Streams whose handler is gone; anything more the peer sends on them is ignored
+        self._closed_streams: Set[int] = set()
         self._is_client: bool = self._quic.configuration.is_client
+        self._handshake_started = time.monotonic()
+        self.handshake_done: Optional[float] = None
+        # Timing of every transfer if tracing is on (see tracing.Tracer)
+        self.tracer: Optional[Tracer] = self.scope.get('tracer')
         self._mode: int = SERVER_MODE if not self._is_client else CLIENT_MODE
+        # Why this connection is turned away, if it is (see lifecycle.StreamLifecycle)
+        self._rejection: Optional[str] = None
         if self._mode == CLIENT_MODE:
             self._attach_client_handler()
+        elif self.scope.get('lifecycle') is not None:
+            self._rejection = self.scope['lifecycle'].admit_connection(self)
         
     def _attach_client_handler(self): 
         if self._mode == CLIENT_MODE:
@@ -54,15 +140,72 @@ class AsyncQuicServer(QuicConnectionProtocol):
                        authority=self._quic.configuration.server_name,
                         connection=self._quic,
                         protocol=self,
-                        scope={},
+                        scope={'window': self.receive_credit.stream_budget},
                         stream_ended=False,
                         stream_id=None,
-                        transmit=self.transmit
+                        transmit=self._transmit_soon,
+                        high_watermark=self.send_buffer,
+                        low_watermark=self.send_buffer // 4,
                  )
         
     def remove_handler(self, stream_id):
-        self._handlers.pop(stream_id)
+        self._handlers.pop(stream_id, None)
+        self.receive_credit.release(stream_id)
+        self.stop_receiving(stream_id)
+
+    def handlers(self) -> List['EchoServerRequestHandler']:
+        return list(self._handlers.values())
+
+    def set_send_buffer(self, size: int) -> None:
+        """Let every stream of this connection have size bytes unacknowledged, e.g. to cover a larger BDP."""
+        self.send_buffer = size
+        for handler in self.handlers() + ([self._client_handler] if self._client_handler else []):
+            handler.high_watermark = size
+            handler.low_watermark = size // 4
+        scheduler = self.scope.get('scheduler')
+        if scheduler is not None:
+            scheduler.set_connection_budget(self, 2 * size)
+
+    def buffered_bytes(self) -> int:
+        """Bytes this connection's streams hold in QUIC: sent and unacknowledged, or received and unhandled."""
+        return sum(handler.buffered(stream_id) + self.receive_credit.buffered(stream_id)
+                   for stream_id, handler in self._handlers.items())
+
+    def stop_receiving(self, stream_id: int) -> None:
+        """Ask the peer to stop sending on a stream we are done with, unless it already has."""
+        # Streams aioquic has forgotten are finished and can't get data again
+        self._closed_streams = {closed for closed in self._closed_streams if self.internals.has_stream(closed)}
+        if self.internals.receiving(stream_id):
+            self._quic.stop_stream(stream_id, STREAM_ABORTED)
+            self._closed_streams.add(stream_id)
+        self._transmit_soon()
+
+    def reject_stream(self, stream_id: int, reason: str) -> None:
+        """Answer a new request stream with an ERROR PDU and end it, without serving it."""
+        print(f'[svr] Rejecting stream {stream_id}: {reason}')
+        error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, reason).to_bytes()
+        self._quic.send_stream_data(stream_id, pdu.FRAME_PREFIX.pack(len(error_msg)) + bytes(error_msg), end_stream=True)
+        self.stop_receiving(stream_id)
+        if self._rejection:
+            # Give the ERROR time to arrive, then let the connection go
+            asyncio.get_running_loop().call_later(REJECT_LINGER, self.close)
         
+    def open_datagrams(self, flow: int) -> asyncio.Queue:
+        queue = self._datagram_queues.get(flow)
+        if queue is None:
+            queue = self._datagram_queues[flow] = asyncio.Queue()
+        return queue
+
+    def close_datagrams(self, flow: int) -> None:
+        self._datagram_queues.pop(flow, None)
+
+    def _datagram_received(self, event: DatagramFrameReceived) -> None:
+        if len(event.data) < pdu.LIVE_HEADER.size:
+            return
+        queue = self._datagram_queues.get(pdu.LiveDatagram.flow_of(event.data))
+        if queue is not None:
+            queue.put_nowait(event.data)
+
     def _quic_client_event_dispatch(self, event):
         if isinstance(event, StreamDataReceived):
             self._client_handler.quic_event_received(event)
@@ -70,24 +213,92 @@ class AsyncQuicServer(QuicConnectionProtocol):
     def _quic_server_event_dispatch(self, event):
         handler = None
         if isinstance(event, StreamDataReceived):
+            if event.stream_id in self._closed_streams:
+                # Dropped, but the connection budget it used is given back
+                self.receive_credit.consumed(event.stream_id, len(event.data))
+                self.receive_credit.forget(event.stream_id)
+                return
             if event.stream_id not in self._handlers:
+                lifecycle = self.scope.get('lifecycle')
+                reason = self._rejection or (lifecycle.admit_stream(self) if lifecycle is not None else None)
+                if reason:
+                    self.reject_stream(event.stream_id, reason)
+                    return
                 handler = EchoServerRequestHandler(
                     authority=self._quic.configuration.server_name,
                     connection=self._quic,
                     protocol=self,
-                    scope={},
+                    # Chunk sizes are negotiated against our receive window
+                    scope=dict(self.scope, window=self.receive_credit.stream_budget),
                     stream_ended=event.end_stream,
                     stream_id=event.stream_id,
-                    transmit=self.transmit
+                    transmit=self._transmit_soon,
+                    high_watermark=self.send_buffer,
+                    low_watermark=self.send_buffer // 4,
                 )
                 self._handlers[event.stream_id] = handler
                 handler.quic_event_received(event)
-                asyncio.ensure_future(handler.launch_qvtp())
+                handler.task = asyncio.ensure_future(handler.launch_qvtp())
             else:
                 handler = self._handlers[event.stream_id]
                 handler.quic_event_received(event)
 
+    def transmit(self) -> None:
+        # Runs after every ACK, timer and (coalesced) send, which is when
+        # buffered stream data may have been sent or acknowledged.
+        super().transmit()
+        if self._tuner is not None:
+            self._tuner.sample()
+        for handler in list(self._blocked_senders):
+            handler.wake_if_writable()
+        scheduler = self.scope.get('scheduler')
+        if scheduler is not None:
+            scheduler.drained()
+
+    def block_sender(self, handler) -> None:
+        self._blocked_senders.add(handler)
+
+    def unblock_sender(self, handler) -> None:
+        self._blocked_senders.discard(handler)
+
+    def connection_lost(self, exc) -> None:
+        super().connection_lost(exc)
+        self._connection_ended()
+
+    def _connection_ended(self) -> None:
+        # A server connection ends with ConnectionTerminated; connection_lost
+        # is only called when a client's socket goes
+        for handler in list(self._blocked_senders):
+            handler.wake_if_writable()
+        # Handlers waiting for data that will never come would hang on to it all
+        for handler in self.handlers():
+            handler.abort('Connection lost')
+        if self.scope.get('lifecycle') is not None:
+            self.scope['lifecycle'].connection_closed(self)
+        scheduler = self.scope.get('scheduler')
+        if scheduler is not None:
+            scheduler.close_connection(self)
+        if self._client_handler is not None:
+            self._client_handler.abort('Connection lost')
+            self._client_handler.finish_traces()
+
+    def _handshake_completed(self, event: HandshakeCompleted) -> None:
+        self.handshake_done = time.monotonic()
+        elapsed = self.handshake_done - self._handshake_started
+        handshake_stats.record(elapsed, event.session_resumed, event.early_data_accepted)
+        kind = 'resumed' if event.session_resumed else 'full'
+        if event.early_data_accepted:
+            kind += ', 0-RTT accepted'
+        prefix = '[cli]' if self._is_client else '[svr]'
+        print(f'{prefix} Handshake completed in {elapsed * 1000:.1f} ms ({kind}); {handshake_stats.summary()}')
+
     def quic_event_received(self, event):
+        if isinstance(event, HandshakeCompleted):
+            self._handshake_completed(event)
+        elif isinstance(event, ConnectionTerminated):
+            self._connection_ended()
+        elif isinstance(event, DatagramFrameReceived):
+            self._datagram_received(event)
         if self._mode == SERVER_MODE:
             self._quic_server_event_dispatch(event)
         else:
@@ -96,32 +307,55 @@ class AsyncQuicServer(QuicConnectionProtocol):
     def is_client(self) -> bool:
         return self._quic.configuration.is_client
 
-class SessionTicketStore:
-    """
-    Simple in-memory store for session tickets.
-    """
-
-    def __init__(self) -> None:
-        self.tickets: Dict[bytes, SessionTicket] = {}
-
-    def add(self, ticket: SessionTicket) -> None:
-        self.tickets[ticket.ticket] = ticket
-
-    def pop(self, label: bytes) -> Optional[SessionTicket]:
-        return self.tickets.pop(label, None)
-
+    def trace_id(self) -> str:
+        # The name of the connection's qlog file
+        return self.internals.connection_id()
 
-async def run_server(server, server_port, configuration):  
+async def run_server(server, server_port, configuration, scope=None, tickets: Optional[SessionTicketStore] = None,
+                     reuse_port: bool = False, metrics_port: Optional[int] = None):  
     print("[svr] Server starting...")  
-    await serve(server, server_port, configuration=configuration, 
-            create_protocol=AsyncQuicServer,
-            session_ticket_fetcher=SessionTicketStore().pop,
-            session_ticket_handler=SessionTicketStore().add)
+    # The files we serve are indexed before the first request comes in
+    catalog = (scope or {}).get('catalog')
+    if catalog is not None:
+        await catalog.start()
+    if metrics_port:
+        await metrics.serve_endpoint('127.0.0.1', metrics_port)
+        print(f'[svr] Metrics at http://127.0.0.1:{metrics_port}/')
+    # qlog of every connection, if tracing is on
+    if (scope or {}).get('tracer') is not None:
+        configuration.quic_logger = scope['tracer'].quic_logger
+        print(f'[svr] Tracing connections to {scope["tracer"].directory}')
+    # One store for issuing and looking up tickets, or resumption never finds them
+    tickets = tickets if tickets is not None else SessionTicketStore()
+    # As aioquic's serve(), but worker processes may share the port: the
+    # kernel then hashes each client address to one of their sockets, so
+    # every packet of a connection reaches the worker that owns it
+    await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: QuicServer(configuration=configuration,
+                           create_protocol=functools.partial(AsyncQuicServer, scope=scope),
+                           session_ticket_fetcher=tickets.pop,
+                           session_ticket_handler=tickets.add),
+        local_addr=(server, server_port),
+        reuse_port=reuse_port)
     await asyncio.Future()
   
               
-async def run_client(server, server_port, configuration, video_path, download):    
-    async with connect(server, server_port, configuration=configuration, create_protocol=AsyncQuicServer) as client:
+async def run_client(server, server_port, configuration, video_path, download, scope=None,
+                     tickets: Optional[ClientTicketCache] = None, early_data: bool = True):    
+    # With a ticket from an earlier connection the session is resumed, and
+    # unless early_data is off the REQUEST goes out as 0-RTT data instead
+    # of waiting a round trip for the handshake
+    tickets = tickets if tickets is not None else ClientTicketCache()
+    configuration.session_ticket = tickets.take(configuration.server_name or server)
+    wait_connected = configuration.session_ticket is None or not early_data
+    scope = scope or {}
+    if scope.get('tracer') is not None:
+        configuration.quic_logger = scope['tracer'].quic_logger
+    async with connect(server, server_port, configuration=configuration,
+                       create_protocol=functools.partial(AsyncQuicServer, scope={'transport': scope.get('transport'),
+                                                                                 'tracer': scope.get('tracer')}),
+                       session_ticket_handler=tickets.add, wait_connected=wait_connected) as client:
+        client._client_handler.scope.update(scope)
         await asyncio.ensure_future(client._client_handler.launch_qvtp(video_path, download))
 
         
@@ -136,45 +370,279 @@ class EchoServerRequestHandler:
         stream_ended: bool,
         stream_id: int,
         transmit: Callable[[], None],
+        high_watermark: int = SEND_HIGH_WATERMARK,
+        low_watermark: int = SEND_LOW_WATERMARK,
     ) -> None:
         self.authority = authority
         self.connection = connection
         self.protocol = protocol
-        self.queue: asyncio.Queue[QuicStreamEvent] = asyncio.Queue()
+        # One queue per stream; the client handler drives several streams.
+        self._queues: Dict[int, asyncio.Queue[QuicStreamEvent]] = {}
         self.scope = scope
         self.stream_id = stream_id
         self.transmit = transmit
-
-        if stream_ended:
-            self.queue.put_nowait({"type": "quic.stream_end"})
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self._writable = asyncio.Event()
+        self._blocked_stream: Optional[int] = None
+        # One decoder per stream; the client handler sees several streams.
+        self._decoders: Dict[int, pdu.FrameDecoder] = {}
+        # For the lifecycle manager: the task serving the stream, when it
+        # last received or sent, since when it waits for the peer, and
+        # whether it waits for its turn in the send scheduler
+        self.task: Optional[asyncio.Future] = None
+        self.last_activity = time.monotonic()
+        self.blocked_since: Optional[float] = None
+        self.scheduled = False
+        self._send_ended = False
+        self._closed = False
+        # Why receive() fails from now on, once the client's connection is gone
+        self._lost: Optional[str] = None
+        # Stream -> its timing, if tracing is on
+        self._traces: Dict[int, TransferTrace] = {}
         
 
     async def launch_qvtp(self):
         logging.debug(f"Launching QVTP for stream_id: {self.stream_id}")
-        qc = EchoQuicConnection(self.send, self.receive, self.close, None)
-        await video_server.echo_server_proto(self.scope, qc)
+        qc = EchoQuicConnection(self.send, self.receive, self.close, None, self.send_datagram,
+                                self.protocol.open_datagrams, self.protocol.close_datagrams)
+        try:
+            await video_server.echo_server_proto(self.scope, qc)
+        finally:
+            self.close()
 
     def quic_event_received(self, event: StreamDataReceived) -> None:
-        self.queue.put_nowait(
-            QuicStreamEvent(event.stream_id, event.data, 
-                            event.end_stream)
-        )
-    async def receive(self) -> QuicStreamEvent:
-        queue_item = await self.queue.get()
+        self.last_activity = time.monotonic()
+        decoder = self._decoders.get(event.stream_id)
+        if decoder is None:
+            decoder = self._decoders[event.stream_id] = pdu.FrameDecoder()
+        queue = self._queue(event.stream_id)
+        try:
+            frames = decoder.feed(event.data)
+        except ValueError as e:
+            logging.warning(f"Stream {event.stream_id}: {e}")
+            self._decoders.pop(event.stream_id, None)
+            self.abort('Invalid frame')
+            return
+        for frame in frames:
+            queue.put_nowait(
+                QuicStreamEvent(event.stream_id, frame, False)
+            )
+        if event.end_stream:
+            if len(decoder):
+                logging.warning(f"Stream {event.stream_id} ended with {len(decoder)} bytes of partial frame")
+            self._decoders.pop(event.stream_id, None)
+            queue.put_nowait(
+                QuicStreamEvent(event.stream_id, b'', True)
+            )
+
+    def _queue(self, stream_id: int) -> asyncio.Queue:
+        queue = self._queues.get(stream_id)
+        if queue is None:
+            queue = self._queues[stream_id] = asyncio.Queue()
+            if self._lost is not None:
+                queue.put_nowait(None)
+        return queue
+
+    async def _get(self, queue: asyncio.Queue) -> QuicStreamEvent:
+        queue_item = await queue.get()
+        if queue_item is None:
+            # Left for the next receive too (see EchoClientRequestHandler.abort)
+            queue.put_nowait(None)
+            raise ConnectionError(self._lost)
+        return queue_item
+
+    async def receive(self, stream_id: Optional[int] = None) -> QuicStreamEvent:
+        # The server handler serves one stream; the client names the stream
+        stream_id = self.stream_id if stream_id is None else stream_id
+        queue = self._queue(stream_id)
+        metrics.RECEIVE_QUEUE_DEPTH.observe(queue.qsize())
+        if self.protocol.tracer is not None:
+            return await self._traced_receive(stream_id, queue)
+        queue_item = await self._get(queue)
+        self._received(queue_item)
+        return queue_item
+
+    async def _traced_receive(self, stream_id: int, queue: asyncio.Queue) -> QuicStreamEvent:
+        trace = self._trace(stream_id)
+        now = time.monotonic()
+        if trace.idle_from is not None and trace.in_transfer():
+            trace.stall('local', now - trace.idle_from)
+        waited = queue.empty()
+        queue_item = await self._get(queue)
+        self._received(queue_item)
+        trace.idle_from = time.monotonic()
+        if waited and trace.in_transfer():
+            trace.stall('peer', trace.idle_from - now)
+        trace.message(queue_item.data, trace.idle_from)
+        if queue_item.end_stream:
+            trace.mark('fin', trace.idle_from)
+        # A client is done with a stream at the server's ACK or FIN; a server when it closes it.
+        # (A client's stream may already have been let go with its trace, see _retire_if_done)
+        if self._is_client_handler() and (queue_item.end_stream or 'ack' in trace.phases) \
+                and self._traces.get(stream_id) is trace:
+            self._finish_trace(stream_id)
         return queue_item
+
+    def _received(self, queue_item: QuicStreamEvent) -> None:
+        metrics.BYTES_IN.inc(len(queue_item.data))
+        self.protocol.bytes_in += len(queue_item.data)
+        # Handing a frame to the application frees its share of the receive
+        # budget, which may let the peer send more.
+        if queue_item.data and self.protocol.receive_credit.consumed(
+                queue_item.stream_id, pdu.FRAME_PREFIX.size + len(queue_item.data)):
+            self.transmit()
     
     async def send(self, message: QuicStreamEvent) -> None:
+        trace = self._trace(message.stream_id) if self.protocol.tracer is not None else None
+        if trace is not None and trace.idle_from is not None and trace.in_transfer():
+            trace.stall('local', time.monotonic() - trace.idle_from)
+        scheduler = self.scope.get('scheduler')
+        if scheduler is not None and message.data:
+            # Server streams take turns with every other stream on the server
+            if not scheduler.is_open(self):
+                scheduler.open(self, self.protocol, self.scope.get('priority', DEFAULT_PRIORITY),
+                               lambda: self.buffered(message.stream_id))
+            waiting = time.monotonic()
+            self.scheduled = True
+            try:
+                await scheduler.submit(self, len(message.data), lambda: self._write(message))
+            finally:
+                self.scheduled = False
+            if trace is not None and trace.in_transfer():
+                trace.stall('scheduler', time.monotonic() - waiting)
+        else:
+            self._write(message)
+        if trace is not None:
+            now = time.monotonic()
+            trace.message(message.data, now, message.framed)
+            if message.end_stream:
+                trace.mark('fin', now)
+        if scheduler is not None and message.end_stream:
+            scheduler.close(self)
+        if self.buffered(message.stream_id) > self.high_watermark:
+            await self._drain(message.stream_id)
+        if trace is not None:
+            trace.idle_from = time.monotonic()
+
+    def _write(self, message: QuicStreamEvent) -> None:
+        # Each non-empty send carries exactly one PDU unless it was framed by
+        # pdu.encode_batch; an empty one only ends the stream.
+        if message.data and not message.framed:
+            self.connection.send_stream_data(
+                    stream_id=message.stream_id,
+                    data=pdu.FRAME_PREFIX.pack(len(message.data)),
+                    end_stream=False
+            )
         self.connection.send_stream_data(
                 stream_id=message.stream_id,
                 data=message.data,
                 end_stream=message.end_stream
         )
         
+        metrics.BYTES_OUT.inc(len(message.data))
+        self.protocol.bytes_out += len(message.data)
+        # Flushed once per event-loop tick, however many sends queued data
         self.transmit()
+        self.last_activity = time.monotonic()
+        if message.end_stream:
+            self._send_ended = True
+
+    def send_datagram(self, data: bytes) -> None:
+        # Unreliable and unordered; never retransmitted if lost
+        self.connection.send_datagram_frame(data)
+        metrics.BYTES_OUT.inc(len(data))
+        self.transmit()
+
+    def buffered(self, stream_id: int) -> int:
+        # aioquic keeps written data until the peer acknowledges it; this is
+        # what grows when flow control, congestion or a slow peer hold us back.
+        return self.protocol.internals.send_buffered(stream_id)
+
+    async def _drain(self, stream_id: int) -> None:
+        metrics.SEND_BLOCKED.inc()
+        self._blocked_stream = stream_id
+        self.blocked_since = time.monotonic()
+        trace = self._traces.get(stream_id)
+        if trace is not None:
+            trace.blocked_at, trace.blocked_on = self.blocked_since, None
+        self._writable.clear()
+        self.protocol.block_sender(self)
+        try:
+            await self._writable.wait()
+        finally:
+            if trace is not None:
+                trace.blocked(self._stall_kind(stream_id), time.monotonic())
+                trace.blocked_at = None
+            self.protocol.unblock_sender(self)
+            self._blocked_stream = None
+            self.blocked_since = None
+        if self.protocol._closed.is_set():
+            raise ConnectionError('Connection closed while sending')
+
+    def wake_if_writable(self) -> None:
+        if self._traces and self._blocked_stream in self._traces:
+            # Called on every transmit while blocked; what holds the stream back may change
+            self._traces[self._blocked_stream].blocked(self._stall_kind(self._blocked_stream), time.monotonic())
+        if (self.protocol._closed.is_set() or self._blocked_stream is None
+                or self.buffered(self._blocked_stream) <= self.low_watermark):
+            self._writable.set()
         
     def close(self) -> None:
+        # Ends this stream only; the connection and its other streams carry on
+        if self._closed:
+            return
+        self._closed = True
+        scheduler = self.scope.get('scheduler')
+        if scheduler is not None:
+            scheduler.close(self, finished=False)
+        if not self._send_ended and not self.protocol._closed.is_set():
+            self.connection.send_stream_data(self.stream_id, b'', end_stream=True)
+            self._send_ended = True
+        if self.stream_id in self._traces:
+            self._traces[self.stream_id].mark('fin', time.monotonic())
+            self._finish_trace(self.stream_id)
         self.protocol.remove_handler(self.stream_id)
-        self.connection.close()
+
+    def _trace(self, stream_id: int) -> TransferTrace:
+        trace = self._traces.get(stream_id)
+        if trace is None:
+            trace = self._traces[stream_id] = TransferTrace(self.protocol.trace_id(), stream_id,
+                                                            self.protocol._handshake_started)
+        return trace
+
+    def _finish_trace(self, stream_id: int) -> None:
+        trace = self._traces.pop(stream_id)
+        self.protocol.tracer.finish(trace, self.protocol.handshake_done, '[cli]' if self.protocol.is_client() else '[svr]')
+
+    def finish_traces(self) -> None:
+        # Streams the connection ended under, or that never got an ACK or FIN
+        for stream_id in list(self._traces):
+            self._finish_trace(stream_id)
+
+    def _is_client_handler(self) -> bool:
+        return self.stream_id is None
+
+    def _stall_kind(self, stream_id: int) -> str:
+        return self.protocol.internals.send_blocked_on(stream_id)
+
+    def abort(self, reason: str) -> None:
+        """Stop serving the stream now, telling the peer why if the stream can still carry it."""
+        if self._closed:
+            return
+        print(f'[svr] Closing stream {self.stream_id}: {reason}')
+        if not self._send_ended and not self.protocol._closed.is_set():
+            if self.blocked_since is None:
+                error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, reason).to_bytes()
+                self.connection.send_stream_data(self.stream_id, pdu.FRAME_PREFIX.pack(len(error_msg)) + bytes(error_msg),
+                                                 end_stream=True)
+            else:
+                # Its buffer isn't draining, so an ERROR would never get through; drop it all
+                self.connection.reset_stream(self.stream_id, STREAM_ABORTED)
+            self._send_ended = True
+        if self.task is not None:
+            self.task.cancel()
+        self.close()
         
     async def launch_echo(self):
         qc = EchoQuicConnection(self.send, 
@@ -186,14 +654,65 @@ class EchoServerRequestHandler:
 class EchoClientRequestHandler(EchoServerRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # A batch runs all its streams through this one handler, so a stream's
+        # queue and trace are let go once the server has ended it and only the
+        # end is left to read. Streams ended but not yet read that far, and
+        # those let go (kept until aioquic forgets them too)
+        self._ended: Set[int] = set()
+        self._finished: Set[int] = set()
+
+    def quic_event_received(self, event: StreamDataReceived) -> None:
+        if event.stream_id in self._finished:
+            return
+        super().quic_event_received(event)
+        if event.end_stream:
+            self._ended.add(event.stream_id)
+            self._retire_if_done(event.stream_id)
+
+    async def receive(self, stream_id: Optional[int] = None) -> QuicStreamEvent:
+        if stream_id in self._finished:
+            return QuicStreamEvent(stream_id, b'', True)
+        queue_item = await super().receive(stream_id)
+        self._retire_if_done(stream_id)
+        return queue_item
+
+    def _retire_if_done(self, stream_id: int) -> None:
+        queue = self._queues.get(stream_id)
+        # Once the end marker is read, or is all that is left (a receive already
+        # waiting still gets it; later ones get it from receive())
+        if stream_id not in self._ended or (queue is not None and queue.qsize() > 1):
+            return
+        self._ended.discard(stream_id)
+        self._queues.pop(stream_id, None)
+        self._finished = {finished for finished in self._finished if self.protocol.internals.has_stream(finished)}
+        self._finished.add(stream_id)
+        if stream_id in self._traces:
+            self._traces[stream_id].mark('fin', time.monotonic())
+            self._finish_trace(stream_id)
         
     async def launch_qvtp(self, video_path, download):
         logging.debug(f"Launching QVTP client for video_path: {video_path}, download: {download}")
-        qc = EchoQuicConnection(self.send, self.receive, self.close, self.get_next_stream_id)
+        qc = EchoQuicConnection(self.send, self.receive, self.close, self.get_next_stream_id, self.send_datagram,
+                                self.protocol.open_datagrams, self.protocol.close_datagrams)
         await video_client.echo_client_proto(self.scope, qc, video_path, download)
 
+    def abort(self, reason: str) -> None:
+        """
+        The connection is gone: every receive on its streams, waiting or yet
+        to come, fails with reason instead of waiting for the server forever.
+        """
+        if self._lost is not None:
+            return
+        self._lost = reason
+        for queue in self._queues.values():
+            queue.put_nowait(None)
+
     def get_next_stream_id(self) -> int:
-        return self.connection.get_next_available_stream_id()
+        # aioquic only counts a stream as used once something is written to
+        # it, so claim it now in case several are opened before any REQUEST.
+        stream_id = self.connection.get_next_available_stream_id()
+        self.connection.send_stream_data(stream_id, b'')
+        return stream_id
     
     async def launch_echo(self):
         qc = EchoQuicConnection(self.send, 
@@ -2,48 +2,226 @@
 
 import argparse
 import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
 from aioquic.quic.configuration import QuicConfiguration
 import video_client
 import quic_engine
+import pdu
 import video_server
+import disk_io
+import catalog
+import chunk_cache
+import tickets
+import metrics
+import dedup
+import fec
+import lifecycle
+import live
+import scheduler
+import transport
+import tracing
+import logging
 from typing import Dict
+def setup_observability(args):
+    # Per-chunk messages are at DEBUG, so off unless asked for
+    logging.basicConfig(level=args.log_level.upper(), format='%(message)s')
+    metrics.dump_on_signal()
+
 def client_mode(args):
+    setup_observability(args)
     server_address = args.server
     server_port = args.port
     cert_file = args.cert_file
     video_path = args.video_path
-    download = args.download
+    download = args.download or args.live
+    
+    scope = {
+        'checksums': args.checksum.split(','),
+        'digest': args.digest,
+        'streams': args.streams,
+        'resume': args.resume,
+        'fsync': args.fsync,
+        'ranges': args.range,
+        'concurrency': args.concurrency,
+        'chunk_size': args.chunk_size,
+        'adaptive_chunks': args.adaptive_chunks,
+        'dedup': args.dedup,
+        'live': {'fec': args.fec, 'k': args.fec_group, 'm': args.fec_parity, 'bitrate': args.bitrate,
+                 'latency': args.latency / 1000} if args.live else None,
+        'loss': args.loss,
+        'priority': args.priority,
+        'list': args.page_size if args.list else None,
+        'transport': transport.PROFILES[args.transport],
+        'tracer': tracing.Tracer(args.trace) if args.trace else None,
+    }
+    disk_io.set_pool(disk_io.DiskPool(args.io_threads))
     
-    config = quic_engine.build_client_quic_config(cert_file)
-    asyncio.run(quic_engine.run_client(server_address, server_port, config, video_path, download))
+    print(f'[cli] Transport: {scope["transport"].describe()}')
+    config = quic_engine.build_client_quic_config(cert_file, scope['transport'])
+    ticket_cache = tickets.ClientTicketCache(os.path.expanduser(args.ticket_file) if args.ticket_file else None)
+    asyncio.run(quic_engine.run_client(server_address, server_port, config, video_path, download, scope,
+                                       ticket_cache, not args.no_early_data))
+
+def parse_range(value: str):
+    offset, _, length = value.partition(':')
+    try:
+        offset, length = int(offset), int(length)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected OFFSET:LENGTH, got {value!r}')
+    if offset < 0 or length <= 0:
+        raise argparse.ArgumentTypeError(f'invalid range {value!r}')
+    return offset, length
 
 def server_mode(args):
+    setup_observability(args)
+    if args.workers > 1:
+        run_workers(args)
+        return
+    
+    ticket_store = (tickets.SharedTicketStore(args.ticket_dir, args.max_tickets, args.ticket_ttl) if args.ticket_dir
+                    else tickets.SessionTicketStore(args.max_tickets, args.ticket_ttl, args.ticket_file))
+    serve_process(args, ticket_store, metrics_port=args.metrics_port)
+
+def serve_process(args, ticket_store, reuse_port=False, metrics_port=None):
     listen_address = args.listen
     listen_port = args.port
     cert_file = args.cert_file
     key_file = args.key_file
+    disk_io.set_pool(disk_io.DiskPool(args.io_threads))
+    
+    scope = {
+        'fsync': args.fsync,
+        'adaptive_chunks': args.adaptive_chunks,
+        'chunk_store': dedup.ChunkStore(args.chunk_store) if args.chunk_store else None,
+        'catalog': catalog.Catalog(args.root, digest=args.catalog_digest, refresh=args.catalog_refresh),
+        'lifecycle': lifecycle.StreamLifecycle(args.max_connections, args.max_streams, args.idle_timeout,
+                                               args.slow_peer_timeout, args.memory_mb * 1024 * 1024),
+        'scheduler': scheduler.SendScheduler(args.sched_quantum * 1024) if not args.no_fair_share else None,
+        'transport': transport.PROFILES[args.transport],
+        'tracer': tracing.Tracer(args.trace) if args.trace else None,
+    }
+    chunk_cache.set_cache(chunk_cache.ChunkCache(args.cache_mb * 1024 * 1024))
     
-    server_config = quic_engine.build_server_quic_config(cert_file, key_file)
-    asyncio.run(quic_engine.run_server(listen_address, listen_port, server_config))
+    print(f'[svr] Transport: {scope["transport"].describe()}')
+    server_config = quic_engine.build_server_quic_config(cert_file, key_file, scope['transport'])
+    asyncio.run(quic_engine.run_server(listen_address, listen_port, server_config, scope, ticket_store, reuse_port,
+                                       metrics_port))
+
+def serve_worker(args, worker, ticket_dir):
+    print(f'[svr] Worker {worker} (pid {os.getpid()}) starting')
+    setup_observability(args)
+    try:
+        # Each worker has its own metrics, on the next port up from the first
+        serve_process(args, tickets.SharedTicketStore(ticket_dir, args.max_tickets, args.ticket_ttl), reuse_port=True,
+                      metrics_port=args.metrics_port + worker if args.metrics_port else None)
+    except KeyboardInterrupt:
+        pass
+
+def run_workers(args):
+    # Workers share the UDP port (SO_REUSEPORT) and a ticket directory, so a
+    # client resumes on whichever worker its next connection is hashed to
+    ticket_dir = args.ticket_dir or tempfile.mkdtemp(prefix='qvtp-tickets-')
+    workers = [multiprocessing.Process(target=serve_worker, args=(args, worker, ticket_dir), daemon=True)
+               for worker in range(args.workers)]
+    for process in workers:
+        process.start()
+    # Stopping the parent stops the workers too, and a metrics dump request
+    # is passed on to each of them
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: [os.kill(process.pid, signum) for process in workers])
+    try:
+        while all(process.is_alive() for process in workers):
+            time.sleep(1)
+        print('[svr] A worker exited, shutting down')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+        if not args.ticket_dir:
+            shutil.rmtree(ticket_dir, ignore_errors=True)
 
 def parse_args():
     parser = argparse.ArgumentParser(description='QVTP example')
+    parser.add_argument('--log-level', default='warning', choices=['debug', 'info', 'warning', 'error'], help='Logging level; debug logs every chunk')
     subparsers = parser.add_subparsers(dest='mode', help='Mode to run the application in', required=True)
     
     client_parser = subparsers.add_parser('client')
     client_parser.add_argument('-s', '--server', default='localhost', help='Host to connect to')   
     client_parser.add_argument('-p', '--port', type=int, default=4433, help='Port to connect to')
     client_parser.add_argument('-c', '--cert-file', default='./certs/quic_certificate.pem', help='Certificate file (for self-signed certs)')
-    client_parser.add_argument('-v', '--video-path', required=True, help='Path to the video file')
+    client_parser.add_argument('-v', '--video-path', nargs='+', help='Video files to transfer; uploads also take globs and directories')
+    client_parser.add_argument('--concurrency', type=int, default=video_client.DEFAULT_CONCURRENCY, help='Files transferred at once when sending several')
     client_parser.add_argument('-d', '--download', action='store_true', help='Flag to download the video instead of uploading')
+    client_parser.add_argument('--checksum', default=','.join(pdu.DEFAULT_CHECKSUMS), help='Per-chunk checksums to offer, in order of preference (none, crc32, crc32c, xxh64)')
+    client_parser.add_argument('--streams', type=int, default=1, help='Number of parallel QUIC streams to split the transfer across')
+    client_parser.add_argument('--resume', action='store_true', help='Make the transfer resumable and continue an interrupted one')
+    client_parser.add_argument('--digest', choices=pdu.DIGEST_ALGORITHMS, default=None, help='Verify the whole file with this digest at end of transfer')
+    client_parser.add_argument('--range', type=parse_range, action='append', default=[], help='Download only OFFSET:LENGTH bytes; repeat for several ranges, fetched in the order given')
+    client_parser.add_argument('--ticket-file', default='~/.qvtp_tickets', help='Where to keep session tickets for resuming with 0-RTT (empty to not keep them)')
+    client_parser.add_argument('--no-early-data', action='store_true', help='Wait for the handshake instead of sending the request as 0-RTT data')
+    client_parser.add_argument('--fsync', choices=disk_io.FSYNC_POLICIES, default=disk_io.FSYNC_NONE, help='When to fsync downloaded files')
+    client_parser.add_argument('--chunk-size', type=int, default=None, help='Preferred DATA chunk size in bytes (by default the server picks one from the file size and receive window)')
+    client_parser.add_argument('--adaptive-chunks', action='store_true', help='Adjust the chunk size of uploads to the measured throughput')
+    client_parser.add_argument('--dedup', action='store_true', help='Upload only the content-defined chunks the server does not already hold')
+    client_parser.add_argument('--live', action='store_true', help='Play the video from the server as a live feed over QUIC datagrams, with FEC instead of retransmission')
+    client_parser.add_argument('--fec', choices=fec.FEC_SCHEMES, default=live.DEFAULT_FEC, help='Forward error correction of a live feed: XOR parity or Reed-Solomon style')
+    client_parser.add_argument('--fec-group', type=int, default=live.DEFAULT_GROUP, help='Live packets per FEC group')
+    client_parser.add_argument('--fec-parity', type=int, default=live.DEFAULT_PARITY, help='Parity packets per FEC group (rs; xor always sends one), i.e. losses per group it recovers')
+    client_parser.add_argument('--bitrate', type=int, default=live.DEFAULT_BITRATE, help='Bits per second of a live feed')
+    client_parser.add_argument('--latency', type=float, default=live.DEFAULT_LATENCY * 1000, help='Playout delay of a live feed in ms, the jitter it absorbs')
+    client_parser.add_argument('--loss', type=float, default=0.0, help='Fraction of live datagrams to drop on arrival, to simulate a lossy link')
+    client_parser.add_argument('--priority', choices=list(scheduler.PRIORITY_WEIGHTS), default=None, help='Share of the server\'s sending this request asks for, e.g. interactive for a preview, bulk for an archive')
+    client_parser.add_argument('--list', action='store_true', help='List the videos the server has instead of transferring any')
+    client_parser.add_argument('--page-size', type=int, default=catalog.LIST_PAGE, help='Catalog entries fetched per LIST request')
+    client_parser.add_argument('--transport', choices=list(transport.PROFILES), default=transport.DEFAULT_PROFILE, help='QUIC windows, congestion control and timeouts for the kind of path: lan, wan, high-bdp, lossy, or auto to follow the measured bandwidth-delay product')
+    client_parser.add_argument('--trace', metavar='DIR', default=None, help='Write a qlog file per connection and a timing record per transfer (phases and stalls) to this directory')
+    client_parser.add_argument('--io-threads', type=int, default=disk_io.DEFAULT_IO_THREADS, help='Threads for file reads and writes')
     
     server_parser = subparsers.add_parser('server')
     server_parser.add_argument('-c', '--cert-file', default='./certs/quic_certificate.pem', help='Certificate file (for self-signed certs)')
     server_parser.add_argument('-k', '--key-file', default='./certs/quic_private_key.pem', help='Key file (for self-signed certs)')
     server_parser.add_argument('-l', '--listen', default='localhost', help='Address to listen on')
     server_parser.add_argument('-p', '--port', type=int, default=4433, help='Port to listen on')
+    server_parser.add_argument('--fsync', choices=disk_io.FSYNC_POLICIES, default=disk_io.FSYNC_NONE, help='When to fsync uploaded files')
+    server_parser.add_argument('--ticket-file', default=None, help='File to keep issued session tickets in across restarts')
+    server_parser.add_argument('--ticket-dir', default=None, help='Directory of session tickets shared by worker processes (a temporary one by default)')
+    server_parser.add_argument('--ticket-ttl', type=float, default=tickets.DEFAULT_TICKET_TTL, help='Seconds an issued session ticket stays valid')
+    server_parser.add_argument('--max-tickets', type=int, default=tickets.DEFAULT_MAX_TICKETS, help='Most session tickets the server keeps')
+    server_parser.add_argument('--cache-mb', type=int, default=chunk_cache.DEFAULT_CACHE_BUDGET // (1024 * 1024), help='Memory budget of the download chunk cache in MiB (per worker)')
+    server_parser.add_argument('--metrics-port', type=int, default=None, help='Serve metrics as text on this local port (workers use the ports after it too); SIGUSR1 dumps them to stderr')
+    server_parser.add_argument('--workers', type=int, default=1, help='Server processes sharing the port, e.g. one per CPU core')
+    server_parser.add_argument('--adaptive-chunks', action='store_true', help='Adjust the chunk size of downloads to the measured throughput (bypasses the chunk cache while it changes)')
+    server_parser.add_argument('--chunk-store', default=None, help='Directory of uploaded chunks by content, for dedup uploads (off if not given)')
+    server_parser.add_argument('--root', default='.', help='Directory of the videos to serve; only files found under it are served')
+    server_parser.add_argument('--catalog-refresh', type=float, default=catalog.DEFAULT_REFRESH, help='Seconds between rescans of the root for new, changed and removed videos')
+    server_parser.add_argument('--catalog-digest', choices=pdu.DIGEST_ALGORITHMS, default=None, help='Precompute this whole-file digest of every served video in the background')
+    server_parser.add_argument('--max-connections', type=int, default=lifecycle.DEFAULT_MAX_CONNECTIONS, help='Connections served at once (per worker); more are answered with an ERROR')
+    server_parser.add_argument('--max-streams', type=int, default=lifecycle.DEFAULT_MAX_STREAMS, help='Request streams served at once per connection')
+    server_parser.add_argument('--idle-timeout', type=float, default=lifecycle.DEFAULT_IDLE_TIMEOUT, help='Seconds a stream may neither receive nor send before it is closed')
+    server_parser.add_argument('--slow-peer-timeout', type=float, default=lifecycle.DEFAULT_SLOW_PEER_TIMEOUT, help='Seconds a stream may wait for the client to take its data before it is reset')
+    server_parser.add_argument('--memory-mb', type=int, default=lifecycle.DEFAULT_MEMORY_BUDGET // (1024 * 1024), help='MiB buffered in QUIC for all connections past which new streams are turned away (per worker)')
+    server_parser.add_argument('--no-fair-share', action='store_true', help='Let every stream send as fast as it can instead of taking turns by priority')
+    server_parser.add_argument('--sched-quantum', type=int, default=scheduler.DEFAULT_QUANTUM // 1024, help='KiB a stream sends per turn for each unit of its priority weight')
+    server_parser.add_argument('--transport', choices=list(transport.PROFILES), default=transport.DEFAULT_PROFILE, help='QUIC windows, congestion control and timeouts for the kind of path: lan, wan, high-bdp, lossy, or auto to follow the measured bandwidth-delay product')
+    server_parser.add_argument('--trace', metavar='DIR', default=None, help='Write a qlog file per connection and a timing record per transfer (phases and stalls) to this directory')
+    server_parser.add_argument('--io-threads', type=int, default=disk_io.DEFAULT_IO_THREADS, help='Threads for file reads and writes')
        
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.mode == 'client' and not args.video_path and not args.list:
+        client_parser.error('one of -v/--video-path or --list is required')
+    if args.mode == 'server' and args.workers > 1 and args.ticket_file:
+        # Workers share tickets through --ticket-dir, whose files already persist them
+        server_parser.error('--ticket-file is for a single process; with --workers, use --ticket-dir to keep tickets across restarts')
+    return args
 
 if __name__ == '__main__':
     args = parse_args()
@@ -0,0 +1,137 @@
+import bisect
+import hashlib
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from disk_io import WriteBehind
+
+
+class RangeSet:
+    """
+    Sorted, non-overlapping [start, stop) byte ranges.
+
+    Chunks nearly always arrive in order, which only ever extends the last
+    range, so a transfer of any size is usually tracked by a single entry.
+    """
+
+    def __init__(self, ranges: Iterable[Tuple[int, int]] = ()) -> None:
+        self._starts: List[int] = []
+        self._stops: List[int] = []
+        for start, stop in ranges:
+            self.add(start, stop)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return iter(zip(self._starts, self._stops))
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def total(self) -> int:
+        return sum(stop - start for start, stop in self)
+
+    def add(self, start: int, stop: int) -> None:
+        if start >= stop:
+            return
+        if self._stops and self._stops[-1] <= start:
+            # Fast path: at or past the end of the last range
+            if self._stops[-1] == start:
+                self._stops[-1] = stop
+            else:
+                self._starts.append(start)
+                self._stops.append(stop)
+            return
+        # Merge with every range that overlaps or touches [start, stop)
+        lo = bisect.bisect_left(self._stops, start)
+        hi = bisect.bisect_right(self._starts, stop)
+        if lo < hi:
+            start = min(start, self._starts[lo])
+            stop = max(stop, self._stops[hi - 1])
+        self._starts[lo:hi] = [start]
+        self._stops[lo:hi] = [stop]
+
+    def end_of(self, position: int) -> int:
+        """End of the range containing position, or position if it isn't in one."""
+        i = bisect.bisect_right(self._starts, position) - 1
+        return max(position, self._stops[i]) if i >= 0 else position
+
+    def covers(self, start: int, stop: int) -> bool:
+        i = bisect.bisect_right(self._starts, start) - 1
+        return i >= 0 and self._stops[i] >= stop
+
+    def missing(self, start: int, stop: int) -> List[Tuple[int, int]]:
+        """The parts of [start, stop) not in the set."""
+        gaps = []
+        position = start
+        for range_start, range_stop in self:
+            if range_stop <= position:
+                continue
+            if range_start >= stop:
+                break
+            if range_start > position:
+                gaps.append((position, range_start))
+            position = max(position, range_stop)
+        if position < stop:
+            gaps.append((position, stop))
+        return gaps
+
+
+class Reassembler:
+    """
+    Places received chunks at their byte offsets in a preallocated file,
+    through a disk_io.WriteBehind so writes stay off the event loop, and
+    tracks which part of the expected [start, start + length) has arrived,
+    so chunks may come in any order, more than once, or over several
+    streams. Streams of one file may share a `received` set, which may
+    also come pre-filled from a resumed transfer.
+    """
+
+    def __init__(self, writer: WriteBehind, start: int, length: int, received: Optional[RangeSet] = None) -> None:
+        self.writer = writer
+        self.start = start
+        self.stop = start + length
+        self.received = received if received is not None else RangeSet()
+        # True while every chunk has exactly extended the received prefix,
+        # i.e. an incremental digest in arrival order is a digest of the file.
+        self.in_order = not length or self.received.missing(self.start, self.stop) == [(self.start, self.stop)]
+
+    @property
+    def complete(self) -> bool:
+        return self.stop == self.start or self.received.covers(self.start, self.stop)
+
+    def missing(self) -> List[Tuple[int, int]]:
+        return self.received.missing(self.start, self.stop)
+
+    def _contiguous_end(self) -> int:
+        return min(self.received.end_of(self.start), self.stop)
+
+    async def write(self, offset: int, data) -> bool:
+        """
+        Queue a chunk for writing at offset; False if it falls outside the
+        expected range. `received` counts it at once, so flush the writer
+        before persisting that set anywhere.
+        """
+        end = offset + len(data)
+        if offset < self.start or end > self.stop:
+            return False
+        if self.in_order and offset != self._contiguous_end():
+            self.in_order = False
+        await self.writer.write(offset, data)
+        self.received.add(offset, end)
+        return True
+
+    async def digest(self, name: str) -> bytes:
+        """Digest of the expected range as written, read back from the file."""
+        await self.writer.flush()
+        return await self.writer.run(self._read_digest, name)
+
+    def _read_digest(self, name: str, block_size: int = 1024 * 1024) -> bytes:
+        f = self.writer.f
+        digest = hashlib.new(name)
+        f.seek(self.start)
+        remaining = self.stop - self.start
+        while remaining:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+        return digest.digest()
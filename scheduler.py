@@ -0,0 +1,203 @@
+import asyncio
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, Optional, Set
+
+import metrics
+
+# Share of the send capacity each request priority gets relative to the others
+PRIORITY_WEIGHTS = {'interactive': 16, 'normal': 4, 'bulk': 1}
+DEFAULT_PRIORITY = 'normal'
+
+# Bytes a flow may send per round for each unit of weight
+DEFAULT_QUANTUM = 64 * 1024
+
+# Unacknowledged bytes a connection may have buffered in QUIC before its
+# flows wait for their turn again
+DEFAULT_CONNECTION_BUDGET = 4 * 1024 * 1024
+
+# Samples kept per class for percentiles
+SAMPLES = 10000
+
+
+class ClassStats:
+    """Latency and throughput of one priority class."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.transfers = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.waits: Deque[float] = deque(maxlen=SAMPLES)
+        self.durations: Deque[float] = deque(maxlen=SAMPLES)
+        self._bytes = metrics.registry.counter(f'qvtp_sched_{name}_bytes_total', f'Bytes sent for {name} requests')
+        self._wait = metrics.registry.histogram(f'qvtp_sched_{name}_wait_ms', f'Queueing delay of {name} sends in ms',
+                                                (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000))
+
+    def sent(self, size: int, wait: float) -> None:
+        self.bytes += size
+        self.waits.append(wait)
+        self._bytes.inc(size)
+        self._wait.observe(wait * 1000)
+
+    def finished(self, seconds: float) -> None:
+        self.transfers += 1
+        self.seconds += seconds
+        self.durations.append(seconds)
+
+    @staticmethod
+    def _percentile(samples, fraction: float) -> float:
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 2)
+
+    def summary(self) -> Dict:
+        return {'transfers': self.transfers, 'bytes': self.bytes,
+                'mb_per_s': round(self.bytes / self.seconds / 1e6, 2) if self.seconds else 0.0,
+                'wait_p50_ms': self._percentile(self.waits, 0.5), 'wait_p99_ms': self._percentile(self.waits, 0.99),
+                'transfer_p50_ms': self._percentile(self.durations, 0.5),
+                'transfer_p99_ms': self._percentile(self.durations, 0.99)}
+
+
+class _Flow:
+    __slots__ = ('key', 'connection', 'stats', 'weight', 'deficit', 'pending', 'buffered', 'opened')
+
+    def __init__(self, key, connection, stats: ClassStats, weight: int, buffered: Callable[[], int]) -> None:
+        self.key = key
+        self.connection = connection
+        self.stats = stats
+        self.weight = weight
+        self.deficit = 0
+        # (size, write, future, queued at)
+        self.pending: Deque[tuple] = deque()
+        self.buffered = buffered
+        self.opened = time.monotonic()
+
+
+class SendScheduler:
+    """
+    Deficit round-robin over the sending streams of all connections of
+    this server, so a large download can't starve small ones.
+
+    Handlers submit each send and wait for it to be written. In turn,
+    every flow with something to send gets quantum * weight bytes of
+    credit, by the priority of its request, and writes while its credit
+    covers the next send. A connection whose flows already have budget
+    bytes buffered in QUIC is skipped until ACKs drain it, so what goes
+    into the transport, and so onto the wire, follows the shares.
+    """
+
+    def __init__(self, quantum: int = DEFAULT_QUANTUM, connection_budget: int = DEFAULT_CONNECTION_BUDGET) -> None:
+        self.quantum = quantum
+        self.connection_budget = connection_budget
+        self.classes = {name: ClassStats(name) for name in PRIORITY_WEIGHTS}
+        self._flows: Dict[Hashable, _Flow] = {}
+        self._connections: Dict[Hashable, Set[_Flow]] = {}
+        self._active: Deque[_Flow] = deque()
+        self._budgets: Dict[Hashable, int] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def summary(self) -> Dict:
+        return {name: stats.summary() for name, stats in self.classes.items() if stats.transfers or stats.bytes}
+
+    def open(self, key: Hashable, connection: Hashable, priority: str, buffered: Callable[[], int]) -> None:
+        """Register a sending stream; buffered() tells how much it has in QUIC unacknowledged."""
+        priority = priority if priority in PRIORITY_WEIGHTS else DEFAULT_PRIORITY
+        flow = _Flow(key, connection, self.classes[priority], PRIORITY_WEIGHTS[priority], buffered)
+        self._flows[key] = flow
+        self._connections.setdefault(connection, set()).add(flow)
+
+    def is_open(self, key: Hashable) -> bool:
+        return key in self._flows
+
+    def close(self, key: Hashable, finished: bool = True) -> None:
+        flow = self._flows.pop(key, None)
+        if flow is None:
+            return
+        flows = self._connections.get(flow.connection)
+        if flows is not None:
+            flows.discard(flow)
+            if not flows:
+                del self._connections[flow.connection]
+        if flow in self._active:
+            self._active.remove(flow)
+        for _, _, future, _ in flow.pending:
+            if not future.done():
+                future.set_exception(ConnectionError('Stream closed while sending'))
+        if finished:
+            flow.stats.finished(time.monotonic() - flow.opened)
+
+    def close_connection(self, connection: Hashable) -> None:
+        for flow in list(self._connections.get(connection, ())):
+            self.close(flow.key, finished=False)
+        self._budgets.pop(connection, None)
+
+    async def submit(self, key: Hashable, size: int, write: Callable[[], None]) -> None:
+        """Wait for the flow's turn, then call write()."""
+        flow = self._flows[key]
+        future = asyncio.get_running_loop().create_future()
+        if not flow.pending:
+            self._active.append(flow)
+        flow.pending.append((size, write, future, time.monotonic()))
+        self.poke()
+        await future
+
+    def poke(self) -> None:
+        """Something may be sendable: a send was submitted or a connection drained."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        self._wake.set()
+
+    def drained(self) -> None:
+        """A connection transmitted, so it may have room again; cheap when nobody waits."""
+        if self._active:
+            self._wake.set()
+
+    async def _run(self) -> None:
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            self._dispatch()
+
+    def set_connection_budget(self, connection: Hashable, budget: int) -> None:
+        """A budget for one connection, e.g. for a path with a large bandwidth-delay product."""
+        self._budgets[connection] = max(budget, self.connection_budget)
+        self.drained()
+
+    def _outstanding(self, connection: Hashable) -> int:
+        return sum(flow.buffered() for flow in self._connections.get(connection, ()))
+
+    def _dispatch(self) -> None:
+        blocked = 0
+        while self._active and blocked < len(self._active):
+            flow = self._active[0]
+            size, write, future, queued = flow.pending[0]
+            if self._outstanding(flow.connection) >= self._budgets.get(flow.connection, self.connection_budget):
+                # Its connection is full: skip it until ACKs come in
+                self._active.rotate(-1)
+                blocked += 1
+                continue
+            if flow.deficit < size:
+                flow.deficit += self.quantum * flow.weight
+                self._active.rotate(-1)
+                blocked = 0
+                continue
+            flow.deficit -= size
+            flow.pending.popleft()
+            if not flow.pending:
+                self._active.popleft()
+                # Credit left over carries to the next send, but no more
+                # than a round's worth, so an idle flow can't save up a burst
+                flow.deficit = min(flow.deficit, self.quantum * flow.weight)
+            blocked = 0
+            if future.done():
+                continue
+            try:
+                write()
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            flow.stats.sent(size, time.monotonic() - queued)
+            future.set_result(None)
@@ -0,0 +1,66 @@
+import itertools
+import os
+
+import pytest
+
+from fec import FecCodec
+
+BLOCKS = [os.urandom(64) for _ in range(8)]
+
+
+def drop(codec, lost):
+    """The blocks of a group of BLOCKS and their parity, less those lost, by index."""
+    blocks = dict(enumerate(BLOCKS + codec.encode(BLOCKS)))
+    return {i: block for i, block in blocks.items() if i not in lost}
+
+
+def test_xor_recovers_any_one_lost_block():
+    codec = FecCodec('xor', 8)
+    assert codec.m == 1
+    for lost in range(8):
+        assert codec.recover(8, drop(codec, {lost})) == {lost: BLOCKS[lost]}
+
+
+def test_xor_cannot_recover_two_lost_blocks():
+    codec = FecCodec('xor', 8)
+    assert codec.recover(8, drop(codec, {0, 5})) == {}
+
+
+def test_rs_recovers_any_m_lost_blocks():
+    codec = FecCodec('rs', 8, 3)
+    for count in (1, 2, 3):
+        for lost in itertools.combinations(range(8 + 3), count):
+            recovered = codec.recover(8, drop(codec, set(lost)))
+            assert recovered == {i: BLOCKS[i] for i in lost if i < 8}, lost
+
+
+def test_rs_cannot_recover_more_than_m_lost_blocks():
+    codec = FecCodec('rs', 8, 3)
+    assert codec.recover(8, drop(codec, {0, 1, 2, 3})) == {}
+    assert codec.recover(8, drop(codec, {0, 1, 8, 9})) == {}
+
+
+def test_short_group():
+    codec = FecCodec('rs', 8, 2)
+    blocks = dict(enumerate(BLOCKS[:3] + codec.encode(BLOCKS[:3])))
+    del blocks[0], blocks[2]
+    assert codec.recover(3, blocks) == {0: BLOCKS[0], 2: BLOCKS[2]}
+
+
+def test_nothing_lost_nothing_recovered():
+    codec = FecCodec('rs', 8, 2)
+    assert codec.recover(8, drop(codec, set())) == {}
+
+
+def test_none_adds_no_parity():
+    codec = FecCodec('none', 8, 4)
+    assert codec.m == 0
+    assert codec.encode(BLOCKS) == []
+    assert codec.recover(8, drop(codec, {3})) == {}
+
+
+def test_invalid_codecs_are_refused():
+    with pytest.raises(ValueError):
+        FecCodec('ldpc')
+    with pytest.raises(ValueError):
+        FecCodec('rs', 250, 10)
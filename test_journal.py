@@ -0,0 +1,151 @@
+import asyncio
+import json
+import os
+
+import journal
+from chunk_source import open_preallocated
+from disk_io import WriteBehind
+from journal import TransferJournal
+from reassembly import Reassembler
+
+SIZE = 64 * 1024
+KEY = {'filename': 'clip.mp4', 'filesize': SIZE, 'digest': 'abc'}
+DATA = os.urandom(SIZE)
+
+
+def paths(tmp_path):
+    file_path = str(tmp_path / 'received_clip.mp4')
+    return file_path + '.journal', file_path
+
+
+async def receive(journal_path, file_path, chunks, stop=None):
+    """Receive chunks as an upload does, journaled, until cancelled or done."""
+    saved = TransferJournal.open(journal_path, KEY, file_path)
+    try:
+        with open_preallocated(file_path, SIZE) as f:
+            writer = WriteBehind(f)
+            saved.attach(writer)
+            reassembler = Reassembler(writer, 0, SIZE, saved.received)
+            try:
+                for offset, size in chunks:
+                    await reassembler.write(offset, DATA[offset:offset + size])
+                if stop is not None:
+                    await stop.wait()
+            finally:
+                await saved.finish(writer, SIZE)
+    finally:
+        saved.release()
+
+
+def test_save_and_peek(tmp_path):
+    journal_path, file_path = paths(tmp_path)
+    asyncio.run(receive(journal_path, file_path, [(0, 1000), (5000, 1000)]))
+    saved = TransferJournal.peek(journal_path, file_path)
+    assert saved['key'] == KEY
+    assert saved['ranges'] == [[0, 1000], [5000, 6000]]
+
+
+def test_complete_transfer_discards_journal(tmp_path):
+    journal_path, file_path = paths(tmp_path)
+    asyncio.run(receive(journal_path, file_path, [(0, SIZE)]))
+    assert not os.path.exists(journal_path)
+    with open(file_path, 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_interrupted_transfer_resumes_from_what_was_written(tmp_path):
+    journal_path, file_path = paths(tmp_path)
+
+    async def interrupt():
+        stop = asyncio.Event()
+        task = asyncio.ensure_future(receive(journal_path, file_path, [(0, 20000), (20000, 5000)], stop))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(interrupt())
+    # Nothing of the journal is left open, and it claims only bytes in the file
+    assert journal_path not in journal._open_journals
+    resumed = TransferJournal.open(journal_path, KEY, file_path)
+    try:
+        assert resumed.saved.missing(0, SIZE) == [(25000, SIZE)]
+    finally:
+        resumed.release()
+    with open(file_path, 'rb') as f:
+        assert f.read(25000) == DATA[:25000]
+
+    asyncio.run(receive(journal_path, file_path, [(25000, SIZE - 25000)]))
+    assert not os.path.exists(journal_path)
+    with open(file_path, 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_shared_journal_offers_only_saved_ranges(tmp_path):
+    journal_path, file_path = paths(tmp_path)
+
+    async def share():
+        first = TransferJournal.open(journal_path, KEY, file_path)
+        with open_preallocated(file_path, SIZE) as f:
+            writer = WriteBehind(f)
+            first.attach(writer)
+            reassembler = Reassembler(writer, 0, SIZE, first.received)
+            await reassembler.write(0, DATA[:1000])
+            await first.checkpoint()
+            # Queued for writing, but neither written nor saved yet
+            await reassembler.write(1000, DATA[1000:2000])
+            second = TransferJournal.open(journal_path, KEY, file_path)
+            assert second is first
+            assert second.saved.missing(0, SIZE) == [(1000, SIZE)]
+            second.release()
+            await first.finish(writer, SIZE)
+        first.release()
+
+    asyncio.run(share())
+    assert TransferJournal.peek(journal_path, file_path)['ranges'] == [[0, 2000]]
+
+
+def test_released_journal_is_reloaded_from_disk(tmp_path):
+    journal_path, file_path = paths(tmp_path)
+    asyncio.run(receive(journal_path, file_path, [(0, 1000)]))
+    stale = TransferJournal.open(journal_path, KEY, file_path)
+    stale.received.add(1000, 9000)
+    stale.release()
+    resumed = TransferJournal.open(journal_path, KEY, file_path)
+    try:
+        assert resumed is not stale
+        assert list(resumed.received) == [(0, 1000)]
+    finally:
+        resumed.release()
+
+
+def test_journal_of_another_transfer_is_ignored(tmp_path):
+    journal_path, file_path = paths(tmp_path)
+    asyncio.run(receive(journal_path, file_path, [(0, 1000)]))
+    other = TransferJournal.open(journal_path, dict(KEY, digest='def'), file_path)
+    try:
+        assert list(other.received) == []
+    finally:
+        other.release()
+
+
+def test_journal_of_changed_file_is_discarded(tmp_path):
+    journal_path, file_path = paths(tmp_path)
+    asyncio.run(receive(journal_path, file_path, [(0, 1000)]))
+    with open(file_path, 'r+b') as f:
+        f.truncate(SIZE // 2)
+    assert TransferJournal.peek(journal_path, file_path) is None
+    assert not os.path.exists(journal_path)
+
+
+def test_unreadable_journal_is_ignored(tmp_path):
+    journal_path, file_path = paths(tmp_path)
+    with open(journal_path, 'w') as f:
+        f.write('{not json')
+    assert TransferJournal.peek(journal_path) is None
+    with open(journal_path, 'w') as f:
+        json.dump({'key': KEY, 'ranges': [[0, 10]]}, f)
+    # Saved without the file's state, so it can't be trusted for that file
+    assert TransferJournal.peek(journal_path, file_path) is None
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import random
+
+import pdu
+from fec import FecCodec
+from live import JitterBuffer, LiveSender
+
+PAYLOAD = 1000
+# One packet per ms of the feed
+BITRATE = PAYLOAD * 8 * 1000
+DATA = os.urandom(16 * PAYLOAD - 500)
+
+
+def live_packets(tmp_path, codec):
+    """The datagrams of DATA sent as a live feed, in the order sent."""
+    path = str(tmp_path / 'clip.mp4')
+    with open(path, 'wb') as f:
+        f.write(DATA)
+    sent = []
+    asyncio.run(LiveSender(sent.append, 1, codec, BITRATE, PAYLOAD).send_file(path))
+    return [pdu.LiveDatagram.from_bytes(datagram) for datagram in sent]
+
+
+def data_packet(packets, sequence):
+    return next(p for p in packets if p.kind == pdu.LIVE_DATA and p.sequence == sequence)
+
+
+def played(released):
+    return b''.join(payload for _, payload in released)
+
+
+def test_packets_are_played_in_order(tmp_path):
+    codec = FecCodec('xor', 4)
+    packets = live_packets(tmp_path, codec)
+    assert sum(p.kind == pdu.LIVE_PARITY for p in packets) == 4
+    random.Random(1).shuffle(packets)
+    buffer = JitterBuffer(codec, 0.05)
+    for packet in packets:
+        buffer.add(packet, 0)
+    released = buffer.pop_due(1)
+    assert [sequence for sequence, _ in released] == list(range(16))
+    assert played(released) == DATA
+    assert buffer.stats()['lost'] == 0
+
+
+def test_xor_rebuilds_one_lost_packet_per_group(tmp_path):
+    codec = FecCodec('xor', 4)
+    packets = live_packets(tmp_path, codec)
+    lost = {data_packet(packets, sequence) for sequence in (1, 6, 15)}
+    buffer = JitterBuffer(codec, 0.05)
+    for packet in packets:
+        if packet not in lost:
+            buffer.add(packet, 0)
+    assert played(buffer.pop_due(1)) == DATA
+    assert buffer.stats()['recovered'] == 3
+
+
+def test_rs_rebuilds_k_of_n(tmp_path):
+    codec = FecCodec('rs', 4, 2)
+    packets = live_packets(tmp_path, codec)
+    # Any 4 of each group's 6 packets will do, parity or not
+    rng = random.Random(2)
+    groups = {}
+    for packet in packets:
+        first = packet.sequence if packet.kind == pdu.LIVE_PARITY else packet.sequence - packet.index
+        groups.setdefault(first, []).append(packet)
+    buffer = JitterBuffer(codec, 0.05)
+    for group in groups.values():
+        assert len(group) == 6
+        for packet in rng.sample(group, 4):
+            buffer.add(packet, 0)
+    assert played(buffer.pop_due(1)) == DATA
+
+
+def test_packets_wait_until_due_and_gaps_until_the_next_is_due(tmp_path):
+    codec = FecCodec('none')
+    packets = live_packets(tmp_path, codec)
+    buffer = JitterBuffer(codec, 0.05)
+    buffer.add(data_packet(packets, 0), 0)
+    assert buffer.pop_due(0.04) == []
+    assert buffer.pop_due(0.0505) == [(0, DATA[:PAYLOAD])]
+    # Packet 1 is lost; packet 2 is due 2 ms into the feed
+    buffer.add(data_packet(packets, 2), 0.003)
+    assert buffer.pop_due(0.0515) == []
+    assert buffer.pop_due(0.0525) == [(1, None), (2, DATA[2 * PAYLOAD:3 * PAYLOAD])]
+    assert buffer.next_seq == 3
+    # Too late to play
+    buffer.add(data_packet(packets, 1), 0.06)
+    assert buffer.pop_due(1) == []
+    assert buffer.stats()['lost'] == 1
+    assert buffer.stats()['late'] == 1
+    assert buffer.stats()['max_jitter_ms'] == 1.0
+
+
+def test_duplicates_are_played_once(tmp_path):
+    codec = FecCodec('none')
+    packets = live_packets(tmp_path, codec)
+    buffer = JitterBuffer(codec, 0.05)
+    for packet in packets + packets[:5]:
+        buffer.add(packet, 0)
+    assert played(buffer.pop_due(1)) == DATA
+    assert buffer.stats()['received'] == 16
+
+
+def test_finish_releases_the_rest(tmp_path):
+    codec = FecCodec('none')
+    packets = live_packets(tmp_path, codec)
+    buffer = JitterBuffer(codec, 10)
+    for packet in packets[:10]:
+        if packet.sequence != 5:
+            buffer.add(packet, 0)
+    released = buffer.finish(16)
+    assert [sequence for sequence, _ in released] == list(range(16))
+    assert [sequence for sequence, payload in released if payload is None] == [5, 10, 11, 12, 13, 14, 15]
+    assert buffer.stats()['lost'] == 7
@@ -0,0 +1,89 @@
+import pytest
+
+import pdu
+
+
+def datagrams():
+    return [
+        pdu.Datagram(pdu.MSG_TYPE_REQUEST, "", filename='clip.mp4', options={'checksum': ['crc32']}),
+        pdu.Datagram(pdu.MSG_TYPE_DATA, "", sequence_num=1, data=b'a' * 5000, offset=0),
+        pdu.Datagram(pdu.MSG_TYPE_DATA, "", sequence_num=2, data=b'', offset=5000),
+        pdu.Datagram(pdu.MSG_TYPE_ACK, "Upload complete"),
+    ]
+
+
+def frame(datagram):
+    encoded = datagram.to_bytes()
+    return pdu.FRAME_PREFIX.pack(len(encoded)) + bytes(encoded)
+
+
+def decoded(frames):
+    return [(d.mtype, d.msg, d.filename, d.sequence_num, d.offset, bytes(d.data), d.options)
+            for d in map(pdu.Datagram.from_bytes, frames)]
+
+
+def expected():
+    return [(d.mtype, d.msg, d.filename, d.sequence_num, d.offset, bytes(d.data), d.options) for d in datagrams()]
+
+
+def test_several_frames_in_one_read():
+    stream = b''.join(map(frame, datagrams()))
+    decoder = pdu.FrameDecoder()
+    assert decoded(decoder.feed(stream)) == expected()
+    assert len(decoder) == 0
+
+
+def test_frames_split_at_every_byte():
+    stream = b''.join(map(frame, datagrams()))
+    decoder = pdu.FrameDecoder()
+    frames = []
+    for i in range(len(stream)):
+        frames.extend(decoder.feed(stream[i:i + 1]))
+    assert decoded(frames) == expected()
+    assert len(decoder) == 0
+
+
+def test_split_prefix_waits_for_the_rest():
+    stream = frame(datagrams()[3])
+    decoder = pdu.FrameDecoder()
+    assert decoder.feed(stream[:2]) == []
+    assert decoder.feed(stream[2:pdu.FRAME_PREFIX.size + 1]) == []
+    assert len(decoder) == 1
+    assert decoded(decoder.feed(stream[pdu.FRAME_PREFIX.size + 1:])) == expected()[3:]
+
+
+def test_frame_and_a_half():
+    first, second = frame(datagrams()[1]), frame(datagrams()[3])
+    decoder = pdu.FrameDecoder()
+    assert decoded(decoder.feed(first + second[:7])) == expected()[1:2]
+    assert len(decoder) == 7 - pdu.FRAME_PREFIX.size
+    assert decoded(decoder.feed(second[7:])) == expected()[3:]
+
+
+def test_encode_batch_round_trip():
+    buffer = bytearray(1024 * 1024)
+    batch = pdu.encode_batch(datagrams(), buffer)
+    assert batch.obj is buffer
+    assert bytes(batch) == b''.join(map(frame, datagrams()))
+    assert decoded(pdu.FrameDecoder().feed(batch)) == expected()
+
+
+def test_encode_batch_grows_a_small_buffer():
+    batch = pdu.encode_batch(datagrams(), bytearray(16))
+    assert decoded(pdu.FrameDecoder().feed(batch)) == expected()
+
+
+def test_largest_frame_is_accepted():
+    decoder = pdu.FrameDecoder()
+    assert decoder.feed(pdu.FRAME_PREFIX.pack(pdu.MAX_FRAME_SIZE)) == []
+    assert len(decoder.feed(bytes(pdu.MAX_FRAME_SIZE))[0]) == pdu.MAX_FRAME_SIZE
+
+
+def test_oversize_length_is_refused():
+    decoder = pdu.FrameDecoder()
+    with pytest.raises(ValueError):
+        decoder.feed(pdu.FRAME_PREFIX.pack(pdu.MAX_FRAME_SIZE + 1) + b'x' * 100)
+    decoder = pdu.FrameDecoder()
+    assert len(decoder.feed(frame(datagrams()[3]))) == 1
+    with pytest.raises(ValueError):
+        decoder.feed(b'\xff' * pdu.FRAME_PREFIX.size)
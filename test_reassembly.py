@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import os
+
+from chunk_source import open_preallocated
+from disk_io import WriteBehind
+from reassembly import RangeSet, Reassembler
+
+SIZE = 10000
+DATA = os.urandom(SIZE)
+
+
+def test_ranges_merge_when_they_overlap_or_touch():
+    ranges = RangeSet()
+    ranges.add(100, 200)
+    ranges.add(300, 400)
+    ranges.add(0, 50)
+    assert list(ranges) == [(0, 50), (100, 200), (300, 400)]
+    ranges.add(200, 300)
+    assert list(ranges) == [(0, 50), (100, 400)]
+    ranges.add(40, 120)
+    assert list(ranges) == [(0, 400)]
+    ranges.add(500, 600)
+    ranges.add(450, 700)
+    assert list(ranges) == [(0, 400), (450, 700)]
+    assert ranges.total() == 650
+
+
+def test_empty_and_repeated_ranges_change_nothing():
+    ranges = RangeSet([(0, 100)])
+    ranges.add(50, 50)
+    ranges.add(80, 10)
+    ranges.add(10, 90)
+    ranges.add(0, 100)
+    assert list(ranges) == [(0, 100)]
+
+
+def test_end_of_and_covers():
+    ranges = RangeSet([(0, 100), (200, 300)])
+    assert ranges.end_of(0) == 100
+    assert ranges.end_of(50) == 100
+    assert ranges.end_of(150) == 150
+    assert ranges.end_of(250) == 300
+    assert ranges.covers(0, 100)
+    assert ranges.covers(210, 300)
+    assert not ranges.covers(50, 250)
+    assert not ranges.covers(100, 101)
+    assert not RangeSet().covers(0, 1)
+
+
+def test_missing():
+    ranges = RangeSet([(100, 200), (300, 400)])
+    assert ranges.missing(0, 500) == [(0, 100), (200, 300), (400, 500)]
+    assert ranges.missing(150, 350) == [(200, 300)]
+    assert ranges.missing(100, 200) == []
+    assert ranges.missing(210, 290) == [(210, 290)]
+    assert RangeSet().missing(0, 10) == [(0, 10)]
+
+
+async def reassemble(path, chunks, start=0, length=SIZE, received=None):
+    """Write chunks through a Reassembler; what it kept, its state and its digest."""
+    with open_preallocated(path, SIZE) as f:
+        writer = WriteBehind(f)
+        reassembler = Reassembler(writer, start, length, received)
+        try:
+            accepted = [await reassembler.write(offset, DATA[offset:offset + size]) for offset, size in chunks]
+            digest = await reassembler.digest('sha256')
+        finally:
+            await writer.close()
+    return accepted, reassembler, digest
+
+
+def test_out_of_order_chunks_are_placed_at_their_offsets(tmp_path):
+    path = str(tmp_path / 'clip.mp4')
+    chunks = [(6000, 4000), (0, 3000), (3000, 3000), (1000, 1000)]
+    accepted, reassembler, digest = asyncio.run(reassemble(path, chunks))
+    assert accepted == [True] * 4
+    assert reassembler.complete
+    assert not reassembler.in_order
+    assert digest == hashlib.sha256(DATA).digest()
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_in_order_chunks(tmp_path):
+    chunks = [(offset, 1000) for offset in range(0, SIZE, 1000)]
+    _, reassembler, _ = asyncio.run(reassemble(str(tmp_path / 'clip.mp4'), chunks))
+    assert reassembler.in_order
+    assert reassembler.complete
+
+
+def test_chunks_outside_the_range_are_refused(tmp_path):
+    chunks = [(1000, 2000), (0, 1000), (500, 1000), (3000, 1000), (3500, 1000), (4000, 1000)]
+    accepted, reassembler, _ = asyncio.run(reassemble(str(tmp_path / 'clip.mp4'), chunks, 1000, 3000))
+    assert accepted == [True, False, False, True, False, False]
+    assert reassembler.missing() == []
+    assert reassembler.complete
+
+
+def test_incomplete_transfer_reports_what_is_missing(tmp_path):
+    chunks = [(0, 2000), (5000, 1000)]
+    _, reassembler, _ = asyncio.run(reassemble(str(tmp_path / 'clip.mp4'), chunks))
+    assert not reassembler.complete
+    assert reassembler.missing() == [(2000, 5000), (6000, SIZE)]
+
+
+def test_resumed_transfer_completes_what_was_received(tmp_path):
+    path = str(tmp_path / 'clip.mp4')
+    with open(path, 'wb') as f:
+        f.write(DATA[:4000])
+    received = RangeSet([(0, 4000)])
+    _, reassembler, digest = asyncio.run(reassemble(path, [(4000, SIZE - 4000)], received=received))
+    # Part of the file was never seen, so no digest in arrival order covers it
+    assert not reassembler.in_order
+    assert reassembler.complete
+    assert received is reassembler.received
+    assert digest == hashlib.sha256(DATA).digest()
+
+
+def test_empty_range_is_complete(tmp_path):
+    _, reassembler, _ = asyncio.run(reassemble(str(tmp_path / 'clip.mp4'), [], 0, 0))
+    assert reassembler.complete
+    assert reassembler.missing() == []
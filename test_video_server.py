@@ -0,0 +1,21 @@
+import pdu
+from video_server import MAX_PARTS, negotiate_options, requested_part
+
+
+def request(**options):
+    return pdu.Datagram(pdu.MSG_TYPE_REQUEST, "", filename='clip.mp4', options=options)
+
+
+def test_whole_file_is_one_part():
+    assert requested_part(request()) == (0, 1)
+    assert negotiate_options(request(), 1000, None)['range'] == [0, 1000]
+
+
+def test_parts_split_the_file():
+    ranges = [negotiate_options(request(part=[part, 3]), 1000, None)['range'] for part in range(3)]
+    assert ranges == [[0, 333], [333, 333], [666, 334]]
+
+
+def test_invalid_parts_are_refused():
+    for part in ([0, 0], [-1, 2], [2, 2], [0, MAX_PARTS + 1], [0], [0, 1, 2], '0/1', [0.5, 2], [True, 2], None):
+        assert requested_part(request(part=part)) is None, part
@@ -0,0 +1,283 @@
+import asyncio
+import base64
+import datetime
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from aioquic.tls import CipherSuite, SessionTicket
+
+DEFAULT_MAX_TICKETS = 10000
+DEFAULT_TICKET_TTL = 24 * 60 * 60
+
+# How long a changed store may go unsaved
+SAVE_DELAY = 1.0
+
+# Age after which a half-written or claimed ticket file is garbage
+STALE_AFTER = 60.0
+
+
+# Tickets are saved as JSON, never pickled: a ticket directory may be
+# shared, and loading a pickle anyone could write would run their code
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+
+def _unb64(text: str) -> bytes:
+    return base64.b64decode(text.encode('ascii'), validate=True)
+
+
+def ticket_to_json(ticket: SessionTicket) -> Dict:
+    return {
+        'age_add': ticket.age_add,
+        'cipher_suite': int(ticket.cipher_suite),
+        'not_valid_after': ticket.not_valid_after.isoformat(),
+        'not_valid_before': ticket.not_valid_before.isoformat(),
+        'resumption_secret': _b64(ticket.resumption_secret),
+        'server_name': ticket.server_name,
+        'ticket': _b64(ticket.ticket),
+        'max_early_data_size': ticket.max_early_data_size,
+        'other_extensions': [[kind, _b64(data)] for kind, data in ticket.other_extensions],
+    }
+
+
+def ticket_from_json(fields: Dict) -> SessionTicket:
+    """Raises ValueError, KeyError or TypeError if fields isn't a ticket."""
+    max_early_data_size = fields['max_early_data_size']
+    return SessionTicket(
+        age_add=int(fields['age_add']),
+        cipher_suite=CipherSuite(fields['cipher_suite']),
+        not_valid_after=datetime.datetime.fromisoformat(fields['not_valid_after']),
+        not_valid_before=datetime.datetime.fromisoformat(fields['not_valid_before']),
+        resumption_secret=_unb64(fields['resumption_secret']),
+        server_name=str(fields['server_name']),
+        ticket=_unb64(fields['ticket']),
+        max_early_data_size=int(max_early_data_size) if max_early_data_size is not None else None,
+        other_extensions=[(int(kind), _unb64(data)) for kind, data in fields['other_extensions']],
+    )
+
+
+def _save(path: str, entries) -> None:
+    # Tickets hold resumption secrets, so only their owner may read them
+    tmp_path = path + '.tmp'
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, path)
+
+
+def _load(path: Optional[str], decode):
+    """What decode makes of the JSON saved at path, or None if that is missing or malformed."""
+    if not path:
+        return None
+    try:
+        with open(path, 'r') as f:
+            return decode(json.load(f))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def _decode_entry(entry) -> Tuple[SessionTicket, float]:
+    # A server ticket and when it expires
+    return ticket_from_json(entry['ticket']), float(entry['expires'])
+
+
+def _encode_entry(ticket: SessionTicket, expires: float) -> Dict:
+    return {'ticket': ticket_to_json(ticket), 'expires': expires}
+
+
+class SessionTicketStore:
+    """
+    Session tickets issued by the server, so that a returning client can
+    resume its TLS session (and send 0-RTT data) instead of doing a full
+    handshake.
+
+    Holds at most max_tickets, oldest evicted first, each for at most ttl
+    seconds. Tickets are single use: pop() removes the ticket, so early
+    data sent with it cannot be replayed against this store. With a path
+    the store is saved shortly after each change and loaded on start, so
+    tickets survive a restart.
+    """
+
+    def __init__(self, max_tickets: int = DEFAULT_MAX_TICKETS, ttl: float = DEFAULT_TICKET_TTL,
+                 path: Optional[str] = None) -> None:
+        self.max_tickets = max_tickets
+        self.ttl = ttl
+        self.path = path
+        self.issued = 0
+        self.resumed = 0
+        self.expired = 0
+        # label -> (ticket, expiry as time.time())
+        loaded = _load(path, lambda entries: [_decode_entry(entry) for entry in entries])
+        self.tickets: OrderedDict[bytes, Tuple[SessionTicket, float]] = OrderedDict(
+            (ticket.ticket, (ticket, expires)) for ticket, expires in loaded or ())
+        self._save_pending = False
+        self._evict_expired()
+
+    def add(self, ticket: SessionTicket) -> None:
+        expires = min(time.time() + self.ttl, ticket.not_valid_after.timestamp())
+        self.tickets[ticket.ticket] = (ticket, expires)
+        self.issued += 1
+        self._evict_expired()
+        while len(self.tickets) > self.max_tickets:
+            self.tickets.popitem(last=False)
+        self._changed()
+
+    def pop(self, label: bytes) -> Optional[SessionTicket]:
+        entry = self.tickets.pop(label, None)
+        if entry is None:
+            return None
+        self._changed()
+        ticket, expires = entry
+        if expires < time.time():
+            self.expired += 1
+            return None
+        self.resumed += 1
+        return ticket
+
+    def stats(self) -> dict:
+        return {'tickets': len(self.tickets), 'issued': self.issued, 'resumed': self.resumed, 'expired': self.expired}
+
+    def _evict_expired(self) -> None:
+        # Tickets are added in expiry order unless the TTL changed, so the
+        # oldest ones are at the front
+        now = time.time()
+        while self.tickets:
+            label, (_, expires) = next(iter(self.tickets.items()))
+            if expires >= now:
+                break
+            del self.tickets[label]
+            self.expired += 1
+
+    def _changed(self) -> None:
+        if not self.path or self._save_pending:
+            return
+        self._save_pending = True
+        try:
+            asyncio.get_running_loop().call_later(SAVE_DELAY, self.save)
+        except RuntimeError:
+            self.save()
+
+    def save(self) -> None:
+        self._save_pending = False
+        if self.path:
+            _save(self.path, [_encode_entry(ticket, expires) for ticket, expires in self.tickets.values()])
+
+
+class ClientTicketCache:
+    """
+    Session tickets the client has received, by server name, so the next
+    connection to that server resumes the session and can send its REQUEST
+    as 0-RTT early data. Each ticket is used once (the server only accepts
+    it once); with a path the cache persists between runs.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        loaded = _load(path, lambda entries: [ticket_from_json(entry) for entry in entries])
+        self.tickets: Dict[str, SessionTicket] = {ticket.server_name: ticket for ticket in loaded or ()}
+
+    def take(self, server_name: str) -> Optional[SessionTicket]:
+        ticket = self.tickets.pop(server_name, None)
+        if ticket is not None:
+            self.save()
+        if ticket is not None and ticket.is_valid:
+            return ticket
+        return None
+
+    def add(self, ticket: SessionTicket) -> None:
+        self.tickets[ticket.server_name] = ticket
+        self.save()
+
+    def save(self) -> None:
+        if self.path:
+            _save(self.path, [ticket_to_json(ticket) for ticket in self.tickets.values()])
+
+
+class SharedTicketStore:
+    """
+    Session ticket store shared by the worker processes of one server, so a
+    client resumes whichever worker its next connection lands on.
+
+    Each ticket is a file in directory, named after its label. pop() claims
+    a ticket by renaming its file, which only one process can do, so tickets
+    stay single use without any locking. Expired tickets, and the oldest
+    ones beyond max_tickets, are swept out every sweep_every additions.
+    """
+
+    def __init__(self, directory: str, max_tickets: int = DEFAULT_MAX_TICKETS, ttl: float = DEFAULT_TICKET_TTL,
+                 sweep_every: int = 100) -> None:
+        self.directory = directory
+        self.max_tickets = max_tickets
+        self.ttl = ttl
+        self.sweep_every = sweep_every
+        self.issued = 0
+        self.resumed = 0
+        self.expired = 0
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._sweep()
+
+    def _path(self, label: bytes) -> str:
+        return os.path.join(self.directory, label.hex() + '.ticket')
+
+    def add(self, ticket: SessionTicket) -> None:
+        expires = min(time.time() + self.ttl, ticket.not_valid_after.timestamp())
+        _save(self._path(ticket.ticket), _encode_entry(ticket, expires))
+        self.issued += 1
+        if self.issued % self.sweep_every == 0:
+            self._sweep()
+
+    def pop(self, label: bytes) -> Optional[SessionTicket]:
+        path = self._path(label)
+        claimed = f'{path}.{os.getpid()}'
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            return None
+        entry = _load(claimed, _decode_entry)
+        try:
+            os.remove(claimed)
+        except OSError:
+            pass
+        if entry is None:
+            return None
+        ticket, expires = entry
+        if expires < time.time():
+            self.expired += 1
+            return None
+        self.resumed += 1
+        return ticket
+
+    def stats(self) -> dict:
+        return {'issued': self.issued, 'resumed': self.resumed, 'expired': self.expired}
+
+    def _sweep(self) -> None:
+        now = time.time()
+        tickets = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if not entry.name.endswith('.ticket'):
+                    # A claim or save left behind by a worker that died mid-way
+                    if mtime < now - STALE_AFTER:
+                        self._remove(entry.path)
+                elif mtime < now - self.ttl:
+                    self._remove(entry.path)
+                    self.expired += 1
+                else:
+                    tickets.append((mtime, entry.path))
+        tickets.sort()
+        for _, path in tickets[:max(0, len(tickets) - self.max_tickets)]:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
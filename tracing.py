@@ -0,0 +1,131 @@
+import json
+import os
+from typing import Dict, Optional
+
+from aioquic.quic.logger import QuicLogger, QuicLoggerTrace, QLOG_VERSION
+
+import pdu
+
+# Phases of a transfer in the order they normally happen. ack is the ACK
+# PDU of an upload, or for anything else the first FIN sent or received.
+PHASES = ('handshake', 'request', 'response', 'first_data', 'last_data', 'ack')
+
+# What a stream's time went on between its first and last DATA:
+#   stream_window, connection_window  the sender waited for the peer's flow-control credit
+#   congestion                        the sender waited for the congestion window (or ACKs)
+#   scheduler                         the sender waited for its turn (see scheduler.SendScheduler)
+#   peer                              the receiver waited for the next PDU to arrive
+#   local                             our own code between PDUs, e.g. disk reads and writes
+STALLS = ('stream_window', 'connection_window', 'congestion', 'scheduler', 'peer', 'local')
+
+# Message type of each PDU that starts a phase, on whichever side sees it
+PHASE_OF_TYPE = {pdu.MSG_TYPE_REQUEST: 'request', pdu.MSG_TYPE_RESPONSE: 'response', pdu.MSG_TYPE_ACK: 'ack'}
+
+
+class QlogWriter(QuicLogger):
+    """
+    As aioquic's QuicFileLogger, one qlog file per connection, written when
+    it ends; files are named by side too, so a client and a server can
+    share a directory.
+    """
+
+    def __init__(self, directory: str) -> None:
+        super().__init__()
+        self.directory = directory
+
+    def end_trace(self, trace: QuicLoggerTrace) -> None:
+        trace_dict = trace.to_dict()
+        path = os.path.join(self.directory, '{}_{}.qlog'.format(
+            trace_dict['common_fields']['ODCID'], trace_dict['vantage_point']['type']))
+        with open(path, 'w') as f:
+            json.dump({'qlog_format': 'JSON', 'qlog_version': QLOG_VERSION, 'traces': [trace_dict]}, f)
+        self._traces.remove(trace)
+
+
+class TransferTrace:
+    """
+    When one stream reached each phase, in seconds from the start of its
+    connection, and what it stalled on. Filled in by the stream's handler
+    as PDUs go through it.
+    """
+    __slots__ = ('connection', 'stream_id', 'started', 'phases', 'stalls', 'stall_counts',
+                 'blocked_at', 'blocked_on', 'idle_from', 'finished')
+
+    def __init__(self, connection: str, stream_id: int, started: float) -> None:
+        self.connection = connection
+        self.stream_id = stream_id
+        self.started = started
+        self.phases: Dict[str, float] = {}
+        self.stalls: Dict[str, float] = dict.fromkeys(STALLS, 0.0)
+        self.stall_counts: Dict[str, int] = dict.fromkeys(STALLS, 0)
+        # Since when the sender is blocked and on what (last seen), or since
+        # when the handler is off doing its own work
+        self.blocked_at: Optional[float] = None
+        self.blocked_on: Optional[str] = None
+        self.idle_from: Optional[float] = None
+        self.finished = False
+
+    def mark(self, phase: str, now: float) -> None:
+        # The first time counts, except for the last DATA
+        if phase not in self.phases or phase == 'last_data':
+            self.phases[phase] = now - self.started
+
+    def message(self, data, now: float, framed: bool = False) -> None:
+        """Note the phase a PDU sent or received starts, if any."""
+        if not data:
+            return
+        mtype = pdu.MTYPE.unpack_from(data, pdu.FRAME_PREFIX.size if framed else 0)[0]
+        if mtype == pdu.MSG_TYPE_DATA:
+            self.mark('first_data', now)
+            self.mark('last_data', now)
+        elif mtype in PHASE_OF_TYPE:
+            self.mark(PHASE_OF_TYPE[mtype], now)
+
+    def stall(self, kind: str, seconds: float, new: bool = True) -> None:
+        self.stalls[kind] += seconds
+        if new:
+            self.stall_counts[kind] += 1
+
+    def blocked(self, kind: str, now: float) -> None:
+        """The sender is still blocked, now on kind; the time since the last look goes to it."""
+        self.stall(kind, now - self.blocked_at, new=kind != self.blocked_on)
+        self.blocked_at, self.blocked_on = now, kind
+
+    def in_transfer(self) -> bool:
+        return 'first_data' in self.phases
+
+    def record(self, handshake: Optional[float]) -> Dict:
+        record = {'connection': self.connection, 'stream': self.stream_id}
+        if handshake is not None:
+            self.phases.setdefault('handshake', handshake - self.started)
+        if 'fin' in self.phases:
+            self.phases.setdefault('ack', self.phases['fin'])
+        for phase in PHASES:
+            record[phase + '_ms'] = round(self.phases[phase] * 1000, 2) if phase in self.phases else None
+        record['stalls'] = {kind: {'ms': round(self.stalls[kind] * 1000, 2), 'count': self.stall_counts[kind]}
+                            for kind in STALLS if self.stall_counts[kind]}
+        return record
+
+
+class Tracer:
+    """
+    Opt-in tracing of connections into a directory: an aioquic qlog file
+    per connection (see QlogWriter), and a timing record per transfer
+    appended to transfers-<pid>.jsonl and printed. Handlers only consult
+    it when scope['tracer'] is set, so leaving it off costs nothing.
+    """
+
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.quic_logger = QlogWriter(directory)
+        self._records = open(os.path.join(directory, f'transfers-{os.getpid()}.jsonl'), 'a')
+
+    def finish(self, trace: TransferTrace, handshake: Optional[float], prefix: str) -> None:
+        if trace.finished:
+            return
+        trace.finished = True
+        record = trace.record(handshake)
+        self._records.write(json.dumps(record) + '\n')
+        self._records.flush()
+        print(f'{prefix} Transfer timing: {record}')
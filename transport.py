@@ -0,0 +1,132 @@
+import time
+from typing import Dict, Optional
+
+from aioquic.quic.configuration import QuicConfiguration
+
+MIB = 1024 * 1024
+
+
+class TransportProfile:
+    """
+    QUIC settings for a kind of path. Windows are per stream and per
+    connection, for what we receive (see flow_control.ReceiveCredit) and
+    what a stream may have sent but unacknowledged (send_buffer); to
+    keep a path full both must be at least its bandwidth-delay product.
+    An auto profile starts from these and grows them (see AutoTuner).
+    """
+
+    def __init__(self, name: str, stream_window: int, connection_window: int, send_buffer: int,
+                 congestion: str = 'cubic', max_datagram_size: int = 1200, initial_rtt: float = 0.1,
+                 idle_timeout: float = 60.0, auto: bool = False, max_window: Optional[int] = None) -> None:
+        self.name = name
+        self.stream_window = stream_window
+        self.connection_window = connection_window
+        self.send_buffer = send_buffer
+        self.congestion = congestion
+        self.max_datagram_size = max_datagram_size
+        self.initial_rtt = initial_rtt
+        self.idle_timeout = idle_timeout
+        self.auto = auto
+        self.max_window = max_window or stream_window
+
+    def configure(self, configuration: QuicConfiguration) -> QuicConfiguration:
+        # The windows we start with; ReceiveCredit raises them as data is consumed
+        configuration.max_stream_data = self.stream_window
+        configuration.max_data = self.connection_window
+        configuration.congestion_control_algorithm = self.congestion
+        configuration.max_datagram_size = self.max_datagram_size
+        configuration.initial_rtt = self.initial_rtt
+        configuration.idle_timeout = self.idle_timeout
+        return configuration
+
+    def describe(self) -> Dict:
+        return {'profile': self.name, 'stream_window': self.stream_window, 'connection_window': self.connection_window,
+                'send_buffer': self.send_buffer, 'congestion': self.congestion,
+                'max_datagram_size': self.max_datagram_size, 'idle_timeout': self.idle_timeout}
+
+
+PROFILES = {
+    # Sub-millisecond RTT and no loss to speak of: small windows do, and
+    # full Ethernet-sized packets are safe
+    'lan': TransportProfile('lan', 4 * MIB, 16 * MIB, 2 * MIB, 'reno', 1452, 0.01, 30.0),
+    # Tens of ms across the Internet, at the usual safe packet size
+    'wan': TransportProfile('wan', 8 * MIB, 32 * MIB, 4 * MIB, 'cubic', 1200, 0.1, 60.0),
+    # Long fat pipes, e.g. 1 Gbit/s at 250 ms needs about 30 MiB in flight
+    'high-bdp': TransportProfile('high-bdp', 32 * MIB, 128 * MIB, 32 * MIB, 'cubic', 1200, 0.3, 120.0),
+    # Wireless and congested links: CUBIC gets back to speed faster after
+    # each loss than Reno, and a long idle timeout rides out outages
+    'lossy': TransportProfile('lossy', 4 * MIB, 16 * MIB, 2 * MIB, 'cubic', 1200, 0.2, 120.0),
+    # Starts as wan and follows the measured bandwidth-delay product
+    'auto': TransportProfile('auto', 8 * MIB, 32 * MIB, 4 * MIB, 'cubic', 1200, 0.1, 60.0, auto=True,
+                             max_window=64 * MIB),
+}
+DEFAULT_PROFILE = 'auto'
+
+# How many RTTs, and at least how long, each measurement of an auto profile spans
+SAMPLE_RTTS = 4
+MIN_SAMPLE_TIME = 0.1
+
+
+class AutoTuner:
+    """
+    Grows one connection's windows to its bandwidth-delay product.
+
+    Every few RTTs it measures how many bytes the connection moved (sent
+    or handed to the application) and the smoothed RTT. Moving at least
+    half a window per RTT means the window is what limits the
+    connection, as a window can't move more than itself per RTT, so it
+    doubles, or goes straight to twice the measured BDP, up to the
+    profile's max_window. A congestion-limited or idle connection stays
+    as it is. Windows are never shrunk.
+    """
+
+    def __init__(self, protocol, profile: TransportProfile) -> None:
+        self.protocol = protocol
+        self.profile = profile
+        self._started: Optional[float] = None
+        self._moved = 0
+
+    def sample(self, now: Optional[float] = None) -> None:
+        """Called on every transmit; cheap unless a measurement is due."""
+        now = time.monotonic() if now is None else now
+        rtt = self.protocol.internals.smoothed_rtt()
+        if rtt is None:
+            return
+        moved = self.protocol.bytes_in + self.protocol.bytes_out
+        if self._started is None:
+            self._started, self._moved = now, moved
+            return
+        rtt = max(rtt, 0.001)
+        elapsed = now - self._started
+        if elapsed < max(SAMPLE_RTTS * rtt, MIN_SAMPLE_TIME):
+            return
+        bdp = int((moved - self._moved) / elapsed * rtt)
+        self._started, self._moved = now, moved
+        if self._grow(bdp):
+            prefix = '[cli]' if self.protocol.is_client() else '[svr]'
+            credit = self.protocol.receive_credit
+            print(f'{prefix} Transport auto-tuned for RTT {rtt * 1000:.1f} ms, BDP {bdp} bytes: '
+                  f'stream window {credit.stream_budget}, connection window {credit.connection_budget}, '
+                  f'send buffer {self.protocol.send_buffer}')
+
+    def _grow(self, bdp: int) -> bool:
+        limit = self.profile.max_window
+        credit = self.protocol.receive_credit
+        grown = False
+        # The BDP is of the whole connection, so a stream window sized to it
+        # is generous when several streams share the connection
+        if bdp * 2 >= credit.stream_budget and credit.stream_budget < limit:
+            # Streams opened from now on get it too, but only through
+            # ReceiveCredit's first MAX_STREAM_DATA: they start with the window
+            # of the handshake's transport parameters, which the peer goes by
+            credit.stream_budget = min(limit, max(credit.stream_budget * 2, bdp * 2))
+            grown = True
+        if bdp * 2 >= credit.connection_budget and credit.connection_budget < limit * 4:
+            credit.connection_budget = min(limit * 4, max(credit.connection_budget * 2, bdp * 2))
+            grown = True
+        # and one stream alone must still be able to use its whole window
+        credit.connection_budget = max(credit.connection_budget, credit.stream_budget)
+        if bdp * 2 >= self.protocol.send_buffer and self.protocol.send_buffer < limit:
+            self.protocol.set_send_buffer(min(limit, max(self.protocol.send_buffer * 2, bdp * 2)))
+            grown = True
+        return grown
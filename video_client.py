@@ -1,8 +1,31 @@
 import asyncio
+import glob
+import logging
 import os
-from typing import Dict
+import random
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 from common import EchoQuicConnection, QuicStreamEvent
 import pdu
+from chunk_source import ChunkSizer, ChunkSource, file_digest, open_preallocated, part_range, resized_chunks
+from reassembly import RangeSet, Reassembler
+from journal import TransferJournal, discard as discard_journal
+from disk_io import FSYNC_NONE, WriteBehind, get_pool
+import metrics
+import dedup
+import live
+from fec import FecCodec
+
+log = logging.getLogger(__name__)
+
+# Files a batch transfers at once
+DEFAULT_CONCURRENCY = 4
+
+# Entries per MANIFEST PDU of a dedup upload
+MANIFEST_BATCH = 4096
+
+# How often a live stream's jitter buffer is checked for packets due to play
+LIVE_TICK = 0.005
 
 class EchoClientRequestHandler:
     def __init__(self, connection):
@@ -14,86 +37,492 @@ class EchoClientRequestHandler:
         else:
             await upload_video({}, self.connection, video_path)
 
-async def upload_video(scope: Dict, conn: EchoQuicConnection, filepath: str):
+def request_options(scope: Dict) -> Dict:
+    # Offer the checksums we can compute, in the caller's order of preference
+    supported = pdu.supported_checksums()
+    options = {'checksum': [name for name in scope.get('checksums', pdu.DEFAULT_CHECKSUMS) if name in supported]}
+    if scope.get('digest'):
+        options['digest'] = scope['digest']
+    # The server picks the chunk size; a download's chunks have to fit our receive window
+    if scope.get('window'):
+        options['window'] = scope['window']
+    if scope.get('chunk_size'):
+        options['chunk_size'] = scope['chunk_size']
+    if scope.get('priority'):
+        options['priority'] = scope['priority']
+    return options
+
+def accepted_options(response_msg: pdu.Datagram):
+    checksum_alg = pdu.CHECKSUM_NAMES[response_msg.options.get('checksum', 'crc32')]
+    digest_name = response_msg.options.get('digest')
+    return checksum_alg, pdu.new_digest(digest_name) if digest_name else None
+
+async def upload_video(scope: Dict, conn: EchoQuicConnection, filepath: str) -> Optional[int]:
+    """Upload a file; returns the bytes of it actually sent, or None if the upload failed."""
     print('[cli] uploading video:', filepath)
     
-    # Open the video file
-    with open(filepath, 'rb') as f:
-        video_data = f.read()
-    
-    filesize = len(video_data)
-    print(f'[cli] Read file: {filepath}, Size: {filesize}')
+    # Only stat the video here; it is read chunk by chunk while sending
+    filesize = os.path.getsize(filepath)
+    print(f'[cli] Video file: {filepath}, Size: {filesize}')
     
+    # A resumable upload identifies the file by its digest, so the server
+    # only resumes onto a partial copy of the same content
+    fingerprint = None
+    manifest = None
+    parts = max(1, scope.get('streams', 1))
+    if scope.get('dedup'):
+        # Content-defined chunks, so the server can tell which it already holds
+        manifest = await get_pool().submit(dedup.file_manifest, filepath)
+        print(f'[cli] Dedup upload, {len(manifest)} content-defined chunks')
+        parts = 1
+    elif scope.get('resume'):
+        fingerprint = (await file_digest(filepath, 'sha256')).hex()
+        print(f'[cli] Resumable upload, fingerprint: {fingerprint}')
+
+    # Each part of the file goes over its own stream of this connection
+    if parts > 1:
+        print(f'[cli] Splitting upload across {parts} streams')
+    results = await asyncio.gather(*(upload_part(scope, conn, filepath, filesize, part, parts, fingerprint, manifest)
+                                     for part in range(parts)))
+    print('[cli] Upload complete')
+    return sum(results) if None not in results else None
+
+async def upload_part(scope: Dict, conn: EchoQuicConnection, filepath: str, filesize: int, part: int, parts: int,
+                      fingerprint: Optional[str] = None, manifest: Optional[List[dedup.ManifestEntry]] = None) -> Optional[int]:
+    start, length = part_range(filesize, part, parts)
+    options = request_options(scope)
+    if parts > 1:
+        options['part'] = [part, parts]
+    if fingerprint:
+        options['resume'] = fingerprint
+    if manifest:
+        options['dedup'] = {'chunks': len(manifest)}
+
     # Create and send the REQUEST message to initiate the upload
-    request_msg = pdu.Datagram(pdu.MSG_TYPE_REQUEST, "", filename=os.path.basename(filepath), filesize=filesize)
+    request_msg = pdu.Datagram(pdu.MSG_TYPE_REQUEST, "", filename=os.path.basename(filepath), filesize=filesize,
+                               options=options)
     new_stream_id = conn.new_stream()
     qs = QuicStreamEvent(new_stream_id, request_msg.to_bytes(), False)
-    print(f'[cli] Sending REQUEST')
+    print(f'[cli] Sending REQUEST on stream {new_stream_id}')
     await conn.send(qs)
     
     # Wait for the RESPONSE from the server
     try:
-        response: QuicStreamEvent = await conn.receive()
+        response: QuicStreamEvent = await conn.receive(new_stream_id)
         print('[cli] Response received')
     except Exception as e:
         print(f'[cli] Error receiving response: {e}')
-        return
+        return None
     response_msg = pdu.Datagram.from_bytes(response.data)
     print(f'[cli] Server response received')
     
     if response_msg.mtype == pdu.MSG_TYPE_RESPONSE:
-        # Send the video data in chunks
-        chunk_size = 10 * 1024  # 100 KB chunks
-        num_chunks = (filesize + chunk_size - 1) // chunk_size
-        print(f'[cli] Total chunks to send: {num_chunks}')
+        checksum_alg, digest = accepted_options(response_msg)
+        # A resumed upload only sends what the server is missing
+        whole = [(start, start + length)]
+        ranges = [tuple(r) for r in response_msg.options.get('missing', whole)]
+        if ranges != whole:
+            print(f'[cli] Resuming upload, sending ranges: {ranges}')
+        if manifest and 'dedup' in response_msg.options:
+            # Send the chunk list; the server answers with the byte ranges it doesn't hold
+            for i in range(0, len(manifest), MANIFEST_BATCH):
+                entries = pdu.encode_manifest((size, chunk_digest) for _, size, chunk_digest in manifest[i:i + MANIFEST_BATCH])
+                await conn.send(QuicStreamEvent(new_stream_id, pdu.Datagram(pdu.MSG_TYPE_MANIFEST, "", data=entries).to_bytes(), False))
+            reply: QuicStreamEvent = await conn.receive(new_stream_id)
+            reply_msg = pdu.Datagram.from_bytes(reply.data)
+            if reply_msg.mtype != pdu.MSG_TYPE_MANIFEST:
+                print(f'[cli] Upload failed: {reply_msg.msg}')
+                return None
+            ranges = [(offset, offset + size) for offset, size in reply_msg.ranges]
+            sending = sum(stop - first for first, stop in ranges)
+            print(f'[cli] Server is {reply_msg.msg.lower()}, sending {sending} of {filesize} bytes')
+            metrics.DEDUP_BYTES.inc(filesize - sending)
+        elif manifest:
+            print('[cli] Server keeps no chunk store, sending the whole file')
+
+        # Send the video data in chunks of the size the server chose (a
+        # server that doesn't negotiate one expects the old size), adjusted
+        # to the measured throughput if adaptive_chunks is set
+        chunk_size = response_msg.options.get('chunk_size', pdu.LEGACY_CHUNK_SIZE)
+        num_chunks = sum((stop - first + chunk_size - 1) // chunk_size for first, stop in ranges)
+        print(f'[cli] Total chunks to send: {num_chunks} of {chunk_size} bytes, bytes {start}-{start + length}')
         
-        for i in range(0, filesize, chunk_size):
-            chunk_data = video_data[i:i + chunk_size]
-            data_msg = pdu.Datagram(pdu.MSG_TYPE_DATA, "", sequence_num=i // chunk_size + 1, data=chunk_data)
-            data_msg.calculate_checksum()
-            print(f'[cli] Sending DATA chunk: {i // chunk_size + 1}/{num_chunks}, Size: {len(chunk_data)}')
-            await conn.send(QuicStreamEvent(new_stream_id, data_msg.to_bytes(), False))
+        sizer = ChunkSizer(chunk_size, response_msg.options.get('chunk_limit', chunk_size),
+                           scope.get('adaptive_chunks', False), pdu.MIN_CHUNK_SIZE)
+        open_chunks = lambda size, offset, length: ChunkSource(filepath, size, offset, length)
+        sequence_num = 0
+        sent = 0
+        send_buffer = bytearray(pdu.HEADER.size + sizer.limit + 64)
+        for first, stop in ranges:
+            async for i, chunk_data in resized_chunks(open_chunks, sizer, first, stop - first):
+                sequence_num += 1
+                data_msg = pdu.Datagram(pdu.MSG_TYPE_DATA, "", sequence_num=sequence_num, data=chunk_data, offset=i)
+                data_msg.calculate_checksum(checksum_alg)
+                if digest:
+                    digest.update(chunk_data)
+                log.debug('[cli] Sending DATA chunk: %d/%d, Size: %d', sequence_num, num_chunks, len(chunk_data))
+                await conn.send(QuicStreamEvent(new_stream_id, data_msg.to_bytes(send_buffer), False))
+                sizer.sent(len(chunk_data))
+                sent += len(chunk_data)
+                metrics.CHUNKS_OUT.inc()
+        if sizer.adaptive:
+            print(f'[cli] Chunk size settled at {sizer.size} bytes')
         
+        if digest:
+            # When only missing ranges were sent the running digest doesn't cover the whole range
+            file_hash = digest.digest() if ranges == whole else await file_digest(filepath, digest.name, start, length)
+            end_msg = pdu.Datagram(pdu.MSG_TYPE_END, digest.name, data=file_hash)
+            await conn.send(QuicStreamEvent(new_stream_id, end_msg.to_bytes(), False))
+
         # Send an end-of-stream signal
         print('[cli] Sending end-of-stream signal')
         await conn.send(QuicStreamEvent(new_stream_id, b'', True))
         print('[cli] End-of-stream signal sent')
-    
-    print('[cli] Upload complete')
 
-async def download_video(scope: Dict, conn: EchoQuicConnection, filename: str):
+        # Wait for the server's ACK so the connection isn't closed under it
+        ack: QuicStreamEvent = await conn.receive(new_stream_id)
+        ack_msg = pdu.Datagram.from_bytes(ack.data)
+        if ack_msg.mtype == pdu.MSG_TYPE_ACK:
+            print(f'[cli] ACK received: {ack_msg.msg}')
+            return sent
+        elif ack_msg.mtype == pdu.MSG_TYPE_ERROR:
+            print(f'[cli] Upload failed: {ack_msg.msg}')
+        else:
+            print(f'[cli] Unexpected reply to upload: {ack_msg.mtype}')
+    elif response_msg.mtype == pdu.MSG_TYPE_ERROR:
+        print(f'[cli] Upload failed: {response_msg.msg}')
+    return None
+
+async def download_video(scope: Dict, conn: EchoQuicConnection, filename: str) -> Optional[int]:
+    """Download a file; returns the bytes of it actually received, or None if the download failed."""
     print('[cli] downloading video:', filename)
-    
+    # Catalog names may be in subdirectories; the copy goes to the same relative path
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    if scope.get('live'):
+        return await live_video(scope, conn, filename)
+    if scope.get('ranges'):
+        return await download_ranges(scope, conn, filename, scope['ranges'])
+
+    # Each stream asks the server for one part of the file
+    parts = max(1, scope.get('streams', 1))
+    if parts > 1:
+        print(f'[cli] Splitting download across {parts} streams')
+    results = await asyncio.gather(*(download_part(scope, conn, filename, part, parts) for part in range(parts)))
+    print('[cli] Download complete')
+    return sum(results) if None not in results else None
+
+async def download_part(scope: Dict, conn: EchoQuicConnection, filename: str, part: int, parts: int) -> Optional[int]:
+    options = request_options(scope)
+    if parts > 1:
+        options['part'] = [part, parts]
+    # Tell the server which version of the file our partial copy is of and what we have of it
+    journal_path = filename + '.journal'
+    if scope.get('resume'):
+        saved = TransferJournal.peek(journal_path, filename)
+        options['resume'] = {'etag': saved['key']['etag'], 'have': saved['ranges']} if saved else {}
+    else:
+        discard_journal(journal_path)
+
     # Create and send the REQUEST message to initiate the download
-    request_msg = pdu.Datagram(pdu.MSG_TYPE_REQUEST, "", filename=filename)
+    request_msg = pdu.Datagram(pdu.MSG_TYPE_REQUEST, "", filename=filename, options=options)
     new_stream_id = conn.new_stream()
     qs = QuicStreamEvent(new_stream_id, request_msg.to_bytes(), False)
-    print(f'[cli] Sending REQUEST')
+    print(f'[cli] Sending REQUEST on stream {new_stream_id}')
     await conn.send(qs)
     
     # Wait for the RESPONSE from the server
-    response: QuicStreamEvent = await conn.receive()
+    response: QuicStreamEvent = await conn.receive(new_stream_id)
     response_msg = pdu.Datagram.from_bytes(response.data)
     print(f'[cli] Server response received')
     
     if response_msg.mtype == pdu.MSG_TYPE_RESPONSE:
-        # Receive the video data in chunks
+        checksum_alg, digest = accepted_options(response_msg)
+        start, length = response_msg.options.get('range', [0, response_msg.filesize])
+        journal = None
+        if scope.get('resume'):
+            # A journal for another version of the file is started afresh
+            journal = TransferJournal.open(journal_path, {
+                'filename': filename, 'filesize': response_msg.filesize, 'etag': response_msg.options.get('etag')}, filename)
+            if 'missing' in response_msg.options:
+                print(f'[cli] Resuming download, missing ranges: {response_msg.options["missing"]}')
+        digest_ok = True
+        received_bytes = 0
+        # Receive the video data in chunks, placed by offset into this part's range of the file
+        try:
+            with open_preallocated(filename, response_msg.filesize) as f:
+                writer = WriteBehind(f, fsync=scope.get('fsync', FSYNC_NONE))
+                reassembler = Reassembler(writer, start, length, journal.received if journal else None)
+                if journal:
+                    journal.attach(writer)
+                try:
+                    while True:
+                        message: QuicStreamEvent = await conn.receive(new_stream_id)
+                        if message.end_stream:
+                            break
+                        data_msg = pdu.Datagram.from_bytes(message.data)
+                        if data_msg.mtype == pdu.MSG_TYPE_END:
+                            if digest:
+                                received = digest.digest() if reassembler.in_order else await reassembler.digest(digest.name)
+                                if received != data_msg.data:
+                                    digest_ok = False
+                                    print('[cli] File digest mismatch. Data integrity compromised.')
+                                else:
+                                    print(f'[cli] File digest verified ({digest.name})')
+                            continue
+                        if data_msg.is_checksum_valid(checksum_alg):
+                            if await reassembler.write(data_msg.offset, data_msg.data):
+                                if digest and reassembler.in_order:
+                                    digest.update(data_msg.data)
+                                if journal and journal.note(len(data_msg.data)):
+                                    await journal.checkpoint()
+                                received_bytes += len(data_msg.data)
+                                metrics.CHUNKS_IN.inc()
+                                log.debug('[cli] Received DATA chunk, Size: %d', len(data_msg.data))
+                            else:
+                                metrics.CHUNKS_DROPPED.inc()
+                                log.warning('[cli] Chunk at offset %d is outside %d-%d', data_msg.offset, start, start + length)
+                        else:
+                            metrics.CHECKSUM_FAILURES.inc()
+                            log.warning('[cli] Checksum invalid. Data integrity compromised.')
+                finally:
+                    # Also when the connection is lost: what arrived is written
+                    # out, and journaled for a resumed download
+                    if journal:
+                        await journal.finish(writer, response_msg.filesize)
+                    else:
+                        await writer.close()
+        finally:
+            if journal:
+                journal.release()
+        if not reassembler.in_order:
+            metrics.OUT_OF_ORDER.inc()
+        if not reassembler.complete:
+            print(f'[cli] Download incomplete, missing ranges: {reassembler.missing()}')
+        return received_bytes if reassembler.complete and digest_ok else None
+    elif response_msg.mtype == pdu.MSG_TYPE_ERROR:
+        print(f'[cli] Download failed: {response_msg.msg}')
+    return None
+
+async def fetch_ranges(scope: Dict, conn: EchoQuicConnection, filename: str,
+                       ranges: List[Tuple[int, int]]) -> AsyncIterator[Tuple[int, int, memoryview]]:
+    """
+    Ask the server for (offset, length) byte ranges of a file, in the order
+    given, and yield (filesize, offset, data) for each chunk as it arrives,
+    so playback can start from any position without waiting for the rest
+    of the file. data is only valid until the next chunk is requested.
+    """
+    request_msg = pdu.Datagram(pdu.MSG_TYPE_REQUEST, "", filename=filename, options=request_options(scope),
+                               ranges=ranges)
+    stream_id = conn.new_stream()
+    print(f'[cli] Sending byte-range REQUEST on stream {stream_id}: {ranges}')
+    await conn.send(QuicStreamEvent(stream_id, request_msg.to_bytes(), False))
+
+    response: QuicStreamEvent = await conn.receive(stream_id)
+    response_msg = pdu.Datagram.from_bytes(response.data)
+    if response_msg.mtype == pdu.MSG_TYPE_ERROR:
+        raise ValueError(response_msg.msg)
+    print(f'[cli] Server will send ranges: {response_msg.ranges}')
+    checksum_alg, _ = accepted_options(response_msg)
+    while True:
+        message: QuicStreamEvent = await conn.receive(stream_id)
+        if message.end_stream:
+            break
+        data_msg = pdu.Datagram.from_bytes(message.data)
+        if data_msg.mtype != pdu.MSG_TYPE_DATA:
+            continue
+        if not data_msg.is_checksum_valid(checksum_alg):
+            metrics.CHECKSUM_FAILURES.inc()
+            log.warning('[cli] Checksum invalid. Data integrity compromised.')
+            continue
+        metrics.CHUNKS_IN.inc()
+        yield response_msg.filesize, data_msg.offset, data_msg.data
+
+async def download_ranges(scope: Dict, conn: EchoQuicConnection, filename: str,
+                          ranges: List[Tuple[int, int]]) -> Optional[int]:
+    """Fetch byte ranges of a file into a sparse local copy of it; returns the bytes received, or None."""
+    requested = time.monotonic()
+    first_byte = None
+    received = RangeSet()
+    f = writer = None
+    try:
+        async for filesize, offset, data in fetch_ranges(scope, conn, filename, ranges):
+            if first_byte is None:
+                first_byte = time.monotonic() - requested
+                print(f'[cli] First byte at offset {offset} after {first_byte * 1000:.1f} ms')
+                f = open_preallocated(filename, filesize)
+                writer = WriteBehind(f, fsync=scope.get('fsync', FSYNC_NONE))
+            await writer.write(offset, data)
+            received.add(offset, offset + len(data))
+    except ValueError as e:
+        print(f'[cli] Download failed: {e}')
+        return None
+    finally:
+        if writer:
+            await writer.close()
+            f.close()
+    complete = first_byte is not None
+    for offset, length in ranges:
+        # Ranges are cut short at the end of the file
+        missing = received.missing(offset, min(offset + length, filesize)) if complete else []
+        if missing:
+            complete = False
+            print(f'[cli] Range {offset}+{length} incomplete, missing: {missing}')
+    print(f'[cli] Received {received.total()} bytes in {len(received)} ranges')
+    return received.total() if complete else None
+
+async def live_video(scope: Dict, conn: EchoQuicConnection, filename: str) -> Optional[int]:
+    """
+    Play a file from the server as a live feed: its packets arrive as QUIC
+    DATAGRAMs, go through a jitter buffer with FEC recovery, and are
+    written out in order at a fixed delay; what is lost stays lost. With
+    scope['loss'] that fraction of datagrams is dropped on arrival, to
+    try the FEC settings on a loopback link. Returns the bytes played.
+    """
+    stream_id = conn.new_stream()
+    flow = live.flow_id(stream_id)
+    datagrams = conn.open_datagrams(flow)
+    request_msg = pdu.Datagram(pdu.MSG_TYPE_REQUEST, "", filename=filename, options={'live': scope['live']})
+    print(f'[cli] Sending live stream REQUEST on stream {stream_id}')
+    await conn.send(QuicStreamEvent(stream_id, request_msg.to_bytes(), False))
+    response: QuicStreamEvent = await conn.receive(stream_id)
+    response_msg = pdu.Datagram.from_bytes(response.data)
+    if response_msg.mtype != pdu.MSG_TYPE_RESPONSE:
+        print(f'[cli] Live stream failed: {response_msg.msg}')
+        conn.close_datagrams(flow)
+        return None
+    params = response_msg.options['live']
+    print(f'[cli] Live stream accepted: {params}')
+
+    buffer = live.JitterBuffer(FecCodec(params['fec'], params['k'], params['m']), params['latency'])
+    loss = scope.get('loss', 0.0)
+    dropped = 0
+    end = asyncio.ensure_future(conn.receive(stream_id))
+    position = 0
+    try:
         with open(filename, 'wb') as f:
-            while True:
-                message: QuicStreamEvent = await conn.receive()
-                if message.end_stream:
-                    break
-                data_msg = pdu.Datagram.from_bytes(message.data)
-                if data_msg.is_checksum_valid():
-                    f.write(data_msg.data)
-                    print(f'[cli] Received DATA chunk, Size: {len(data_msg.data)}')
-                else:
-                    print('[cli] Checksum invalid. Data integrity compromised.')
-    
-    print('[cli] Download complete')
+            writer = WriteBehind(f, fsync=scope.get('fsync', FSYNC_NONE))
+
+            async def play(released) -> None:
+                nonlocal position
+                for _, payload in released:
+                    if payload is not None:
+                        await writer.write(position, payload)
+                        position += len(payload)
+
+            try:
+                # Until the server's END, and then for one latency period so the
+                # datagrams still in flight can make it
+                closing = None
+                while closing is None or time.monotonic() < closing:
+                    try:
+                        data = await asyncio.wait_for(datagrams.get(), LIVE_TICK)
+                    except asyncio.TimeoutError:
+                        data = None
+                    if data is not None:
+                        if loss and random.random() < loss:
+                            dropped += 1
+                        else:
+                            buffer.add(pdu.LiveDatagram.from_bytes(data), time.monotonic())
+                    await play(buffer.pop_due(time.monotonic()))
+                    if closing is None and end.done():
+                        closing = time.monotonic() + params['latency']
+                end_msg = pdu.Datagram.from_bytes(end.result().data)
+                await play(buffer.finish(end_msg.options.get('packets', buffer.next_seq)))
+            finally:
+                await writer.close()
+    finally:
+        end.cancel()
+        conn.close_datagrams(flow)
+    stats = buffer.stats()
+    stats['dropped'] = dropped
+    print(f'[cli] Live stream ended, {position} bytes played: {stats}')
+    return position
+
+def expand_paths(paths: List[str]) -> List[str]:
+    """Files named by paths, glob patterns or directories (searched recursively), once each."""
+    files = []
+    for path in paths:
+        matches = sorted(glob.glob(path, recursive=True)) if glob.has_magic(path) else [path]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, dirs, names in os.walk(match):
+                    dirs.sort()
+                    files.extend(os.path.join(root, name) for name in sorted(names))
+            else:
+                files.append(match)
+    return list(dict.fromkeys(files))
+
+async def transfer_batch(scope: Dict, conn: EchoQuicConnection, paths: List[str], download: bool) -> Dict:
+    """
+    Transfer several files over the one connection, each on its own
+    stream(s), at most scope['concurrency'] at a time, and print an
+    aggregate summary. A failed file doesn't stop the others.
+    """
+    limit = asyncio.Semaphore(max(1, scope.get('concurrency', DEFAULT_CONCURRENCY)))
+    transfer = download_video if download else upload_video
+
+    async def transfer_one(path: str) -> Tuple[bool, int]:
+        async with limit:
+            started = time.monotonic()
+            metrics.ACTIVE_STREAMS.inc()
+            try:
+                # What went over the wire, not the file's size: a range,
+                # resumed or dedup transfer only moves part of it
+                size = await transfer(scope, conn, path)
+            except Exception as e:
+                print(f'[cli] Transfer of {path} failed: {e}')
+                size = None
+            finally:
+                metrics.ACTIVE_STREAMS.dec()
+            if size is not None:
+                metrics.record_transfer(size, time.monotonic() - started)
+            return size is not None, size or 0
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(transfer_one(path) for path in paths))
+    elapsed = time.monotonic() - started
+    total = sum(size for _, size in results)
+    failed = [path for path, (ok, _) in zip(paths, results) if not ok]
+    summary = {'files': len(paths), 'failed': len(failed), 'bytes': total, 'seconds': round(elapsed, 3),
+               'mb_per_s': round(total / elapsed / 1e6, 2) if elapsed else 0.0}
+    print(f'[cli] Batch {"download" if download else "upload"} summary: {summary}')
+    for path in failed:
+        print(f'[cli] Failed: {path}')
+    return summary
+
+async def list_catalog(scope: Dict, conn: EchoQuicConnection) -> int:
+    """Page through the server's catalog on one stream and print it; returns the number of files."""
+    stream_id = conn.new_stream()
+    cursor = None
+    count = 0
+    while True:
+        list_msg = pdu.Datagram(pdu.MSG_TYPE_LIST, "", options={'cursor': cursor, 'limit': scope['list']})
+        await conn.send(QuicStreamEvent(stream_id, list_msg.to_bytes(), False))
+        reply: QuicStreamEvent = await conn.receive(stream_id)
+        reply_msg = pdu.Datagram.from_bytes(reply.data)
+        if reply_msg.mtype != pdu.MSG_TYPE_LIST:
+            print(f'[cli] Listing failed: {reply_msg.msg}')
+            break
+        for entry in reply_msg.options['entries']:
+            digest = ' {}:{}'.format(*entry['digest']) if 'digest' in entry else ''
+            print(f'[cli] {entry["size"]:>14} {entry["name"]}{digest}')
+            count += 1
+        cursor = reply_msg.options.get('next')
+        if cursor is None:
+            print(f'[cli] {count} of {reply_msg.options.get("total", count)} files listed')
+            break
+    await conn.send(QuicStreamEvent(stream_id, b'', True))
+    return count
 
-async def echo_client_proto(scope: Dict, conn: EchoQuicConnection, video_path: str, download: bool):
-    if download:
+async def echo_client_proto(scope: Dict, conn: EchoQuicConnection, video_path: Union[str, List[str]], download: bool):
+    if scope.get('list'):
+        await list_catalog(scope, conn)
+    elif not isinstance(video_path, str):
+        # Uploads may name globs and directories; downloads name server files
+        paths = video_path if download else expand_paths(video_path)
+        await transfer_batch(scope, conn, paths, download)
+    elif download:
         await download_video(scope, conn, video_path)
     else:
         await upload_video(scope, conn, video_path)
@@ -1,111 +1,451 @@
 import asyncio
-from typing import Dict
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
 from common import EchoQuicConnection, QuicStreamEvent
 import pdu
+from chunk_source import ChunkSizer, file_digest, open_preallocated, part_range, resized_chunks
+from reassembly import RangeSet, Reassembler
+from journal import TransferJournal, discard as discard_journal
+from disk_io import FSYNC_NONE, WriteBehind, get_pool
+from chunk_cache import CachedChunks, get_cache
+from catalog import LIST_PAGE, MAX_LIST_PAGE
+import metrics
+from scheduler import DEFAULT_PRIORITY
+import dedup
+import live
+from fec import FecCodec
 
-async def handle_upload(scope: Dict, conn: EchoQuicConnection, initial_msg: pdu.Datagram):
+log = logging.getLogger(__name__)
+
+# Most byte ranges one download REQUEST may ask for
+MAX_RANGES = 64
+# Most streams one transfer may be split across
+MAX_PARTS = 64
+
+def negotiate_options(request_msg: pdu.Datagram, filesize: int, window: Optional[int]) -> Dict:
+    """Options of the RESPONSE to a REQUEST; window is the receive window of whichever side receives the data."""
+    options = {'checksum': pdu.negotiate_checksum(request_msg.options.get('checksum'))}
+    options['chunk_size'], options['chunk_limit'] = pdu.negotiate_chunk_size(
+        request_msg.options.get('chunk_size'), filesize, window)
+    # A multi-stream transfer sends one part of the file per stream
+    part, parts = requested_part(request_msg)
+    options['range'] = list(part_range(filesize, part, parts))
+    digest = pdu.negotiate_digest(request_msg.options.get('digest'))
+    if digest:
+        options['digest'] = digest
+    return options
+
+def requested_part(request_msg: pdu.Datagram) -> Optional[Tuple[int, int]]:
+    """(part, parts) of a REQUEST, (0, 1) for the whole file; None if it isn't a valid split."""
+    value = request_msg.options.get('part', [0, 1])
+    if not isinstance(value, list) or len(value) != 2 or not all(type(n) is int for n in value):
+        return None
+    part, parts = value
+    if not 1 <= parts <= MAX_PARTS or not 0 <= part < parts:
+        return None
+    return part, parts
+
+def requested_ranges(request_msg: pdu.Datagram, filesize: int) -> List[Tuple[int, int]]:
+    """The (offset, length) ranges of a byte-range REQUEST, in order, cut to the file."""
+    ranges = []
+    for offset, length in request_msg.ranges[:MAX_RANGES]:
+        length = min(length, filesize - offset)
+        if length > 0:
+            ranges.append((offset, length))
+    return ranges
+
+async def receive_manifest(conn: EchoQuicConnection, filesize: int, count: int) -> Optional[List[dedup.ManifestEntry]]:
+    """The chunk list of a dedup upload as (offset, length, digest); None unless it adds up to the file."""
+    if count > filesize // dedup.MIN_CHUNK + 1:
+        return None
+    manifest = []
+    offset = 0
+    while len(manifest) < count:
+        message: QuicStreamEvent = await conn.receive()
+        if message.end_stream:
+            return None
+        manifest_msg = pdu.Datagram.from_bytes(message.data)
+        if manifest_msg.mtype != pdu.MSG_TYPE_MANIFEST:
+            return None
+        for length, digest in pdu.decode_manifest(manifest_msg.data):
+            manifest.append((offset, length, digest))
+            offset += length
+    return manifest if len(manifest) == count and offset == filesize else None
+
+async def handle_upload(scope: Dict, conn: EchoQuicConnection, initial_msg: pdu.Datagram, stream_id: int) -> int:
     print('[svr] handling upload for:', initial_msg.filename)
+    if os.path.basename(initial_msg.filename) != initial_msg.filename or initial_msg.filename in ('.', '..'):
+        error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "Invalid file name")
+        print(f'[svr] Sending ERROR, {initial_msg.filename!r} is not a plain file name')
+        await conn.send(QuicStreamEvent(stream_id, error_msg.to_bytes(), True))
+        return 0
+    if requested_part(initial_msg) is None:
+        error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "Invalid part")
+        print(f'[svr] Sending ERROR, invalid part {initial_msg.options.get("part")!r}')
+        await conn.send(QuicStreamEvent(stream_id, error_msg.to_bytes(), True))
+        return 0
     
     # Send a RESPONSE message to the client to acknowledge the upload request
-    response_msg = pdu.Datagram(pdu.MSG_TYPE_RESPONSE, "", filename=initial_msg.filename, filesize=initial_msg.filesize)
+    options = negotiate_options(initial_msg, initial_msg.filesize, scope.get('window'))
+    start, length = options['range']
+    # Under the catalog root, so the file is served (and listed) once complete
+    catalog = scope['catalog']
+    file_path = os.path.join(catalog.root, f"received_{initial_msg.filename}")
+
+    # A dedup upload sends its chunk manifest first, then only the chunks
+    # the store doesn't hold; without a store it is a plain upload
+    store = scope.get('chunk_store')
+    dedup_request = initial_msg.options.get('dedup') if store else None
+    if dedup_request:
+        options['dedup'] = dedup.CHUNK_HASH
+
+    # A resumable upload is journaled under the client's fingerprint of the
+    # file; if an earlier attempt left one, only the missing ranges are asked for
+    fingerprint = initial_msg.options.get('resume') if not dedup_request else None
+    if fingerprint:
+        journal = TransferJournal.open(file_path + '.journal', {
+            'filename': initial_msg.filename, 'filesize': initial_msg.filesize, 'digest': fingerprint}, file_path)
+        options['missing'] = journal.saved.missing(start, start + length)
+        print(f'[svr] Resumable upload, missing ranges: {options["missing"]}')
+    else:
+        journal = None
+        discard_journal(file_path + '.journal')
+
+    # Not served while it is being written
+    catalog_name = catalog.name_of(file_path)
+    catalog.hold(catalog_name)
+    try:
+        return await receive_upload(scope, conn, initial_msg, stream_id, options, journal, file_path)
+    finally:
+        if journal:
+            journal.release()
+        await catalog.release(catalog_name, os.path.exists(file_path) and not os.path.exists(file_path + '.journal'))
+
+async def receive_upload(scope: Dict, conn: EchoQuicConnection, initial_msg: pdu.Datagram, stream_id: int,
+                         options: Dict, journal: Optional[TransferJournal], file_path: str) -> int:
+    start, length = options['range']
+    digest = pdu.new_digest(options['digest']) if 'digest' in options else None
+    digest_ok = True
+    checksum_alg = pdu.CHECKSUM_NAMES[options['checksum']]
+    store = scope.get('chunk_store')
+    dedup_request = 'dedup' in options and initial_msg.options.get('dedup')
+    response_msg = pdu.Datagram(pdu.MSG_TYPE_RESPONSE, "", filename=initial_msg.filename, filesize=initial_msg.filesize,
+                                options=options)
     print(f'[svr] Sending RESPONSE')
-    await conn.send(QuicStreamEvent(initial_msg.transaction_id, response_msg.to_bytes(), False))
+    await conn.send(QuicStreamEvent(stream_id, response_msg.to_bytes(), False))
+
+    manifest = None
+    received = journal.received if journal else None
+    # A manifest left by an earlier upload no longer describes the file
+    discard_journal(file_path + '.manifest')
+    if dedup_request:
+        manifest = await receive_manifest(conn, initial_msg.filesize, dedup_request.get('chunks', 0))
+        if manifest is None:
+            error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "Invalid manifest")
+            print(f'[svr] Sending ERROR, manifest does not describe the file')
+            await conn.send(QuicStreamEvent(stream_id, error_msg.to_bytes(), True))
+            return 0
+        held, missing_chunks = await get_pool().submit(store.split, manifest)
     
-    # Open a new file to write the incoming video data
-    file_path = f"received_{initial_msg.filename}"
-    with open(file_path, 'wb') as f:
-        total_chunks = 0
-        total_size = 0
-        last_sequence_num = 0
-        while True:
-            try:
-                print('[svr] Waiting to receive data chunks...')
-                message: QuicStreamEvent = await conn.receive()
-                print(f'[svr] Received message: {message}')
-                if message.end_stream:
-                    print('[svr] End-of-stream signal received')
-                    break
-                if message.data:
-                    data_msg = pdu.Datagram.from_bytes(message.data)
-                    if data_msg.is_checksum_valid():
-                        if data_msg.sequence_num == last_sequence_num + 1:
-                            f.write(data_msg.data)
-                            total_size += len(data_msg.data)
-                            total_chunks += 1
-                            last_sequence_num = data_msg.sequence_num
-                            print(f'[svr] Received DATA chunk {total_chunks}, Size: {len(data_msg.data)}')
+    # Open the file to write the incoming video data; other streams of a
+    # multi-stream upload fill the rest of it
+    with open_preallocated(file_path, initial_msg.filesize) as f:
+        # Chunks are placed by offset, so arrival order doesn't matter; they
+        # are batched and written on the disk pool while we keep receiving
+        writer = WriteBehind(f, fsync=scope.get('fsync', FSYNC_NONE))
+        if journal:
+            journal.attach(writer)
+        try:
+            if manifest:
+                # Held chunks are copied from the store before the client is told
+                # what to send, so one evicted or deleted since split() is asked
+                # for like any other missing chunk
+                copied = []
+                for entry in held:
+                    data = await get_pool().submit(store.get, entry[2])
+                    if data is None:
+                        missing_chunks.append(entry)
+                    else:
+                        await writer.write(entry[0], data)
+                        copied.append(entry)
+                if len(copied) < len(held):
+                    print(f'[svr] {len(held) - len(copied)} chunks left the store, asking for them instead')
+                    missing_chunks.sort()
+                held = copied
+                held_bytes = sum(size for _, size, _ in held)
+                reply_msg = pdu.Datagram(pdu.MSG_TYPE_MANIFEST, f"Holding {len(held)} of {len(manifest)} chunks",
+                                         ranges=dedup.manifest_ranges(missing_chunks))
+                print(f'[svr] Dedup upload, holding {len(held)} of {len(manifest)} chunks ({held_bytes} bytes)')
+                await conn.send(QuicStreamEvent(stream_id, reply_msg.to_bytes(), False))
+                # Held chunks count as received
+                received = RangeSet((offset, offset + size) for offset, size in dedup.manifest_ranges(held))
+                metrics.DEDUP_BYTES.inc(held_bytes)
+            reassembler = Reassembler(writer, start, length, received)
+            total_chunks = 0
+            total_bytes = 0
+            while True:
+                try:
+                    message: QuicStreamEvent = await conn.receive()
+                    log.debug('[svr] Received message: %s', message)
+                    if message.end_stream:
+                        print('[svr] End-of-stream signal received')
+                        break
+                    if message.data:
+                        data_msg = pdu.Datagram.from_bytes(message.data)
+                        if data_msg.mtype == pdu.MSG_TYPE_END:
+                            if digest:
+                                # Out-of-order chunks mean the running digest is of the wrong byte order
+                                received_digest = digest.digest() if reassembler.in_order else await reassembler.digest(digest.name)
+                                digest_ok = received_digest == data_msg.data
+                                print(f'[svr] File digest ({digest.name}) {"verified" if digest_ok else "mismatch"}')
+                            continue
+                        if data_msg.is_checksum_valid(checksum_alg):
+                            if await reassembler.write(data_msg.offset, data_msg.data):
+                                if digest and reassembler.in_order:
+                                    digest.update(data_msg.data)
+                                if journal and journal.note(len(data_msg.data)):
+                                    await journal.checkpoint()
+                                total_chunks += 1
+                                total_bytes += len(data_msg.data)
+                                metrics.CHUNKS_IN.inc()
+                                log.debug('[svr] Received DATA chunk %d, Size: %d', total_chunks, len(data_msg.data))
+                            else:
+                                metrics.CHUNKS_DROPPED.inc()
+                                log.warning('[svr] Chunk %d at offset %d is outside %d-%d',
+                                            data_msg.sequence_num, data_msg.offset, start, start + length)
                         else:
-                            print(f'[svr] Out of order packet received: {data_msg.sequence_num} expected: {last_sequence_num + 1}')
-                            # Handle out-of-order packets if necessary
+                            metrics.CHECKSUM_FAILURES.inc()
+                            log.warning('[svr] Checksum invalid. Data integrity compromised.')
                     else:
-                        print('[svr] Checksum invalid. Data integrity compromised.')
-                else:
-                    print('[svr] Received empty data message')
-            except Exception as e:
-                print(f'[svr] Error receiving data: {e}')
-                break
+                        print('[svr] Received empty data message')
+                except Exception as e:
+                    print(f'[svr] Error receiving data: {e}')
+                    break
+
+            chunks_ok = True
+            if manifest and reassembler.complete:
+                # Check the new chunks against the manifest as they go into the store
+                await writer.flush()
+                chunks_ok = not await writer.run(store.put_from, f, missing_chunks)
+                if chunks_ok:
+                    dedup.save_manifest(file_path + '.manifest', manifest)
+        finally:
+            # However the stream ends, an abort included: what arrived is
+            # written out, and journaled for a resumed upload
+            if journal:
+                await journal.finish(writer, initial_msg.filesize)
+            else:
+                await writer.close()
     
-    print(f'[svr] Upload complete for: {initial_msg.filename}. Total size: {total_size} bytes in {total_chunks} chunks.')
-    # Send an ACK message to the client
-    ack_msg = pdu.Datagram(pdu.MSG_TYPE_ACK, "Upload complete")
-    print(f'[svr] Sending ACK')
-    await conn.send(QuicStreamEvent(initial_msg.transaction_id, ack_msg.to_bytes(), True))
+    missing = reassembler.missing()
+    if not reassembler.in_order:
+        metrics.OUT_OF_ORDER.inc()
+    print(f'[svr] Upload complete for: {initial_msg.filename}. Total size: {reassembler.received.total()} bytes in {total_chunks} chunks.')
+    # Send an ACK message to the client, or an ERROR if data is missing or the file digest didn't match
+    if missing:
+        ack_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, f"Missing {sum(stop - start for start, stop in missing)} bytes")
+        print(f'[svr] Sending ERROR, missing ranges: {missing}')
+    elif not chunks_ok:
+        ack_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "Chunk digest mismatch")
+        print(f'[svr] Sending ERROR, chunks do not match the manifest')
+    elif digest_ok:
+        ack_msg = pdu.Datagram(pdu.MSG_TYPE_ACK, "Upload complete")
+        print(f'[svr] Sending ACK')
+    else:
+        ack_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "File digest mismatch")
+        print(f'[svr] Sending ERROR')
+    await conn.send(QuicStreamEvent(stream_id, ack_msg.to_bytes(), True))
+    return total_bytes
 
-async def handle_download(scope: Dict, conn: EchoQuicConnection, initial_msg: pdu.Datagram):
+async def handle_download(scope: Dict, conn: EchoQuicConnection, initial_msg: pdu.Datagram, stream_id: int) -> int:
     print('[svr] handling download for:', initial_msg.filename)
     
-    # Open the requested video file
+    # Only catalog files are served, and what the RESPONSE needs to know of
+    # them is in the catalog; their chunks come from the shared cache, which
+    # drops anything it holds of an older version of the file
+    entry = scope['catalog'].get(initial_msg.filename)
+    if entry is None:
+        error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "File not found")
+        print(f'[svr] Sending ERROR, {initial_msg.filename!r} is not in the catalog')
+        await conn.send(QuicStreamEvent(stream_id, error_msg.to_bytes(), False))
+        return 0
+    if requested_part(initial_msg) is None:
+        error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "Invalid part")
+        print(f'[svr] Sending ERROR, invalid part {initial_msg.options.get("part")!r}')
+        await conn.send(QuicStreamEvent(stream_id, error_msg.to_bytes(), True))
+        return 0
+    cache = get_cache()
     try:
-        with open(initial_msg.filename, 'rb') as f:
-            video_data = f.read()
-        
-        filesize = len(video_data)
-        print(f'[svr] Read file: {initial_msg.filename}, Size: {filesize}')
+        version = cache.track(entry.version)
+        _, filesize, mtime_ns = version
+        print(f'[svr] Video file: {initial_msg.filename}, Size: {filesize}')
         
         # Send a RESPONSE message to the client
-        response_msg = pdu.Datagram(pdu.MSG_TYPE_RESPONSE, "", filename=initial_msg.filename, filesize=filesize)
+        # The client receives, so its window sets the chunk size
+        options = negotiate_options(initial_msg, filesize, initial_msg.options.get('window', scope.get('window')))
+        start, length = options['range']
+        checksum_alg = pdu.CHECKSUM_NAMES[options['checksum']]
+        digest = pdu.new_digest(options['digest']) if 'digest' in options else None
+
+        # The client resumes from what it already has, if its partial file
+        # is of this version of ours
+        options['etag'] = f'{filesize}-{mtime_ns}'
+        ranges = [(start, start + length)]
+        served = []
+        resume = initial_msg.options.get('resume')
+        if initial_msg.ranges:
+            # A byte-range request gets exactly those bytes, in the order
+            # asked for, so a player can seek without fetching the rest
+            served = requested_ranges(initial_msg, filesize)
+            if not served:
+                error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "Invalid range")
+                print(f'[svr] Sending ERROR, no valid range in {initial_msg.ranges}')
+                await conn.send(QuicStreamEvent(stream_id, error_msg.to_bytes(), True))
+                return 0
+            ranges = [(offset, offset + size) for offset, size in served]
+            start, length = 0, filesize
+            # The file digest is of a contiguous range, which this isn't
+            options.pop('digest', None)
+            options.pop('range')
+            digest = None
+            print(f'[svr] Byte-range request: {served}')
+        elif resume and resume.get('etag') == options['etag']:
+            ranges = options['missing'] = RangeSet(resume.get('have', [])).missing(start, start + length)
+            print(f'[svr] Resuming download, missing ranges: {ranges}')
+        response_msg = pdu.Datagram(pdu.MSG_TYPE_RESPONSE, "", filename=initial_msg.filename, filesize=filesize,
+                                    options=options, ranges=served)
         print(f'[svr] Sending RESPONSE')
-        await conn.send(QuicStreamEvent(initial_msg.transaction_id, response_msg.to_bytes(), False))
+        await conn.send(QuicStreamEvent(stream_id, response_msg.to_bytes(), False))
         
-        # Send the video data in chunks
-        chunk_size = 10 * 1024  # 100 KB chunks
-        num_chunks = (filesize + chunk_size - 1) // chunk_size
-        print(f'[svr] Total chunks to send: {num_chunks}')
+        # Send the video data in chunks of the negotiated size, adjusted to
+        # the measured throughput if adaptive_chunks is set
+        chunk_size = options['chunk_size']
+        num_chunks = sum((stop - 1) // chunk_size - first // chunk_size + 1 for first, stop in ranges if stop > first)
+        print(f'[svr] Total chunks to send: {num_chunks} of {chunk_size} bytes, bytes {ranges}')
         
-        for i in range(0, filesize, chunk_size):
-            chunk_data = video_data[i:i + chunk_size]
-            data_msg = pdu.Datagram(pdu.MSG_TYPE_DATA, "", sequence_num=i // chunk_size + 1, data=chunk_data)
-            data_msg.calculate_checksum()
-            await conn.send(QuicStreamEvent(initial_msg.transaction_id, data_msg.to_bytes(), False))
-            print(f'[svr] Sending DATA chunk: {i // chunk_size + 1}/{num_chunks}, Size: {len(chunk_data)}')
+        sizer = ChunkSizer(chunk_size, options['chunk_limit'], scope.get('adaptive_chunks', False), pdu.MIN_CHUNK_SIZE)
+        open_chunks = lambda size, offset, length: CachedChunks(cache, version, size, checksum_alg, offset, length)
+        sent = 0
+        sequence_num = 0
+        send_buffer = bytearray(pdu.HEADER.size + sizer.limit + 64)
+        for first, stop in ranges:
+            async for i, chunk_data, checksum in resized_chunks(open_chunks, sizer, first, stop - first):
+                sequence_num += 1
+                data_msg = pdu.Datagram(pdu.MSG_TYPE_DATA, "", sequence_num=sequence_num, data=chunk_data, offset=i,
+                                        checksum_alg=checksum_alg, checksum=checksum)
+                if digest:
+                    digest.update(chunk_data)
+                await conn.send(QuicStreamEvent(stream_id, data_msg.to_bytes(send_buffer), False))
+                sent += len(chunk_data)
+                sizer.sent(len(chunk_data))
+                metrics.CHUNKS_OUT.inc()
+                log.debug('[svr] Sending DATA chunk: %d/%d, Size: %d', sequence_num, num_chunks, len(chunk_data))
+        if sizer.adaptive:
+            print(f'[svr] Chunk size settled at {sizer.size} bytes')
         
+        if digest:
+            # When only missing ranges were sent the running digest doesn't cover the whole range
+            if ranges == [(start, start + length)]:
+                file_hash = digest.digest()
+            elif entry.digest and entry.digest[0] == digest.name and (start, length) == (0, filesize):
+                file_hash = entry.digest[1]
+            else:
+                file_hash = await file_digest(entry.path, digest.name, start, length)
+            end_msg = pdu.Datagram(pdu.MSG_TYPE_END, digest.name, data=file_hash)
+            await conn.send(QuicStreamEvent(stream_id, end_msg.to_bytes(), False))
+
         # Send an end-of-stream signal
-        await conn.send(QuicStreamEvent(initial_msg.transaction_id, b'', True))
+        await conn.send(QuicStreamEvent(stream_id, b'', True))
         print('[svr] End-of-stream signal sent')
+        return sent
         
     except FileNotFoundError:
-        # Send an ERROR message to the client
+        # Removed since the catalog last saw it; send an ERROR message to the client
+        error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "File not found")
+        print(f'[svr] Sending ERROR')
+        await conn.send(QuicStreamEvent(stream_id, error_msg.to_bytes(), False))
+        return 0
+
+async def handle_live(scope: Dict, conn: EchoQuicConnection, initial_msg: pdu.Datagram, stream_id: int) -> int:
+    print('[svr] handling live stream of:', initial_msg.filename)
+    entry = scope['catalog'].get(initial_msg.filename)
+    if entry is None:
         error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "File not found")
         print(f'[svr] Sending ERROR')
-        await conn.send(QuicStreamEvent(initial_msg.transaction_id, error_msg.to_bytes(), False))
+        await conn.send(QuicStreamEvent(stream_id, error_msg.to_bytes(), True))
+        return 0
+
+    # The file is played out as a live feed over DATAGRAM frames; this
+    # stream only carries the REQUEST/RESPONSE and the closing END
+    params = live.negotiate_live(initial_msg.options['live'])
+    response_msg = pdu.Datagram(pdu.MSG_TYPE_RESPONSE, "", filename=initial_msg.filename,
+                                filesize=entry.size, options={'live': params})
+    print(f'[svr] Sending RESPONSE, live stream {params}')
+    await conn.send(QuicStreamEvent(stream_id, response_msg.to_bytes(), False))
+
+    sender = live.LiveSender(conn.send_datagram, live.flow_id(stream_id),
+                             FecCodec(params['fec'], params['k'], params['m']), params['bitrate'])
+    packets = await sender.send_file(entry.path)
+    print(f'[svr] Live stream sent: {packets} packets, {sender.parity_packets} parity')
+    end_msg = pdu.Datagram(pdu.MSG_TYPE_END, "", options={'packets': packets})
+    await conn.send(QuicStreamEvent(stream_id, end_msg.to_bytes(), True))
+    return sender.bytes
+
+async def handle_list(scope: Dict, conn: EchoQuicConnection, list_msg: pdu.Datagram, stream_id: int) -> None:
+    """Reply to a LIST with a page of catalog entries; its 'next' option is the cursor of the page after."""
+    catalog = scope['catalog']
+    try:
+        limit = min(MAX_LIST_PAGE, max(1, int(list_msg.options.get('limit', LIST_PAGE))))
+    except (TypeError, ValueError):
+        limit = LIST_PAGE
+    cursor = list_msg.options.get('cursor')
+    entries, next_cursor = catalog.page(cursor if isinstance(cursor, str) else None, limit)
+    reply_msg = pdu.Datagram(pdu.MSG_TYPE_LIST, "", options={
+        'entries': [entry.describe() for entry in entries], 'next': next_cursor, 'total': len(catalog)})
+    print(f'[svr] Sending LIST page of {len(entries)} of {len(catalog)} files')
+    await conn.send(QuicStreamEvent(stream_id, reply_msg.to_bytes(), False))
 
 async def echo_server_proto(scope: Dict, conn: EchoQuicConnection):
     print("[svr] Waiting for messages...")
     while True:
         try:
             message: QuicStreamEvent = await conn.receive()
-            print(f"[svr] received message")
+            log.debug('[svr] received message')
+            if message.end_stream and not message.data:
+                # The client is done with this stream, e.g. after listing
+                break
             initial_msg = pdu.Datagram.from_bytes(message.data)
-            print(f"[svr] parsed message")
+            log.debug('[svr] parsed message')
             
-            if initial_msg.mtype == pdu.MSG_TYPE_REQUEST:
+            if initial_msg.mtype == pdu.MSG_TYPE_LIST:
+                await handle_list(scope, conn, initial_msg, message.stream_id)
+            elif initial_msg.mtype == pdu.MSG_TYPE_REQUEST:
                 if initial_msg.filename:
-                    if initial_msg.filesize > 0:
-                        print(f'[svr] Received upload request for file: {initial_msg.filename} with size: {initial_msg.filesize}')
-                        await handle_upload(scope, conn, initial_msg)
-                    else:
-                        print(f'[svr] Received download request for file: {initial_msg.filename}')
-                        await handle_download(scope, conn, initial_msg)
+                    started = time.monotonic()
+                    # Sets this stream's share of the server's sending (see scheduler.py)
+                    scope['priority'] = initial_msg.options.get('priority', DEFAULT_PRIORITY)
+                    metrics.ACTIVE_STREAMS.inc()
+                    try:
+                        if 'live' in initial_msg.options:
+                            print(f'[svr] Received live stream request for file: {initial_msg.filename}')
+                            size = await handle_live(scope, conn, initial_msg, message.stream_id)
+                        elif initial_msg.filesize > 0:
+                            print(f'[svr] Received upload request for file: {initial_msg.filename} with size: {initial_msg.filesize}')
+                            size = await handle_upload(scope, conn, initial_msg, message.stream_id)
+                        else:
+                            print(f'[svr] Received download request for file: {initial_msg.filename}')
+                            size = await handle_download(scope, conn, initial_msg, message.stream_id)
+                    finally:
+                        metrics.ACTIVE_STREAMS.dec()
+                    metrics.record_transfer(size, time.monotonic() - started)
+                    if scope.get('scheduler') is not None:
+                        print(f'[svr] Send scheduler by priority: {scope["scheduler"].summary()}')
+                    if scope.get('lifecycle') is not None:
+                        print(f'[svr] Server load: {scope["lifecycle"].stats()}')
+                    # A transfer ends its stream; the handler is done with it
+                    break
                 else:
                     error_msg = pdu.Datagram(pdu.MSG_TYPE_ERROR, "Invalid request")
                     print(f'[svr] Sending ERROR')